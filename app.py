@@ -1,13 +1,30 @@
-from flask import Flask, request, render_template, jsonify, send_from_directory, session, redirect, url_for
+from flask import Flask, Response, g, request, render_template, jsonify, send_from_directory, session, redirect, url_for
 from werkzeug.utils import secure_filename
 import os
+import json
+import shutil
+import tempfile
+import time
+import logging
+import atexit
+import hmac
 from datetime import datetime
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from google.cloud import vision
+import metrics
 from invoice_processor import InvoiceProcessor
+from batch import BatchExtractor, unpack_zip
+from cache import default_cache, source_sha256
+from layouts import default_layout_index
+from offload import cooperative
+from ledger import LEDGER_DUPLICATES, PERIODS, DuplicateInvoice, default_ledger, iso_date
+from jobs import DONE, FAILED, JobQueue, JobStore, QueueFull
+from sheets import SheetWriteDeferred, SheetWriter
+from tracing import Trace
 from functools import wraps
 
+# Configured here rather than on import of the processing modules, so
+# library users and the CLI keep their own logging setup
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
+
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # Required for sessions
 
@@ -18,17 +35,22 @@ if not os.path.exists(UPLOAD_FOLDER):
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Queued uploads larger than this are kept in a temporary file instead of memory
+UPLOAD_MEMORY_LIMIT = int(os.environ.get('UPLOAD_MEMORY_LIMIT_MB', 4)) * 1024 * 1024
 
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
 
 # Google Sheets API setup
 SAMPLE_SPREADSHEET_ID = '15HbBXkN3D8SryYxbNYtrVrohzbtt84_0WHpeSt0H7DU'  # Google Sheet ID
-RANGE_NAME = 'Sheet1!A2:G'  # Starting from A2 to leave room for headers
 
 # Password for the application
 APP_PASSWORD = "43north"
 
+# Bearer token Prometheus sends to scrape /metrics; without it, only a
+# logged-in session can read them
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -40,6 +62,25 @@ def login_required(f):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def request_trace(name):
+    """
+    Start a trace for this request. `?trace=1` or an `X-Trace: 1` header
+    turns on verbose dumps of the extracted text for just this request;
+    otherwise TRACE_SAMPLE_RATE decides.
+    """
+    flag = request.args.get('trace') or request.headers.get('X-Trace')
+    return Trace(name, verbose=True if flag in ('1', 'true') else None)
+
+@app.before_request
+def track_request_start():
+    metrics.IN_FLIGHT.inc()
+
+@app.teardown_request
+def track_request_end(exc):
+    # Streamed responses are still being sent here; they count until closed
+    if not g.get('streaming'):
+        metrics.IN_FLIGHT.dec()
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -61,6 +102,90 @@ def logout():
 def index():
     return render_template('index.html')
 
+def process_upload(upload, trace):
+    """Extract line items from an upload held in memory, book them and write them to the sheet."""
+    stream, filename, content_hash = upload
+    try:
+        # Clients are built once per worker, so after the first job
+        # this span should be close to zero
+        with trace.span('clients'):
+            processor = InvoiceProcessor()
+            if not filename.lower().endswith('.pdf'):
+                processor.client
+        
+        # Process the invoice; extraction and parsing record their own spans
+        results = processor.process_invoice(stream, filename)
+        
+        # An invoice number and date already booked fail the job here, before
+        # anything is written
+        booking = book_invoice(results, content_hash, filename, trace)
+        if booking and booking['duplicate_of']:
+            trace.note('duplicate_of', booking['duplicate_of'])
+        
+        # Buffered with rows from other uploads and appended in one call; if
+        # Sheets is down the job is still done, with a 'deferred' note
+        write_to_sheet(results, [booking] if booking else [], trace)
+        
+        return results
+    finally:
+        # Frees the memory, or removes the temporary file if it spilled to disk
+        stream.close()
+
+def book_invoice(results, content_hash, filename, trace, source='upload'):
+    """Record an invoice in the ledger, if it's enabled. Raises DuplicateInvoice."""
+    ledger = default_ledger()
+    if ledger is None:
+        return None
+    with trace.span('ledger'):
+        return ledger.book(results, content_hash=content_hash, filename=filename, source=source)
+
+def write_to_sheet(results, bookings, trace):
+    """
+    Append line items to the sheet, taking their bookings out of the ledger
+    if Sheets rejects them. Returns False if Sheets is unavailable and the
+    rows were left in the spool to be sent when it recovers.
+    """
+    try:
+        with trace.span('sheet_write'):
+            sheet_writer.write(SAMPLE_SPREADSHEET_ID, results)
+    except SheetWriteDeferred as e:
+        # The rows stay spooled until Sheets takes them, so they stay booked
+        trace.note('deferred', str(e))
+        return False
+    except Exception:
+        unbook(bookings)
+        raise
+    return True
+
+def unbook(bookings):
+    """Take bookings whose rows won't be written out of the ledger."""
+    for booking in bookings:
+        default_ledger().unbook(booking['id'])
+
+# Line items are spooled and appended to the sheet in batches
+sheet_writer = SheetWriter()
+atexit.register(sheet_writer.close)
+
+# Background processing of uploads
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 20))
+job_store = JobStore(os.environ.get('JOBS_DB', os.path.join('data', 'jobs.db')))
+job_queue = JobQueue(process_upload, job_store, workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE)
+# Seconds one /jobs/<id>/events response stays open before the client is told
+# to reconnect. A sync worker serving it does nothing else, so keep it well
+# under gunicorn's timeout; gunicorn.conf.py raises it for gevent workers.
+# Uploads only offer the stream (`events_url`) under gevent workers; with sync
+# workers the page polls the job instead of holding a worker per upload.
+STREAM_MAX_SECONDS = float(os.environ.get('STREAM_MAX_SECONDS', 30))
+# How often a stream checks for new events
+STREAM_POLL_SECONDS = 0.25
+
+# Cache, job, spool, layout and ledger gauges are read from their databases when scraped
+metrics.register_collector(metrics.StoreCollector(
+    cache=default_cache(), job_store=job_store, spool=sheet_writer.spool,
+    layouts=default_layout_index(), ledger=default_ledger()
+))
+
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
@@ -75,127 +200,349 @@ def upload_file():
         if not allowed_file(file.filename):
             return jsonify({'error': 'Invalid file type. Allowed types: ' + ', '.join(ALLOWED_EXTENSIONS)}), 400
         
+        trace = request_trace('upload')
+        # The upload stays in memory, with no name on disk for concurrent
+        # uploads to collide on; only large files spill to a temporary file.
+        # It's copied because Werkzeug closes the request stream once the
+        # response is sent, before the job runs.
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        stream = tempfile.SpooledTemporaryFile(max_size=UPLOAD_MEMORY_LIMIT)
+        with trace.span('save'):
+            shutil.copyfileobj(file.stream, stream)
+        trace.count('upload_bytes', stream.tell())
+        metrics.UPLOAD_BYTES.observe(stream.tell())
+        
+        # The same file booked before is turned away without extracting it
+        content_hash = None
+        duplicate = None
+        ledger = default_ledger()
+        if ledger is not None:
+            with trace.span('duplicate_check'):
+                content_hash = source_sha256(stream)
+                duplicate = ledger.find(content_hash=content_hash)
+            if duplicate is not None and LEDGER_DUPLICATES != 'flag':
+                stream.close()
+                metrics.LEDGER_DUPLICATES.labels('rejected').inc()
+                return jsonify({'error': str(DuplicateInvoice(duplicate)), 'duplicate_of': duplicate}), 409
         
         try:
-            # Process the invoice
-            processor = InvoiceProcessor()
-            results = processor.process_invoice(filepath)
-            
-            # Set up Google Sheets
-            credentials = service_account.Credentials.from_service_account_file(
-                'credentials.json',
-                scopes=['https://www.googleapis.com/auth/spreadsheets']
-            )
-            
-            service = build('sheets', 'v4', credentials=credentials)
-            spreadsheet_id = '15HbBXkN3D8SryYxbNYtrVrohzbtt84_0WHpeSt0H7DU'
-            
-            # Define headers
-            headers = [
-                ['Invoice Date', 'Invoice Number', 'Expense Description', 
-                 'Expense Quantity', 'Expense Amount', 'Total Expense Cost', 
-                 'Date Accessed']
-            ]
-            
-            # Check if headers exist
-            header_range = 'Sheet1!A1:G1'
-            result = service.spreadsheets().values().get(
-                spreadsheetId=spreadsheet_id,
-                range=header_range
-            ).execute()
-            
-            if 'values' not in result:
-                # Add headers if they don't exist
-                service.spreadsheets().values().update(
-                    spreadsheetId=spreadsheet_id,
-                    range=header_range,
-                    valueInputOption='RAW',
-                    body={'values': headers}
-                ).execute()
-                
-                # Apply header styling
-                requests = [{
-                    'repeatCell': {
-                        'range': {
-                            'sheetId': 0,  # Assuming first sheet
-                            'startRowIndex': 0,
-                            'endRowIndex': 1,
-                            'startColumnIndex': 0,
-                            'endColumnIndex': 7
-                        },
-                        'cell': {
-                            'userEnteredFormat': {
-                                'backgroundColor': {
-                                    'red': 0.9,
-                                    'green': 0.9,
-                                    'blue': 0.9
-                                },
-                                'textFormat': {
-                                    'bold': True
-                                }
-                            }
-                        },
-                        'fields': 'userEnteredFormat(backgroundColor,textFormat)'
-                    }
-                },
-                {
-                    'updateSheetProperties': {
-                        'properties': {
-                            'sheetId': 0,
-                            'gridProperties': {
-                                'frozenRowCount': 1
-                            }
-                        },
-                        'fields': 'gridProperties.frozenRowCount'
-                    }
-                }]
-                
-                service.spreadsheets().batchUpdate(
-                    spreadsheetId=spreadsheet_id,
-                    body={'requests': requests}
-                ).execute()
-            
-            # Prepare the data for Google Sheets
-            values = []
-            for item in results:
-                values.append([
-                    item['invoice_date'],
-                    item['invoice_number'],
-                    item['expense_description'],
-                    item['expense_qty'],
-                    item['expense_amount'],
-                    item['total_expense_cost'],
-                    item['date_accessed']
-                ])
-            
-            # Append the data to the sheet
-            service.spreadsheets().values().append(
-                spreadsheetId=spreadsheet_id,
-                range='Sheet1!A2:G',  # Start from row 2 to preserve headers
-                valueInputOption='USER_ENTERED',
-                insertDataOption='INSERT_ROWS',
-                body={'values': values}
-            ).execute()
-            
-            # Clean up the uploaded file
-            os.remove(filepath)
-            
-            return jsonify({
-                'message': f'Invoice processed successfully! {len(results)} items extracted.',
-                'items': results
-            })
-            
-        except Exception as e:
-            # Clean up the uploaded file in case of error
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            return jsonify({'error': str(e)}), 500
+            job_id = job_queue.submit((stream, filename, content_hash), filename=filename, trace=trace)
+        except QueueFull as e:
+            stream.close()
+            response = jsonify({'error': f'{e}. Please try again shortly.'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        
+        return jsonify({
+            'message': 'Invoice queued for processing.',
+            'job_id': job_id,
+            'status_url': url_for('job_status', job_id=job_id),
+            'events_url': url_for('job_events', job_id=job_id) if cooperative() else None,
+            'duplicate_of': duplicate
+        }), 202
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Parallel extraction for multi-file and ZIP uploads
+batch_extractor = BatchExtractor(
+    processes=int(os.environ.get('BATCH_PROCESSES', 0)) or None,
+    threads=int(os.environ.get('BATCH_THREADS', 8))
+)
+
+@app.route('/upload/batch', methods=['POST'])
+@login_required
+def upload_batch():
+    uploads = [f for f in request.files.getlist('files') + request.files.getlist('file') if f.filename]
+    if not uploads:
+        return jsonify({'error': 'No files selected'}), 400
+    
+    trace = request_trace('batch')
+    batch_dir = tempfile.mkdtemp(prefix='batch_', dir=app.config['UPLOAD_FOLDER'])
+    try:
+        with trace.span('save'):
+            files, outcomes = save_batch_uploads(uploads, batch_dir)
+        
+        with trace.span('extract'):
+            outcomes = batch_extractor.run(files) + outcomes
+        bookings = book_batch(files, outcomes, trace)
+        results = [item for outcome in outcomes if outcome['status'] == 'ok' for item in outcome['items']]
+        trace.count('files', len(files))
+        trace.count('items', len(results))
+        
+        response = {
+            'message': f'Processed {len(files)} files. {len(results)} items extracted.',
+            'files': outcomes,
+            'file_count': len(outcomes),
+            'failed_count': sum(1 for outcome in outcomes if outcome['status'] == 'error'),
+            'item_count': len(results)
+        }
+        
+        # One append for the whole batch instead of one per invoice
+        if results:
+            try:
+                written = write_to_sheet(results, bookings, trace)
+            except Exception as e:
+                response['error'] = f'Items were extracted but could not be written to the sheet: {e}'
+                return jsonify(response), 502
+            if not written:
+                # Accepted, like an upload job: the rows are spooled and booked
+                response['deferred'] = True
+                response['message'] += ' Google Sheets is unavailable; they will be written when it recovers.'
+                return jsonify(response), 202
+        
+        return jsonify(response)
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        trace.finish()
+
+def book_batch(files, outcomes, trace):
+    """
+    Book each extracted file in the ledger. Files already booked are
+    rejected as errors, with `duplicate_of`, or flagged and kept.
+    Returns the bookings.
+    """
+    if default_ledger() is None:
+        return []
+    # Outcomes only carry the file name, so a name used twice gets no hash
+    sources = {}
+    for filename, source in files:
+        sources[filename] = None if filename in sources else source
+    bookings = []
+    try:
+        for outcome in outcomes:
+            if outcome['status'] != 'ok':
+                continue
+            source = sources.get(outcome['filename'])
+            content_hash = source_sha256(source) if source is not None else None
+            try:
+                booking = book_invoice(outcome['items'], content_hash, outcome['filename'], trace, source='batch')
+            except DuplicateInvoice as e:
+                outcome.update(status='error', error=str(e), duplicate_of=e.booking['id'])
+                continue
+            if booking:
+                bookings.append(booking)
+                if booking['duplicate_of']:
+                    outcome['duplicate_of'] = booking['duplicate_of']
+    except Exception:
+        # The batch fails without writing anything, so none of it stays booked
+        unbook(bookings)
+        raise
+    return bookings
+
+def save_batch_uploads(uploads, batch_dir):
+    """
+    Read the uploaded files, unpacking ZIPs into `batch_dir`.
+    Returns the (name, bytes or path) pairs to extract and error outcomes
+    for anything that was rejected.
+    """
+    files = []
+    outcomes = []
+    for index, upload in enumerate(uploads):
+        filename = secure_filename(upload.filename)
+        extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        if extension != 'zip' and not allowed_file(filename):
+            outcomes.append({'filename': upload.filename, 'status': 'error', 'items': [],
+                             'error': 'Invalid file type. Allowed types: ' + ', '.join(ALLOWED_EXTENSIONS)})
+            continue
+        
+        # Single files are extracted straight from memory
+        if extension != 'zip':
+            content = upload.read()
+            metrics.UPLOAD_BYTES.observe(len(content))
+            files.append((upload.filename, content))
+            continue
+        
+        # ZIP members can add up to far more than the upload, so they go to disk
+        try:
+            metrics.UPLOAD_BYTES.observe(upload.stream.seek(0, os.SEEK_END))
+            upload.stream.seek(0)
+            zip_dir = os.path.join(batch_dir, f'{index}_zip')
+            os.makedirs(zip_dir)
+            extracted, skipped = unpack_zip(upload.stream, zip_dir)
+        except Exception as e:
+            outcomes.append({'filename': upload.filename, 'status': 'error', 'items': [], 'error': str(e)})
+            continue
+        files.extend(extracted)
+        outcomes.extend(skipped)
+    return files, outcomes
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events')
+@login_required
+def job_events(job_id):
+    """
+    Stream the job's progress as newline-delimited JSON, one event per line:
+    'stage' as each step starts, 'page' as each PDF page is read and 'items'
+    with line items as they are found (`first` is the index of the first;
+    later items replace earlier ones from there on). The last line is 'done'
+    or 'failed' with the job record, or 'reconnect' after STREAM_MAX_SECONDS
+    when the job is still running: request again with `?after=<id of the
+    last event>` to carry on. A sync worker is held for as long as the
+    stream is open.
+    """
+    if job_store.state(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    after = request.args.get('after', 0, type=int)
+    response = Response(job_event_stream(job_id, after), mimetype='application/x-ndjson')
+    g.streaming = True
+    response.call_on_close(metrics.IN_FLIGHT.dec)
+    # Proxies must pass each event on as it's written
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def job_event_stream(job_id, after):
+    deadline = time.monotonic() + STREAM_MAX_SECONDS
+    while True:
+        # Read before the events: a job's events are deleted when it finishes,
+        # and its record then has everything they said
+        state = job_store.state(job_id)
+        for event in job_store.events(job_id, after):
+            after = event['id']
+            yield json.dumps(event) + '\n'
+        if state in (DONE, FAILED):
+            yield json.dumps({'event': state, 'job': job_store.get(job_id)}) + '\n'
+            return
+        if time.monotonic() >= deadline:
+            yield json.dumps({'event': 'reconnect', 'after': after}) + '\n'
+            return
+        time.sleep(STREAM_POLL_SECONDS)
+
+@app.route('/jobs')
+@login_required
+def list_jobs():
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    state = request.args.get('state')
+    return jsonify({
+        'jobs': job_store.list(limit=limit, state=state),
+        'queue_depth': job_queue.depth()
+    })
+
+@app.route('/admin/cache')
+@login_required
+def cache_stats():
+    cache = default_cache()
+    if cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(cache.stats(), enabled=True))
+
+@app.route('/admin/cache/purge', methods=['POST'])
+@login_required
+def purge_cache():
+    cache = default_cache()
+    if cache is None:
+        return jsonify({'enabled': False, 'purged': 0})
+    return jsonify({'enabled': True, 'purged': cache.purge()})
+
+@app.route('/admin/layouts')
+@login_required
+def layout_stats():
+    layouts = default_layout_index()
+    if layouts is None:
+        return jsonify({'enabled': False})
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    return jsonify(dict(layouts.stats(), enabled=True, vendors_list=layouts.list(limit=limit)))
+
+@app.route('/admin/layouts/purge', methods=['POST'])
+@login_required
+def purge_layouts():
+    layouts = default_layout_index()
+    if layouts is None:
+        return jsonify({'enabled': False, 'purged': 0})
+    return jsonify({'enabled': True, 'purged': layouts.purge()})
+
+@app.route('/admin/sheets')
+@login_required
+def sheet_stats():
+    return jsonify(sheet_writer.stats())
+
+def ledger_range():
+    """The from/to dates of a ledger query, as YYYY-MM-DD. Raises ValueError."""
+    dates = []
+    for name in ('from', 'to'):
+        value = request.args.get(name)
+        if value and iso_date(value) is None:
+            raise ValueError(f"'{name}' must be a date, e.g. 2024-01-31")
+        dates.append(iso_date(value) if value else None)
+    return dates
+
+@app.route('/ledger/invoices')
+@login_required
+def ledger_invoices():
+    """Booked invoices by date range (`from`, `to`) and/or `number`; `items=1` adds their line items."""
+    ledger = default_ledger()
+    if ledger is None:
+        return jsonify({'enabled': False})
+    try:
+        start, end = ledger_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    invoices = ledger.invoices(start, end, invoice_number=request.args.get('number'), limit=limit,
+                               with_items=request.args.get('items') in ('1', 'true'))
+    return jsonify({'enabled': True, 'invoices': invoices})
+
+@app.route('/ledger/summary')
+@login_required
+def ledger_summary():
+    """Invoices, line items and expense totals per day, month or year (`by`) from `from` to `to`."""
+    ledger = default_ledger()
+    if ledger is None:
+        return jsonify({'enabled': False})
+    by = request.args.get('by', 'month')
+    if by not in PERIODS:
+        return jsonify({'error': f"'by' must be one of: {', '.join(PERIODS)}"}), 400
+    try:
+        start, end = ledger_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(dict(ledger.summary(start, end, by=by), enabled=True))
+
+@app.route('/admin/ledger')
+@login_required
+def ledger_stats():
+    ledger = default_ledger()
+    if ledger is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(ledger.stats(), enabled=True))
+
+@app.route('/admin/ledger/rebuild', methods=['POST'])
+@login_required
+def rebuild_ledger():
+    """Replace the ledger with the rows in the sheet."""
+    ledger = default_ledger()
+    if ledger is None:
+        return jsonify({'enabled': False})
+    # Booked rows still spooled aren't in the sheet yet and would be lost
+    if not sheet_writer.flush() or sheet_writer.spool.counts()['pending']:
+        return jsonify({'error': 'Rows are still waiting to be written to the sheet. '
+                                 'Try again once /admin/sheets shows none pending.'}), 409
+    started_at = time.time()
+    try:
+        rows = sheet_writer.read_rows(SAMPLE_SPREADSHEET_ID)
+    except Exception as e:
+        return jsonify({'error': f'Could not read the sheet: {e}'}), 502
+    return jsonify(dict(ledger.rebuild(rows, started_at=started_at), enabled=True, rows=len(rows)))
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Scraped by Prometheus rather than a logged-in browser, so it has its own token
+    scraper = METRICS_TOKEN and hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                    f'Bearer {METRICS_TOKEN}')
+    if not scraper and 'authenticated' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(metrics.exposition(), mimetype=metrics.CONTENT_TYPE_LATEST)
+
 if __name__ == '__main__':
-    app.run(debug=True, host='127.0.0.1', port=5000) 
\ No newline at end of file
+    app.run(debug=True, host='127.0.0.1', port=5000) 
@@ -0,0 +1,141 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Dict, List, Tuple, Union
+
+from werkzeug.utils import secure_filename
+
+from invoice_processor import InvoiceProcessor, process_invoice_file
+from ocr import VISION_BATCH_SIZE
+from sources import is_pdf_source
+
+logger = logging.getLogger(__name__)
+
+INVOICE_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
+
+# Limits for ZIP uploads, checked against the archive's central directory so
+# a small archive can't expand into something that fills the disk
+MAX_ZIP_MEMBERS = 1000
+MAX_ZIP_UNCOMPRESSED = 512 * 1024 * 1024
+
+
+class BatchExtractor:
+    """
+    Runs process_invoice over many files at once.
+
+    PDF text extraction and parsing are CPU-bound, so they go to a process
+    pool; Vision OCR is network-bound, so images go to a thread pool sharing
+    the worker's Vision client, one Vision batch request's worth per task.
+    Both pools are created on first use and reused.
+    """
+
+    def __init__(self, processes: int = None, threads: int = 8):
+        self.processes = processes or os.cpu_count() or 1
+        self.threads = threads
+        self._process_pool = None
+        self._thread_pool = None
+        self._lock = threading.Lock()
+
+    def _pools(self):
+        with self._lock:
+            if self._process_pool is None:
+                # Spawn rather than fork: the gunicorn worker already has job
+                # threads running, and forking a threaded process can deadlock.
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                self._thread_pool = ThreadPoolExecutor(
+                    max_workers=self.threads, thread_name_prefix='batch-ocr'
+                )
+        return self._process_pool, self._thread_pool
+
+    def run(self, files: List[Tuple[str, Union[str, bytes]]]) -> List[Dict]:
+        """
+        Extract line items from each (filename, source) pair, where the
+        source is a path or the file's bytes.
+
+        Returns one entry per file, PDFs first, with either `items` or `error`
+        set. A failure in one file doesn't affect the others.
+        """
+        process_pool, thread_pool = self._pools()
+        futures = []
+        images = []
+        for filename, source in files:
+            if is_pdf_source(source, filename):
+                futures.append(([filename], process_pool.submit(process_invoice_file, source, filename), False))
+            else:
+                images.append((filename, source))
+
+        # Images go to OCR in groups the size of one Vision batch request
+        processor = InvoiceProcessor()
+        for start in range(0, len(images), VISION_BATCH_SIZE):
+            group = images[start:start + VISION_BATCH_SIZE]
+            future = thread_pool.submit(processor.process_images, [source for _, source in group])
+            futures.append(([filename for filename, _ in group], future, True))
+
+        outcomes = []
+        for filenames, future, grouped in futures:
+            try:
+                results = future.result() if grouped else [future.result()]
+            except Exception as e:
+                results = [e] * len(filenames)
+            for filename, result in zip(filenames, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error processing {filename}: {str(result)}")
+                    outcomes.append({'filename': filename, 'status': 'error', 'items': [],
+                                     'error': str(result)})
+                else:
+                    items, cache_status = result
+                    outcomes.append({'filename': filename, 'status': 'ok', 'items': items,
+                                     'error': None, 'cache': cache_status})
+        return outcomes
+
+    def shutdown(self):
+        with self._lock:
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=False, cancel_futures=True)
+                self._thread_pool.shutdown(wait=False, cancel_futures=True)
+                self._process_pool = None
+                self._thread_pool = None
+
+
+def is_invoice_file(filename: str) -> bool:
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in INVOICE_EXTENSIONS
+
+
+def unpack_zip(zip_file: Union[str, BinaryIO], dest_dir: str) -> Tuple[List[Tuple[str, str]], List[Dict]]:
+    """
+    Extract the invoice files in a ZIP archive (a path or a seekable stream)
+    into `dest_dir`.
+
+    Returns the (filename, path) pairs that were extracted and an error entry
+    for every member that was skipped.
+    """
+    files = []
+    skipped = []
+    with zipfile.ZipFile(zip_file) as archive:
+        members = [info for info in archive.infolist() if not info.is_dir()]
+        if len(members) > MAX_ZIP_MEMBERS:
+            raise ValueError(f'ZIP archive has too many files (max {MAX_ZIP_MEMBERS})')
+        if sum(info.file_size for info in members) > MAX_ZIP_UNCOMPRESSED:
+            raise ValueError('ZIP archive is too large once uncompressed')
+
+        for index, info in enumerate(members):
+            name = os.path.basename(info.filename)
+            if name.startswith('.') or '__MACOSX' in info.filename:
+                continue
+            if not is_invoice_file(name):
+                skipped.append({'filename': info.filename, 'status': 'error', 'items': [],
+                                'error': 'Unsupported file type'})
+                continue
+            # Index prefix keeps same-named files from different folders apart
+            path = os.path.join(dest_dir, f'{index}_{secure_filename(name)}')
+            with archive.open(info) as source, open(path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            files.append((info.filename, path))
+    return files, skipped
@@ -0,0 +1,191 @@
+"""
+Check the line item parser against the golden corpus and measure its throughput.
+
+    python -m benchmarks.bench_parser                  # verify + benchmark
+    python -m benchmarks.bench_parser --update-golden  # re-record expected output
+
+Exits non-zero if any golden invoice parses differently, if parsing with
+learned vendor layouts gives a different result than the heuristics, or if
+a PDF would stop being read at a page that changes its result.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import golden_corpus, large_invoice
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), 'golden_parser.json')
+
+# Invoices that share a letterhead, in the order they are parsed: the first
+# has no column header row, so the plan learned from it has none, and the
+# second has one above its items, after an amount that isn't an item
+_HEADERLESS = """{letterhead}
+Invoice #: 100
+Date: 01/02/2024
+1. Widget 2 5.00 10.00
+2. Gadget 1 3.00 3.00
+Total: 13.00
+"""
+_WITH_HEADER = """{letterhead}
+Invoice #: 200
+Date: 01/03/2024
+Account balance brought forward 1,234.00 1,234.00
+Services
+Description Qty Rate Amount
+Consulting 2 100.00 200.00
+Support 1 50.00 50.00
+Total: 250.00
+"""
+LAYOUT_COLLISIONS = [
+    (f'collision_{name}_{i}', template.format(letterhead=letterhead))
+    for name, letterhead in (('generic', 'INVOICE'), ('vendor', 'Acme Corp'))
+    for i, template in enumerate((_HEADERLESS, _WITH_HEADER))
+]
+# A vendor's invoices labelled 'Invoice # 1001' and then 'Invoice #: 2002',
+# the second also mentioning the first with the looser label
+NUMBER_COLLISIONS = [
+    ('number_label_0', 'Acme Corp\nInvoice # 1001\nDate: 01/02/2024\nServices\nDescription Qty Rate Amount\n'
+                       'Consulting 2 100.00 200.00\nTotal: 200.00\n'),
+    ('number_label_1', 'Acme Corp\nInvoice #: 2002\nDate: 02/02/2024\nServices\nDescription Qty Rate Amount\n'
+                       'Support 1 50.00 50.00\nCredit applied from Invoice # 1001\nTotal: 50.00\n'),
+]
+# Pages of a PDF whose first page has amounts and a terminator before the
+# item section on the second
+SECTION_ON_PAGE_TWO = [
+    'Acme Corp\nInvoice #: 55\nDate: 01/02/2024\nAmount Due: $250.00\nPayment Terms: Net 30',
+    'Services\nDescription Qty Rate Amount\nConsulting 2 100.00 200.00\nSupport 1 50.00 50.00\nTotal: 250.00\n'
+    'Notes\nThank you',
+]
+
+
+def _digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def parse(processor, text):
+    return {
+        'date': processor._extract_date(text),
+        'invoice_number': processor._extract_invoice_number(text),
+        'items': processor._extract_line_items(text),
+    }
+
+
+def check_golden(processor, update: bool = False) -> int:
+    corpus = golden_corpus()
+    actual = {}
+    for name, text in corpus:
+        parsed = parse(processor, text)
+        actual[name] = {'input': _digest(text), 'output': _digest(parsed), 'items': len(parsed['items'])}
+
+    if update:
+        with open(GOLDEN_PATH, 'w') as f:
+            json.dump(actual, f, indent=1, sort_keys=True)
+        print(f'Recorded {len(actual)} golden invoices')
+        return 0
+
+    with open(GOLDEN_PATH) as f:
+        expected = json.load(f)
+    failures = 0
+    for name, entry in actual.items():
+        if expected.get(name, {}).get('input') != entry['input']:
+            print(f'{name}: corpus input changed; re-record with --update-golden')
+            failures += 1
+        elif expected[name] != entry:
+            print(f'{name}: output differs from golden')
+            failures += 1
+    print(f'Golden corpus: {len(actual) - failures}/{len(actual)} identical')
+    return failures
+
+
+def check_layouts() -> int:
+    """
+    Parse the corpus and the letterhead and invoice number collisions twice
+    with a fresh layout index; every result must match the heuristics.
+    """
+    from invoice_parser import InvoiceParser
+    from layouts import LayoutIndex
+
+    corpus = golden_corpus() + LAYOUT_COLLISIONS + NUMBER_COLLISIONS
+    heuristics = InvoiceParser()
+    with tempfile.TemporaryDirectory() as tmp:
+        index = LayoutIndex(os.path.join(tmp, 'layouts.db'))
+        learning = InvoiceParser(layouts=index)
+        failures = 0
+        for _ in range(2):
+            for name, text in corpus:
+                if learning.parse(text) != heuristics.parse(text):
+                    print(f'{name}: parses differently with its vendor layout')
+                    failures += 1
+        stats = index.stats()
+    print(f"Layout plans: {2 * len(corpus) - failures}/{2 * len(corpus)} identical, "
+          f"{stats['vendors']} vendors, hit rate {stats['hit_rate']:.0%}")
+    return failures
+
+
+def check_stop_at_totals(lines_per_page: int = 5) -> int:
+    """
+    Split each invoice into pages and read them until SectionTracker says
+    the items are complete; the pages read must parse like the whole text.
+    """
+    from invoice_parser import InvoiceParser, SectionTracker
+
+    parser = InvoiceParser()
+    documents = [('section_on_page_two', SECTION_ON_PAGE_TWO)]
+    for name, text in golden_corpus():
+        lines = text.split('\n')
+        documents.append((name, ['\n'.join(lines[i:i + lines_per_page])
+                                 for i in range(0, len(lines), lines_per_page)]))
+    failures = stopped = 0
+    for name, pages in documents:
+        tracker = SectionTracker()
+        read = next((i + 1 for i, page in enumerate(pages) if tracker.feed(page)), len(pages))
+        stopped += read < len(pages)
+        if parser.parse('\n'.join(pages[:read])) != parser.parse('\n'.join(pages)):
+            print(f'{name}: stopping after page {read} of {len(pages)} changes its items')
+            failures += 1
+    print(f'Stop at totals: {len(documents) - failures}/{len(documents)} identical, '
+          f'{stopped} stopped early')
+    return failures
+
+
+def bench_throughput(processor, sizes=(100, 1000, 5000), repeat: int = 3):
+    rng = random.Random(11)
+    for size in sizes:
+        text = large_invoice(rng, size)
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parse(processor, text)
+            best = min(best, time.perf_counter() - start)
+        lines = text.count('\n')
+        print(f'{size:>6} items  {lines:>6} lines  {best * 1000:9.2f} ms  {lines / best:12,.0f} lines/s')
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--update-golden', action='store_true')
+    parser.add_argument('--skip-bench', action='store_true')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('INVOICE_CACHE', '0')
+    logging.disable(logging.INFO)
+    from invoice_processor import InvoiceProcessor
+    processor = InvoiceProcessor(cache=False, layouts=False)
+
+    failures = check_golden(processor, update=args.update_golden)
+    if not args.update_golden:
+        failures += check_layouts()
+        failures += check_stop_at_totals()
+    if not args.skip_bench:
+        bench_throughput(processor)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
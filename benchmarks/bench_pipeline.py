@@ -0,0 +1,495 @@
+"""
+Benchmark InvoiceProcessor and the /upload flow on synthetic invoices.
+
+    python -m benchmarks.bench_pipeline                    # run, compare with the baseline
+    python -m benchmarks.bench_pipeline --update-baseline  # re-record the baseline
+    python -m benchmarks.bench_pipeline --scenario parse --quick
+
+Scenarios:
+    parse   _extract_date, _extract_invoice_number, _extract_line_items and parse_text
+    pdf     process_invoice on generated PDFs (extract and parse spans)
+    pdf_table  process_invoice on PDFs with the line items in a real table,
+               read from the table and, for comparison, from the text
+    image   process_invoice and process_images on images, with a fake Vision client
+    upload  POST /upload through to a finished job, with fake Vision and Sheets clients
+
+Each scenario runs in its own process so its peak RSS is its own. Reports
+p50/p95/p99 latency per stage, throughput, accuracy against the values the
+corpus generator put in, and peak RSS. Exits non-zero if accuracy drops or
+latency, throughput or memory regress past --tolerance of the baseline.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from benchmarks.corpus import invoice_pdf, synthetic_corpus, table_invoice_pdf
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline_pipeline.json')
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ['parse', 'pdf', 'pdf_table', 'image', 'upload']
+
+SIZES = (1, 10, 100, 1000, 5000)
+QUICK_SIZES = (1, 10, 100, 1000)
+# Line items per table PDF; 5,000 rows is about 100 pages
+TABLE_SIZES = (10, 100, 1000, 5000)
+QUICK_TABLE_SIZES = (10, 100, 1000)
+# In-process stages are timed this many times per invoice, keeping the fastest
+REPEAT = 3
+# Latency differences smaller than this are noise, whatever the ratio
+MIN_DELTA_MS = 1.0
+MIN_DELTA_RSS_MB = 10
+# Stages and percentiles compared with the baseline, where not all of them.
+# The upload flow's stages share the GIL with other jobs and its tail depends
+# on thread scheduling, so only its end-to-end median is compared.
+COMPARED = {'upload': {'upload_to_done': ('p50_ms',)}}
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Linearly interpolated percentile of `values` (0 <= p <= 100)."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(seconds: List[float]) -> Dict:
+    return {
+        'n': len(seconds),
+        'p50_ms': round(percentile(seconds, 50) * 1000, 3),
+        'p95_ms': round(percentile(seconds, 95) * 1000, 3),
+        'p99_ms': round(percentile(seconds, 99) * 1000, 3),
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class Samples:
+    """Durations per stage."""
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages.setdefault(stage, []).append(seconds)
+
+    def time(self, stage: str, fn, *args, repeat: int = 1):
+        """Call `fn(*args)` `repeat` times, record the fastest and return the last result."""
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn(*args)
+            best = min(best, time.perf_counter() - start)
+        self.add(stage, best)
+        return result
+
+    def summary(self) -> Dict:
+        return {stage: summarize(values) for stage, values in self.stages.items()}
+
+
+def is_correct(results: List[Dict], expected: Dict) -> bool:
+    """True if the sheet rows match the invoice the generator described."""
+    items = [{
+        'description': row['expense_description'],
+        'quantity': row['expense_qty'],
+        'amount': row['expense_amount'],
+        'total': row['total_expense_cost'],
+    } for row in results]
+    return items == expected['items'] and all(
+        row['invoice_number'] == expected['invoice_number'] and
+        row['invoice_date'] == expected['invoice_date']
+        for row in results
+    )
+
+
+def _lines(text: str) -> int:
+    return text.count('\n')
+
+
+def scenario_parse(quick: bool) -> Dict:
+    from invoice_processor import InvoiceProcessor
+    processor = InvoiceProcessor(cache=False)
+    corpus = synthetic_corpus(sizes=QUICK_SIZES if quick else SIZES)
+    processor.parse_text(corpus[-1][1])  # warm up
+    samples = Samples()
+    correct = 0
+    lines = 0
+    for _, text, expected in corpus:
+        samples.time('_extract_date', processor._extract_date, text, repeat=REPEAT)
+        samples.time('_extract_invoice_number', processor._extract_invoice_number, text, repeat=REPEAT)
+        samples.time('_extract_line_items', processor._extract_line_items, text, repeat=REPEAT)
+        results = samples.time('parse_text', processor.parse_text, text, repeat=REPEAT)
+        correct += is_correct(results, expected)
+        lines += _lines(text)
+    elapsed = sum(samples.stages['parse_text'])
+    return {
+        'stages': samples.summary(),
+        'throughput': {'invoices_per_s': round(len(corpus) / elapsed, 1),
+                       'lines_per_s': round(lines / elapsed)},
+        'accuracy': round(correct / len(corpus), 4),
+    }
+
+
+def _traced(samples: Samples, processor, path: str, repeat: int = 1, prefix: str = ''):
+    """
+    process_invoice with its trace spans recorded as stages (named with
+    `prefix`), and the time until the first line items were reported as
+    first_items; keeps the fastest run.
+    """
+    from tracing import Trace
+    best = None
+    for _ in range(repeat):
+        trace = Trace('bench', verbose=False)
+        first_items = []
+
+        def on_event(event):
+            if event.get('items') and not first_items:
+                first_items.append(time.perf_counter() - start)
+
+        trace.listen(on_event)
+        start = time.perf_counter()
+        with trace.activate():
+            results = processor.process_invoice(path)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, trace.spans, first_items)
+    samples.add(f'{prefix}process_invoice', best[0])
+    for span in ('extract', 'parse'):
+        if span in best[1]:
+            samples.add(f'{prefix}{span}', best[1][span])
+    if best[2]:
+        samples.add(f'{prefix}first_items', best[2][0])
+    return results
+
+
+def scenario_pdf(quick: bool) -> Dict:
+    from invoice_processor import InvoiceProcessor
+    processor = InvoiceProcessor(cache=False)
+    corpus = synthetic_corpus(sizes=QUICK_SIZES if quick else SIZES, per_size=2)
+    samples = Samples()
+    correct = 0
+    pages = 0
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for name, text, expected in corpus:
+            path = os.path.join(directory, f'{name}.pdf')
+            pages += invoice_pdf(text, path)
+            paths.append((path, expected))
+        processor.process_invoice(paths[0][0])  # warm up
+        for path, expected in paths:
+            # The 5,000-line documents take seconds each, so they run once
+            repeat = REPEAT if len(expected['items']) <= 1000 else 1
+            correct += is_correct(_traced(samples, processor, path, repeat=repeat), expected)
+    elapsed = sum(samples.stages['process_invoice'])
+    return {
+        'stages': samples.summary(),
+        'throughput': {'invoices_per_s': round(len(corpus) / elapsed, 1),
+                       'pages_per_s': round(pages / elapsed, 1)},
+        'accuracy': round(correct / len(corpus), 4),
+    }
+
+
+def scenario_pdf_table(quick: bool) -> Dict:
+    from invoice_processor import InvoiceProcessor
+    processor = InvoiceProcessor(cache=False, tables=True)
+    text_processor = InvoiceProcessor(cache=False, tables=False)
+    rng = random.Random(17)
+    samples = Samples()
+    correct = 0
+    text_correct = 0
+    pages = 0
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for size in QUICK_TABLE_SIZES if quick else TABLE_SIZES:
+            for i in range(2):
+                path = os.path.join(directory, f'table_{size}_{i}.pdf')
+                page_count, expected = table_invoice_pdf(rng, size, path)
+                pages += page_count
+                paths.append((path, expected))
+        processor.process_invoice(paths[0][0])  # warm up
+        for path, expected in paths:
+            repeat = REPEAT if len(expected['items']) <= 1000 else 1
+            correct += is_correct(_traced(samples, processor, path, repeat=repeat), expected)
+            # The same document with the line items parsed from the text
+            text_correct += is_correct(
+                _traced(samples, text_processor, path, repeat=repeat, prefix='text.'), expected)
+    elapsed = sum(samples.stages['process_invoice'])
+    return {
+        'stages': samples.summary(),
+        'throughput': {'invoices_per_s': round(len(paths) / elapsed, 1),
+                       'pages_per_s': round(pages / elapsed, 1)},
+        'accuracy': round(correct / len(paths), 4),
+        'text_accuracy': round(text_correct / len(paths), 4),
+    }
+
+
+def scenario_image(quick: bool, vision_latency: float = 0.0) -> Dict:
+    from benchmarks.fakes import FakeVision, fake_image
+    from clients import registry
+    from invoice_processor import InvoiceProcessor
+    vision = FakeVision(latency=vision_latency)
+    registry.override('vision', vision)
+    processor = InvoiceProcessor(cache=False)
+    corpus = synthetic_corpus(sizes=(1, 10, 100) if quick else (1, 10, 100, 1000))
+    samples = Samples()
+    correct = 0
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for name, text, expected in corpus:
+            path = os.path.join(directory, f'{name}.png')
+            with open(path, 'wb') as f:
+                f.write(fake_image(text))
+            paths.append((path, expected))
+        processor.process_invoice(paths[0][0])  # warm up
+        for path, expected in paths:
+            correct += is_correct(_traced(samples, processor, path, repeat=REPEAT), expected)
+        # The same images again, as one batch
+        outcomes = samples.time('process_images', processor.process_images, [p for p, _ in paths],
+                                repeat=REPEAT)
+    elapsed = sum(samples.stages['process_invoice'])
+    return {
+        'stages': samples.summary(),
+        'throughput': {'invoices_per_s': round(len(corpus) / elapsed, 1),
+                       'batch_invoices_per_s': round(len(outcomes) / samples.stages['process_images'][0], 1)},
+        'accuracy': round(correct / len(corpus), 4),
+        'vision_calls': vision.calls,
+    }
+
+
+def scenario_upload(quick: bool, vision_latency: float = 0.0, sheets_latency: float = 0.0,
+                    concurrency: int = 4) -> Dict:
+    # The app creates uploads/ and data/ in the working directory
+    workdir = tempfile.mkdtemp(prefix='bench_upload_')
+    os.chdir(workdir)
+    os.environ.update({
+        'INVOICE_CACHE': '0',
+        'JOBS_DB': os.path.join(workdir, 'jobs.db'),
+        'SHEETS_SPOOL': os.path.join(workdir, 'spool.db'),
+        'LEDGER_PATH': os.path.join(workdir, 'ledger.db'),
+        # The warm-up uploads are sent again in the measured run
+        'LEDGER_DUPLICATES': 'flag',
+        'SHEETS_FLUSH_SECONDS': '0.05',
+        'TRACE_LOG': '0',
+    })
+    from benchmarks.fakes import FakeSheets, FakeVision, fake_image
+    from clients import registry
+    import app as webapp
+
+    sheets = FakeSheets(latency=sheets_latency)
+    registry.override('vision', FakeVision(latency=vision_latency))
+    registry.override('sheets', sheets)
+
+    corpus = synthetic_corpus(sizes=(1, 10, 100), per_size=4 if quick else 12)
+    uploads = []
+    for i, (name, text, expected) in enumerate(corpus):
+        if i % 2:
+            path = os.path.join(workdir, f'{name}.pdf')
+            invoice_pdf(text, path)
+        else:
+            path = os.path.join(workdir, f'{name}.png')
+            with open(path, 'wb') as f:
+                f.write(fake_image(text))
+        with open(path, 'rb') as f:
+            uploads.append((os.path.basename(path), f.read(), expected))
+
+    samples = Samples()
+    lock = threading.Lock()
+    outcomes = []
+    # Two uploads first to start the job and sheet writer threads
+    pending = uploads[:2]
+
+    def client_loop():
+        client = webapp.app.test_client()
+        with client.session_transaction() as session:
+            session['authenticated'] = True
+        while True:
+            with lock:
+                if not pending:
+                    return
+                filename, content, expected = pending.pop()
+            start = time.perf_counter()
+            response = client.post('/upload', data={'file': (io.BytesIO(content), filename)})
+            if response.status_code != 202:
+                with lock:
+                    outcomes.append((False, None))
+                continue
+            status_url = response.get_json()['status_url']
+            while True:
+                job = client.get(status_url).get_json()
+                if job['state'] in ('done', 'failed'):
+                    break
+                time.sleep(0.005)
+            elapsed = time.perf_counter() - start
+            with lock:
+                samples.add('upload_to_done', elapsed)
+                timings = job['timings'] or {}
+                for stage in ('save', 'duplicate_check', 'queued', 'extract', 'parse', 'ledger', 'sheet_write'):
+                    if stage in timings:
+                        # PDF and image extraction take very different times
+                        name = f"extract_{timings.get('path')}" if stage == 'extract' else stage
+                        samples.add(name, timings[stage] / 1000)
+                ok = job['state'] == 'done' and is_correct(job['results'], expected)
+                outcomes.append((ok, job['state']))
+
+    client_loop()
+    samples = Samples()
+    outcomes = []
+    pending = list(uploads)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client_loop) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    webapp.sheet_writer.close()
+
+    return {
+        'stages': samples.summary(),
+        'throughput': {'uploads_per_s': round(len(uploads) / wall, 1)},
+        'accuracy': round(sum(ok for ok, _ in outcomes) / len(uploads), 4),
+        'sheet_appends': sum(1 for method, _ in sheets.calls if method == 'append'),
+        'sheet_rows': len(sheets.rows),
+    }
+
+
+RUNNERS = {
+    'parse': scenario_parse,
+    'pdf': scenario_pdf,
+    'pdf_table': scenario_pdf_table,
+    'image': scenario_image,
+    'upload': scenario_upload,
+}
+
+
+def run_child(name: str, quick: bool) -> Dict:
+    """Run one scenario in a fresh interpreter and return its report."""
+    command = [sys.executable, '-m', 'benchmarks.bench_pipeline', '--child', name]
+    if quick:
+        command.append('--quick')
+    completed = subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f'Scenario {name} failed:\n{completed.stderr}')
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare(baseline: Dict, current: Dict, tolerance: float) -> List[str]:
+    """Every way `current` is worse than `baseline` by more than `tolerance`."""
+    regressions = []
+    for name, report in current.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if report['accuracy'] < base['accuracy']:
+            regressions.append(f"{name}: accuracy {report['accuracy']:.2%} < {base['accuracy']:.2%}")
+        compared = COMPARED.get(name)
+        for stage, stats in report['stages'].items():
+            base_stats = base['stages'].get(stage)
+            if not base_stats or (compared is not None and stage not in compared):
+                continue
+            for key in (compared[stage] if compared else ('p50_ms', 'p95_ms')):
+                if (stats[key] > base_stats[key] * (1 + tolerance) and
+                        stats[key] - base_stats[key] > MIN_DELTA_MS):
+                    regressions.append(f'{name}.{stage}: {key} {stats[key]:.2f} > {base_stats[key]:.2f}')
+        for key, value in report['throughput'].items():
+            if key in base['throughput'] and value < base['throughput'][key] / (1 + tolerance):
+                regressions.append(f"{name}: {key} {value} < {base['throughput'][key]}")
+        if (report['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance) and
+                report['peak_rss_mb'] - base['peak_rss_mb'] > MIN_DELTA_RSS_MB):
+            regressions.append(f"{name}: peak RSS {report['peak_rss_mb']} MB > {base['peak_rss_mb']} MB")
+    return regressions
+
+
+def _metric(regression: str) -> str:
+    """The scenario, stage and metric a compare() message is about."""
+    return ' '.join(regression.split(' ')[:2])
+
+
+def print_report(name: str, report: Dict) -> None:
+    print(f"\n[{name}]  accuracy {report['accuracy']:.2%}  peak RSS {report['peak_rss_mb']} MB  " +
+          '  '.join(f'{key} {value:,}' for key, value in report['throughput'].items()))
+    if 'text_accuracy' in report:
+        print(f"  line items from the text instead: accuracy {report['text_accuracy']:.2%}")
+    print(f"  {'stage':<26}{'n':>6}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}")
+    for stage, stats in report['stages'].items():
+        print(f"  {stage:<26}{stats['n']:>6}{stats['p50_ms']:>11.3f}{stats['p95_ms']:>11.3f}{stats['p99_ms']:>11.3f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='run only this scenario (repeatable)')
+    parser.add_argument('--quick', action='store_true', help='smaller corpus, no 5,000-line invoices')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slowdown/growth over the baseline (default 0.5 = 50%%)')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        os.environ.setdefault('INVOICE_CACHE', '0')
+        os.environ.setdefault('LAYOUT_INDEX', '0')
+        logging.disable(logging.WARNING)
+        report = RUNNERS[args.child](args.quick)
+        report['peak_rss_mb'] = peak_rss_mb()
+        print(json.dumps(report))
+        return 0
+
+    current = {}
+    for name in args.scenario or SCENARIOS:
+        current[name] = run_child(name, args.quick)
+        print_report(name, current[name])
+
+    mode = 'quick' if args.quick else 'full'
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+    if args.update_baseline:
+        baseline.setdefault(mode, {}).update(current)
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print(f'\nRecorded {mode} baseline for {", ".join(current)}')
+        return 0
+
+    if mode not in baseline:
+        print(f'\nNo {mode} baseline recorded; run with --update-baseline')
+        return 0
+    regressions = compare(baseline[mode], current, args.tolerance)
+    if regressions:
+        # Timings on a shared machine are noisy: only report regressions that
+        # show up again when their scenario is re-run
+        rerun = sorted({regression.split(':')[0].split('.')[0] for regression in regressions})
+        print(f'\nPossible regressions in {", ".join(rerun)}; re-running to confirm')
+        retry = {name: run_child(name, args.quick) for name in rerun}
+        confirmed = {_metric(regression) for regression in compare(baseline[mode], retry, args.tolerance)}
+        regressions = [regression for regression in regressions if _metric(regression) in confirmed]
+    if regressions:
+        print(f'\n{len(regressions)} REGRESSIONS against the {mode} baseline:')
+        for regression in regressions:
+            print(f'  {regression}')
+        return 1
+    print(f'\nNo regressions against the {mode} baseline (tolerance {args.tolerance:.0%})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
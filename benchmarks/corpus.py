@@ -0,0 +1,409 @@
+"""
+Synthetic invoice text for benchmarks and parser regression checks.
+
+Everything here is generated from a seeded random.Random, so the same seed
+always produces the same corpus.
+"""
+import random
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+WORDS = ['Consulting', 'Design', 'review', 'hours', 'Widget', 'assembly', 'Freight', 'handling',
+         'Support', 'plan', 'License', 'renewal', 'Onsite', 'visit', 'Travel', 'Materials',
+         'Labor', 'Parts', 'Cloud', 'hosting', 'Model', 'X200', 'v2.1', 'Phase', '3', 'rush']
+VENDORS = ['Acme Corp', 'Globex LLC', 'Initech', 'Umbrella Supply', 'Hooli Services', 'Stark Parts']
+
+
+def _date(rng: random.Random) -> str:
+    y, m, d = rng.randint(2019, 2026), rng.randint(1, 12), rng.randint(1, 28)
+    style = rng.randrange(6)
+    if style == 0:
+        return f'{m:02d}/{d:02d}/{y}'
+    if style == 1:
+        return f'{m:02d}-{d:02d}-{y}'
+    if style == 2:
+        return f'{y}/{m:02d}/{d:02d}'
+    if style == 3:
+        return f'{y}-{m:02d}-{d:02d}'
+    if style == 4:
+        return f'{rng.choice(MONTHS)}{rng.choice(["", "uary", "."])} {d}, {y}'
+    return f'{m:02d}/{d:02d}/{y % 100:02d}'
+
+
+def _money(rng: random.Random, value: float) -> str:
+    text = f'{value:,.2f}' if rng.random() < 0.7 else f'{value:.2f}'
+    return ('$' + text) if rng.random() < 0.4 else text
+
+
+def _description(rng: random.Random, words: int = None) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words or rng.randint(1, 5)))
+
+
+def item_line(rng: random.Random, number: int) -> str:
+    """One line item in a random style: date/number prefix, 2 or 3 numbers, $ and commas."""
+    qty = rng.choice([1, 2, 3, 5, 10, 12.5, 0.5])
+    rate = round(rng.uniform(0, 5000), 2) if rng.random() < 0.97 else 0.0
+    total = round(qty * rate, 2)
+    prefix = rng.choice(['', '', _date(rng)[:8], f'{number}.', f'{number})', f'({number})'])
+    fields = [_description(rng)]
+    if rng.random() < 0.7:
+        fields.append(str(qty))
+    fields += [_money(rng, rate), _money(rng, total)]
+    if rng.random() < 0.05:
+        fields.insert(1, '-' + str(rng.randint(1, 9)))
+    return ' '.join(([prefix] if prefix else []) + fields)
+
+
+def golden_invoice(rng: random.Random, index: int) -> str:
+    """A small invoice mixing the layouts and quirks the parser has to handle."""
+    lines = []
+    lines.append(rng.choice(VENDORS) + rng.choice(['', ' Inc.', ' INVOICE']))
+    number = rng.randint(1, 999999)
+    style = rng.randrange(6)
+    if style == 0:
+        lines.append(f'Invoice #: {number}')
+    elif style == 1:
+        lines.append(f'Invoice # {number}')
+    elif style == 2:
+        lines += ['INVOICE', '', f'Ref # {number}']
+    elif style == 3:
+        lines += ['Invoice', 'No number here #', f'PO#{number}#x']
+    elif style == 4:
+        lines += ['Invoice #:', str(number)]
+    if rng.random() < 0.8:
+        lines.append(f'Date: {_date(rng)}')
+    if rng.random() < 0.3:
+        lines.append(rng.choice(['Payment Terms: Net 30', 'Notes: thanks', 'Bill to: 12 Main St.']))
+
+    layout = rng.randrange(5)
+    if layout == 0:
+        lines += [rng.choice(['Services', 'Line Items', 'Product details', 'Charges']),
+                  rng.choice(['Date Description Qty Rate Amount', 'Item Quantity Price Amount',
+                              'Description Rate Total', 'Quantity Price'])]
+    elif layout == 1:
+        lines += ['Description', '', 'Some text', 'Item         Amount']
+    elif layout == 2:
+        lines += ['Items', 'a', 'b', 'c', 'd', 'e', 'Date Description']
+    elif layout == 3 and rng.random() < 0.5:
+        lines.append('Total: 0.00 (previous balance)')
+
+    for n in range(1, rng.randint(0, 12) + 1):
+        lines.append(item_line(rng, n))
+        roll = rng.random()
+        if roll < 0.2:
+            lines.append(_description(rng))
+        elif roll < 0.25:
+            lines.append(f'{n}. only one number 5')
+        elif roll < 0.3:
+            lines.append('   ')
+        elif roll < 0.33:
+            lines.append('Shipping 12.00')
+
+    lines.append(rng.choice(['Subtotal: 100.00', 'Services Subtotal: 10.00', 'Total: 5.00',
+                             'Balance Due 0.00', 'Amount Due: 1.00', 'Terms apply', 'NOTES', '']))
+    if rng.random() < 0.5:
+        lines.append(item_line(rng, 99))
+    return '\n'.join(lines) + rng.choice(['', '\n'])
+
+
+def golden_corpus(seed: int = 8, count: int = 300) -> List[Tuple[str, str]]:
+    """(name, text) pairs used to check that parser changes don't change output."""
+    rng = random.Random(seed)
+    return [(f'golden-{i:03d}', golden_invoice(rng, i)) for i in range(count)]
+
+
+def large_invoice(rng: random.Random, items: int) -> str:
+    """A long single-section invoice with continuation lines, for throughput runs."""
+    lines = [rng.choice(VENDORS), f'Invoice #: {rng.randint(1, 99999)}', f'Date: {_date(rng)}',
+             'Services', 'Date Description Qty Rate Amount']
+    for n in range(1, items + 1):
+        lines.append(item_line(rng, n))
+        if rng.random() < 0.2:
+            lines.append(_description(rng))
+    lines += ['Subtotal: 1.00', 'Payment Terms: Net 30']
+    return '\n'.join(lines) + '\n'
+
+
+# Words that can't be mistaken for numbers, headers or terminators, so the
+# expected parse of a synthetic invoice is known exactly
+CLEAN_WORDS = ['Consulting', 'Design', 'review', 'hours', 'Widget', 'assembly', 'Freight',
+               'handling', 'Support', 'plan', 'License', 'renewal', 'Onsite', 'visit', 'Travel',
+               'Materials', 'Labor', 'Parts', 'Cloud', 'hosting', 'Model', 'rush', 'Phase']
+LAYOUTS = ['table', 'numbered', 'dated', 'plain']
+NUMBER_STYLES = ['labelled', 'hash', 'fallback']
+PDF_LINES_PER_PAGE = 60
+
+
+def _header_date(rng: random.Random) -> str:
+    """An invoice date in one of the styles the parser reads in full."""
+    y, m, d = rng.randint(2019, 2026), rng.randint(1, 12), rng.randint(1, 28)
+    style = rng.randrange(5)
+    if style == 0:
+        return f'{m:02d}/{d:02d}/{y}'
+    if style == 1:
+        return f'{m:02d}-{d:02d}-{y}'
+    if style == 2:
+        return f'{y}/{m:02d}/{d:02d}'
+    if style == 3:
+        return f'{y}-{m:02d}-{d:02d}'
+    return f'{MONTHS[m - 1]} {d}, {y}'
+
+
+def _clean_description(rng: random.Random, words: int = None) -> str:
+    return ' '.join(rng.choice(CLEAN_WORDS) for _ in range(words or rng.randint(1, 5)))
+
+
+def synthetic_invoice(rng: random.Random, lines: int, layout: str = None,
+                      number_style: str = None) -> Tuple[str, dict]:
+    """
+    An invoice with about `lines` lines of line items (continuation lines
+    included) and the values the parser is expected to extract from it.
+
+    Layouts: 'table' has a section header and column header row, 'numbered'
+    and 'dated' prefix each item with a number or a short date, 'plain' has
+    neither and relies on the parser's fallback. Returns (text, expected),
+    where expected has 'invoice_number', 'invoice_date' and 'items'.
+    """
+    layout = layout or rng.choice(LAYOUTS)
+    number_style = number_style or rng.choice(NUMBER_STYLES)
+    number = str(rng.randint(1, 999999))
+    invoice_date = _header_date(rng)
+
+    text = [rng.choice(VENDORS), '12 Main St.']
+    if number_style == 'labelled':
+        text.append(f'Invoice #: {number}')
+    elif number_style == 'hash':
+        text.append(f'Invoice # {number}')
+    else:
+        text += ['INVOICE', f'Ref # {number}']
+    text.append(f'Date: {invoice_date}')
+    if layout == 'table':
+        text += [rng.choice(['Services', 'Line Items', 'Charges']),
+                 rng.choice(['Date Description Qty Rate Amount', 'Item Quantity Price Amount',
+                             'Description Rate Total'])]
+
+    items = []
+    n = 0
+    while n < max(lines, 1):
+        qty = rng.choice([1, 2, 3, 5, 10, 12.5, 0.5])
+        rate = round(rng.uniform(1, 5000), 2)
+        total = round(qty * rate, 2)
+        description = _clean_description(rng)
+        fields = [description]
+        with_qty = rng.random() < 0.7
+        if with_qty:
+            fields.append(str(qty))
+        rate_text, total_text = _money(rng, rate), _money(rng, total)
+        fields += [rate_text, total_text]
+        if layout == 'numbered':
+            fields.insert(0, rng.choice([f'{len(items) + 1}.', f'{len(items) + 1})']))
+        elif layout == 'dated' or (layout == 'table' and rng.random() < 0.5):
+            fields.insert(0, f'{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.randint(19, 26)}')
+        text.append(' '.join(fields))
+        n += 1
+
+        parsed_rate = float(rate_text.replace('$', '').replace(',', ''))
+        parsed_total = float(total_text.replace('$', '').replace(',', ''))
+        item = {
+            'description': description,
+            'quantity': float(qty) if with_qty else (round(parsed_total / parsed_rate, 2) if parsed_rate != 0 else 1),
+            'amount': parsed_rate,
+            'total': parsed_total,
+        }
+        # Continuation lines carry on the description
+        while n < lines and rng.random() < 0.2:
+            continuation = _clean_description(rng)
+            text.append(continuation)
+            item['description'] += ' ' + continuation
+            n += 1
+        items.append(item)
+
+    text += [f'Subtotal: {_money(rng, sum(item["total"] for item in items))}',
+             'Payment Terms: Net 30']
+    expected = {'invoice_number': number, 'invoice_date': invoice_date, 'items': items}
+    return '\n'.join(text) + '\n', expected
+
+
+def synthetic_corpus(seed: int = 11, sizes=(1, 10, 100, 1000, 5000),
+                     per_size: int = 4) -> List[Tuple[str, str, dict]]:
+    """(name, text, expected) for `per_size` invoices of each size, cycling through the layouts."""
+    rng = random.Random(seed)
+    corpus = []
+    for size in sizes:
+        for i in range(per_size):
+            layout = LAYOUTS[i % len(LAYOUTS)]
+            text, expected = synthetic_invoice(rng, size, layout=layout)
+            corpus.append((f'{layout}-{size}-{i}', text, expected))
+    return corpus
+
+
+def invoice_pdf(text: str, path: str, lines_per_page: int = PDF_LINES_PER_PAGE) -> int:
+    """
+    Write `text` as a PDF with a text layer, one line of text per line, and
+    return the number of pages. Uses the built-in Helvetica font, so no
+    font files or PDF libraries are needed.
+    """
+    lines = text.rstrip('\n').split('\n')
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+    streams = []
+    for page_lines in pages:
+        ops = ['BT /F1 10 Tf 40 780 Td 12 TL']
+        for line in page_lines:
+            ops.append(f'({_pdf_escape(line)}) Tj T*')
+        ops.append('ET')
+        streams.append('\n'.join(ops))
+    _write_pdf(streams, path)
+    return len(pages)
+
+
+# A 12-megapixel phone camera frame, portrait
+PHOTO_SIZE = (3024, 4032)
+
+
+def invoice_photo(rng: random.Random, text: str, size: Tuple[int, int] = PHOTO_SIZE,
+                  quality: int = 92) -> Tuple[bytes, float]:
+    """
+    A phone photo of the first page of `text` printed out: the page, slightly
+    rotated, on a darker desk, with a warm tint and sensor noise, as a colour
+    JPEG. Returns (JPEG bytes, the rotation in degrees).
+    """
+    width, height = size
+    page_width, page_height = int(width * 0.8), int(width * 0.8 * 11 / 8.5)
+    page = np.full((page_height, page_width), 255, np.uint8)
+    line_height = page_height // 66
+    for i, line in enumerate(text.split('\n')[:60]):
+        cv2.putText(page, line, (line_height * 2, line_height * (i + 3)), cv2.FONT_HERSHEY_SIMPLEX,
+                    line_height / 40, 0, max(1, line_height // 20), cv2.LINE_AA)
+
+    angle = rng.uniform(-4, 4)
+    frame = np.full((height, width), 255, np.uint8)
+    mask = np.zeros((height, width), np.uint8)
+    matrix = cv2.getRotationMatrix2D((page_width / 2, page_height / 2), angle, 1.0)
+    matrix[0, 2] += (width - page_width) / 2
+    matrix[1, 2] += (height - page_height) / 2
+    frame = cv2.warpAffine(page, matrix, (width, height), borderValue=255)
+    mask = cv2.warpAffine(np.full_like(page, 255), matrix, (width, height))
+    generator = np.random.default_rng(rng.randrange(2 ** 32))
+    desk = generator.normal(70, 12, (height, width)).clip(0, 255).astype(np.uint8)
+    gray = np.where(mask > 127, frame, desk)
+    noisy = (gray.astype(np.int16) + generator.normal(0, 6, gray.shape).astype(np.int16)).clip(0, 255)
+    # Warm indoor light: less blue than red
+    colour = np.stack([noisy * 0.85, noisy * 0.95, noisy], axis=-1).astype(np.uint8)
+    ok, encoded = cv2.imencode('.jpg', colour, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes(), angle
+
+
+# Helvetica advance widths (per 1,000 units of font size) of the characters
+# in amounts, for right-aligning them
+NUMBER_WIDTHS = dict.fromkeys('0123456789$', 556)
+NUMBER_WIDTHS.update({',': 278, '.': 278})
+TABLE_FONT_SIZE = 9
+# Right edges of the Qty, Rate and Amount columns; descriptions start at 40
+TABLE_COLUMNS = (380, 470, 560)
+
+
+def table_invoice_pdf(rng: random.Random, items: int, path: str,
+                      rows_per_page: int = PDF_LINES_PER_PAGE) -> Tuple[int, dict]:
+    """
+    Write an invoice whose line items are a real table: description, Qty,
+    Rate and Amount at fixed positions with the numbers right-aligned, and
+    the column header repeated on every page, like a long statement.
+    Descriptions contain numbers of their own ('Model 3000 bracket') and
+    sometimes wrap onto a second line. Returns (pages, expected) like
+    synthetic_invoice().
+    """
+    number = str(rng.randint(1, 999999))
+    invoice_date = _header_date(rng)
+    header = [(40, 'Description'), (TABLE_COLUMNS[0] - 15, 'Qty'), (TABLE_COLUMNS[1] - 18, 'Rate'),
+              (TABLE_COLUMNS[2] - 33, 'Amount')]
+    rows = [[(40, rng.choice(VENDORS))], [(40, f'Invoice #: {number}')], [(40, f'Date: {invoice_date}')],
+            [(40, 'Services')], header]
+    expected_items = []
+    for _ in range(items):
+        words = _clean_description(rng).split()
+        # Numbers inside the description, which only the columns tell apart
+        # from the amounts
+        words.insert(rng.randrange(len(words) + 1), rng.choice(['3000', '2x4', '12', '4.5', '220V']))
+        description = ' '.join(words)
+        qty = rng.choice([1, 2, 3, 5, 10, 12.5, 0.5])
+        rate = round(rng.uniform(1, 5000), 2)
+        total = round(qty * rate, 2)
+        rate_text, total_text = _money(rng, rate), _money(rng, total)
+        rows.append([(40, description), _right(TABLE_COLUMNS[0], str(qty)),
+                     _right(TABLE_COLUMNS[1], rate_text), _right(TABLE_COLUMNS[2], total_text)])
+        if rng.random() < 0.2:
+            continuation = _clean_description(rng)
+            rows.append([(40, continuation)])
+            description += ' ' + continuation
+        expected_items.append({
+            'description': description,
+            'quantity': float(qty),
+            'amount': float(rate_text.replace('$', '').replace(',', '')),
+            'total': float(total_text.replace('$', '').replace(',', '')),
+        })
+    subtotal = _money(rng, sum(item['total'] for item in expected_items))
+    rows += [[(TABLE_COLUMNS[1] - 60, 'Subtotal:'), _right(TABLE_COLUMNS[2], subtotal)],
+             [(40, 'Payment Terms: Net 30')]]
+
+    streams = []
+    while rows:
+        page_rows, rows = rows[:rows_per_page], rows[rows_per_page:]
+        if streams:
+            page_rows = [header] + page_rows
+        ops = []
+        for i, cells in enumerate(page_rows):
+            y = 780 - 12 * i
+            for x, text in cells:
+                ops.append(f'BT /F1 {TABLE_FONT_SIZE} Tf {x:.2f} {y} Td ({_pdf_escape(text)}) Tj ET')
+        streams.append('\n'.join(ops))
+    _write_pdf(streams, path)
+    return len(streams), {'invoice_number': number, 'invoice_date': invoice_date, 'items': expected_items}
+
+
+def _right(right_edge: float, text: str) -> Tuple[float, str]:
+    """Where to start `text` (digits, $ , .) so it ends at `right_edge`."""
+    width = sum(NUMBER_WIDTHS[c] for c in text) * TABLE_FONT_SIZE / 1000
+    return right_edge - width, text
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def _write_pdf(streams: List[str], path: str) -> None:
+    """Write a PDF with one page per content stream, using the built-in Helvetica as /F1."""
+    objects = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    font = add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    pages_id = add(b'')
+    kids = []
+    for page_stream in streams:
+        stream = page_stream.encode('latin-1')
+        content = add(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+        kids.append(add(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Contents %d 0 R '
+            b'/Resources << /Font << /F1 %d 0 R >> >> >>' % (pages_id, content, font)
+        ))
+    objects[pages_id - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % kid for kid in kids), len(kids))
+    catalog = add(b'<< /Type /Catalog /Pages %d 0 R >>' % pages_id)
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+        len(objects) + 1, catalog, xref)
+    with open(path, 'wb') as f:
+        f.write(out)
@@ -0,0 +1,24 @@
+"""
+The app with its Google clients pointed at benchmarks.fake_google, for load tests:
+
+    FAKE_GOOGLE_URL=http://127.0.0.1:8765 gunicorn benchmarks.fake_app:app
+
+Clients are built by the registry as usual (one Vision client per worker,
+one Sheets service per thread), just against the fake server, so requests
+go over real sockets.
+"""
+import os
+
+from benchmarks import fake_google
+from clients import registry
+
+FAKE_GOOGLE_URL = os.environ.get('FAKE_GOOGLE_URL', 'http://127.0.0.1:8765')
+
+registry.set_factory('vision', lambda: fake_google.vision_client(FAKE_GOOGLE_URL))
+registry.set_factory('sheets', lambda: fake_google.sheets_service(FAKE_GOOGLE_URL))
+
+from app import app  # noqa: E402
+
+# The load test logs in with the app's password; a fixed key lets any
+# worker read the session cookie another worker set
+app.secret_key = os.environ.get('FAKE_APP_SECRET', 'load-test')
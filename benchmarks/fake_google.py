@@ -0,0 +1,156 @@
+"""
+A local HTTP server standing in for the Vision and Sheets REST APIs, for
+load tests that should exercise real network I/O without touching Google.
+
+    python -m benchmarks.fake_google --port 8765 --latency 0.2
+
+Vision's images:annotate returns the text embedded by fakes.fake_image();
+Sheets values get/update/append keep the header and count appended rows,
+and batchUpdate (header styling) is accepted and ignored.
+Every call waits `--latency` seconds first, like a slow upstream. GET /stats
+reports call and row counts and the most calls that were in progress at once;
+`/stats?reset=1` starts that peak over.
+
+`vision_client(url)` and `sheets_service(url)` build real clients that talk
+to it.
+"""
+import argparse
+import base64
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+from benchmarks.fakes import fake_image_text
+
+SHEETS_VALUES = re.compile(r'^/v4/spreadsheets/([^/]+)/values/([^:?]+)(:append)?')
+
+
+class _State:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.header = None
+        self.calls = {'vision': 0, 'images': 0, 'sheets': 0}
+        self.rows = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def wait(self):
+        """Sleep for the configured latency, tracking how many calls overlap."""
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _reply(self, payload, status=200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            with self.state.lock:
+                stats = dict(self.state.calls, rows=self.state.rows,
+                             peak_in_flight=self.state.peak_in_flight)
+                if 'reset=1' in self.path:
+                    self.state.peak_in_flight = self.state.in_flight
+            return self._reply(stats)
+        if not SHEETS_VALUES.match(self.path):
+            return self._reply({'error': {'code': 404, 'message': 'Not found'}}, 404)
+        self._sheets_call()
+        with self.state.lock:
+            header = self.state.header
+        self._reply({'values': [header]} if header else {})
+
+    def do_PUT(self):
+        body = self._body()
+        self._sheets_call()
+        with self.state.lock:
+            self.state.header = body['values'][0]
+        self._reply({'updatedRows': 1})
+
+    def do_POST(self):
+        body = self._body()
+        if self.path.startswith('/v1/images:annotate'):
+            self.state.wait()
+            with self.state.lock:
+                self.state.calls['vision'] += 1
+                self.state.calls['images'] += len(body['requests'])
+            return self._reply({'responses': [
+                {'fullTextAnnotation': {'text': fake_image_text(base64.b64decode(request['image']['content']))}}
+                for request in body['requests']
+            ]})
+        if re.match(r'^/v4/spreadsheets/[^/]+:batchUpdate', self.path):
+            self._sheets_call()
+            return self._reply({'replies': []})
+        match = SHEETS_VALUES.match(self.path)
+        if not match or not match.group(3):
+            return self._reply({'error': {'code': 404, 'message': 'Not found'}}, 404)
+        self._sheets_call()
+        with self.state.lock:
+            self.state.rows += len(body['values'])
+        self._reply({'updates': {'updatedRange': unquote(match.group(2)),
+                                 'updatedRows': len(body['values'])}})
+
+    def _sheets_call(self):
+        self.state.wait()
+        with self.state.lock:
+            self.state.calls['sheets'] += 1
+
+
+def make_server(port: int = 0, latency: float = 0.0) -> ThreadingHTTPServer:
+    """A server on 127.0.0.1:`port` (0 picks a free one); call serve_forever() on it."""
+    handler = type('Handler', (_Handler,), {'state': _State(latency)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def vision_client(url: str):
+    """A Vision client using the REST transport against the fake server at `url`."""
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import vision
+    return vision.ImageAnnotatorClient(credentials=AnonymousCredentials(), transport='rest',
+                                       client_options={'api_endpoint': url})
+
+
+def sheets_service(url: str):
+    """A Sheets service against the fake server at `url`."""
+    import httplib2
+    from googleapiclient.discovery import build
+    return build('sheets', 'v4', http=httplib2.Http(), static_discovery=True,
+                 client_options={'api_endpoint': url})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds per call (default 0.2)')
+    args = parser.parse_args(argv)
+    server = make_server(args.port, args.latency)
+    print(f'Fake Google APIs on http://127.0.0.1:{server.server_address[1]}', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Local stand-ins for the Google Vision and Sheets clients, for benchmarks
+and tests that must not touch the network.
+
+Install them with `clients.registry.override('vision', FakeVision())` and
+`clients.registry.override('sheets', FakeSheets())`.
+"""
+import threading
+import time
+import types
+from typing import List
+
+# Fake "images" are the invoice text behind this prefix; FakeVision reads it back
+FAKE_IMAGE_MAGIC = b'\x89PNG\r\n\x1a\nFAKE-OCR\n'
+
+
+def fake_image(text: str) -> bytes:
+    """Bytes that FakeVision recognizes as `text`."""
+    return FAKE_IMAGE_MAGIC + text.encode('utf-8')
+
+
+def fake_image_text(content: bytes) -> str:
+    """The text behind a fake_image(), or '' for anything else."""
+    if content.startswith(FAKE_IMAGE_MAGIC):
+        return content[len(FAKE_IMAGE_MAGIC):].decode('utf-8')
+    return ''
+
+
+class FakeVision:
+    """
+    Answers batch_annotate_images (and document_text_detection) with the
+    text embedded by fake_image(), after `latency` seconds per call, plus
+    the time to send the images over an uplink of `bandwidth` bytes per
+    second if one is given. The size of each request's images is kept in
+    `request_bytes`.
+    """
+
+    def __init__(self, latency: float = 0.0, bandwidth: float = 0.0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.calls = 0
+        self.images = 0
+        self.request_bytes = []
+        self._lock = threading.Lock()
+
+    def _response(self, content: bytes):
+        return types.SimpleNamespace(
+            error=types.SimpleNamespace(message='', code=0),
+            full_text_annotation=types.SimpleNamespace(text=fake_image_text(content)),
+        )
+
+    def _count(self, images: List[bytes]):
+        size = sum(len(content) for content in images)
+        with self._lock:
+            self.calls += 1
+            self.images += len(images)
+            self.request_bytes.append(size)
+        delay = self.latency + (size / self.bandwidth if self.bandwidth else 0)
+        if delay:
+            time.sleep(delay)
+
+    def batch_annotate_images(self, requests: List):
+        self._count([r.image.content for r in requests])
+        return types.SimpleNamespace(responses=[self._response(r.image.content) for r in requests])
+
+    def document_text_detection(self, image):
+        self._count([image.content])
+        return self._response(image.content)
+
+
+class _Request:
+    def __init__(self, sheets, method: str, kwargs: dict):
+        self._sheets = sheets
+        self._method = method
+        self._kwargs = kwargs
+
+    def execute(self):
+        return self._sheets._execute(self._method, self._kwargs)
+
+
+class FakeSheets:
+    """
+    Enough of the Sheets v4 service for the app: values().get/update/append
+    and batchUpdate. Appended rows are kept in `rows` and read back by a get
+    of rows below the header; every call is logged in `calls` as (method,
+    kwargs) and takes `latency` seconds.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = []
+        self.header = None
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, **kwargs):
+        return _Request(self, 'get', kwargs)
+
+    def update(self, **kwargs):
+        return _Request(self, 'update', kwargs)
+
+    def append(self, **kwargs):
+        return _Request(self, 'append', kwargs)
+
+    def batchUpdate(self, **kwargs):
+        return _Request(self, 'batchUpdate', kwargs)
+
+    def _execute(self, method: str, kwargs: dict):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls.append((method, kwargs))
+            if method == 'get':
+                start, end = [int(cell.lstrip('ABCDEFG')) for cell in kwargs['range'].split('!')[1].split(':')]
+                if start == 1:
+                    return {'values': [self.header]} if self.header else {}
+                values = self.rows[start - 2:end - 1]
+                return {'values': values} if values else {}
+            if method == 'update':
+                self.header = kwargs['body']['values'][0]
+            elif method == 'append':
+                self.rows.extend(kwargs['body']['values'])
+        return {}
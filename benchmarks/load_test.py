@@ -0,0 +1,248 @@
+"""
+Load test gunicorn's sync and gevent workers against local fake Google APIs.
+
+    python -m benchmarks.load_test                       # both worker classes
+    python -m benchmarks.load_test --worker-class gevent --concurrency 300
+
+Starts benchmarks.fake_google (every Vision and Sheets call takes
+--latency seconds), then for each worker class starts gunicorn with
+benchmarks.fake_app and has --concurrency clients upload invoices (small
+PDFs and images) and poll until their jobs finish, backing off on 503.
+
+Reports throughput, upload-to-done latency, how many Google calls were in
+progress at once at the fake server (how many uploads were actually waiting
+on the network together), and the peak total RSS of the gunicorn workers.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import Dict, List
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from benchmarks.bench_pipeline import percentile
+from benchmarks.corpus import invoice_pdf, synthetic_invoice
+from benchmarks.fakes import fake_image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER_CLASSES = ['sync', 'gevent']
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f'{url} did not come up')
+            time.sleep(0.2)
+
+
+def worker_rss_mb(master_pid: int) -> float:
+    """Total resident memory of the gunicorn master's child processes."""
+    total = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            continue
+        if int(status.get('PPid', '0')) == master_pid:
+            total += int(status.get('VmRSS', '0 kB').split()[0])
+    return total / 1024
+
+
+def make_documents(count: int, seed: int = 15) -> List[tuple]:
+    """(filename, bytes) uploads: half one-page PDFs, half fake images."""
+    rng = random.Random(seed)
+    documents = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(count):
+            text, _ = synthetic_invoice(rng, rng.choice([5, 20, 40]))
+            if i % 2:
+                documents.append((f'invoice{i}.png', fake_image(text)))
+                continue
+            path = os.path.join(tmp, 'invoice.pdf')
+            invoice_pdf(text, path)
+            with open(path, 'rb') as f:
+                documents.append((f'invoice{i}.pdf', f.read()))
+    return documents
+
+
+def run_clients(base_url: str, documents: List[tuple], concurrency: int, poll: float) -> Dict:
+    """Upload every document with `concurrency` clients; wait for each job to finish."""
+    login = requests.post(f'{base_url}/login', data={'password': '43north'}, allow_redirects=False)
+    cookies = login.cookies
+    pending = list(documents)
+    lock = threading.Lock()
+    latencies = []
+    counts = {'ok': 0, 'failed': 0, 'rejected': 0}
+    errors = {}
+
+    def client():
+        session = requests.Session()
+        session.cookies.update(cookies)
+        # Like a browser, retry a status poll whose kept-alive connection the
+        # server closed at the same moment
+        session.mount('http://', HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.1)))
+        while True:
+            with lock:
+                if not pending:
+                    return
+                filename, content = pending.pop()
+            try:
+                upload(session, filename, content)
+            except Exception as e:
+                with lock:
+                    counts['failed'] += 1
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+
+    def upload(session, filename, content):
+        start = time.perf_counter()
+        while True:
+            response = session.post(f'{base_url}/upload', files={'file': (filename, content)})
+            if response.status_code != 503:
+                break
+            with lock:
+                counts['rejected'] += 1
+            time.sleep(0.5 + random.random())
+        if response.status_code != 202:
+            raise RuntimeError(f'HTTP {response.status_code}')
+        status_url = base_url + response.json()['status_url']
+        while True:
+            time.sleep(poll)
+            job = session.get(status_url).json()
+            if job['state'] in ('done', 'failed'):
+                break
+        with lock:
+            counts['ok' if job['state'] == 'done' else 'failed'] += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f'Client errors: {errors}', file=sys.stderr)
+    return dict(counts,
+                uploads_per_s=round(len(documents) / elapsed, 1),
+                p50_ms=round(percentile(latencies, 50)),
+                p95_ms=round(percentile(latencies, 95)))
+
+
+def run_mode(worker_class: str, args, fake_url: str, documents: List[tuple]) -> Dict:
+    port = free_port()
+    data_dir = tempfile.mkdtemp(prefix='load_test_')
+    env = dict(
+        os.environ,
+        GUNICORN_WORKER_CLASS=worker_class,
+        FAKE_GOOGLE_URL=fake_url,
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(data_dir, 'metrics'),
+        JOBS_DB=os.path.join(data_dir, 'jobs.db'),
+        SHEETS_SPOOL=os.path.join(data_dir, 'spool.db'),
+        INVOICE_CACHE='0',
+        LAYOUT_INDEX_PATH=os.path.join(data_dir, 'layouts.db'),
+        LEDGER_PATH=os.path.join(data_dir, 'ledger.db'),
+        # The warm-up uploads are sent again in the measured run
+        LEDGER_DUPLICATES='flag',
+        TRACE_LOG='0',
+        LOG_LEVEL='WARNING',
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--workers', str(args.workers),
+         '--bind', f'127.0.0.1:{port}', '--access-logfile', '/dev/null', 'benchmarks.fake_app:app'],
+        cwd=REPO_ROOT, env=env
+    )
+    peak_rss = [0.0]
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(0.5):
+            peak_rss[0] = max(peak_rss[0], worker_rss_mb(server.pid))
+
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        wait_for(f'{base_url}/login')
+        # One upload per worker first, so client construction isn't timed
+        run_clients(base_url, documents[:args.workers * 2], args.workers * 2, args.poll)
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        result = run_clients(base_url, documents, args.concurrency, args.poll)
+        done.set()
+        sampler.join()
+        result['peak_rss_mb'] = round(peak_rss[0], 1)
+        return result
+    finally:
+        done.set()
+        server.terminate()
+        server.wait()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--worker-class', action='append', choices=WORKER_CLASSES,
+                        help='run only this worker class (repeatable)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers (default 2)')
+    parser.add_argument('--concurrency', type=int, default=200, help='concurrent clients (default 200)')
+    parser.add_argument('--uploads', type=int, default=400, help='uploads per worker class (default 400)')
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='seconds per fake Vision/Sheets call (default 0.2)')
+    parser.add_argument('--poll', type=float, default=0.5, help='seconds between status polls')
+    args = parser.parse_args(argv)
+
+    fake_port = free_port()
+    fake = subprocess.Popen([sys.executable, '-m', 'benchmarks.fake_google', '--port', str(fake_port),
+                             '--latency', str(args.latency)], cwd=REPO_ROOT, stdout=subprocess.DEVNULL)
+    fake_url = f'http://127.0.0.1:{fake_port}'
+    results = {}
+    try:
+        wait_for(f'{fake_url}/stats')
+        documents = make_documents(args.uploads)
+        for worker_class in args.worker_class or WORKER_CLASSES:
+            before = json.loads(urllib.request.urlopen(f'{fake_url}/stats?reset=1').read())
+            results[worker_class] = run_mode(worker_class, args, fake_url, documents)
+            after = json.loads(urllib.request.urlopen(f'{fake_url}/stats').read())
+            results[worker_class]['google_calls'] = (after['vision'] + after['sheets']
+                                                     - before['vision'] - before['sheets'])
+            results[worker_class]['peak_google_calls'] = after['peak_in_flight']
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    columns = ['ok', 'failed', 'rejected', 'uploads_per_s', 'p50_ms', 'p95_ms',
+               'google_calls', 'peak_google_calls', 'peak_rss_mb']
+    print(f"\n{args.uploads} uploads, {args.concurrency} clients, {args.workers} workers, "
+          f"{args.latency}s per Google call")
+    print(f"{'worker':<8}" + ''.join(f'{column:>19}' for column in columns))
+    for worker_class, result in results.items():
+        print(f'{worker_class:<8}' + ''.join(f'{result[column]:>19}' for column in columns))
+    return 0 if all(result['failed'] == 0 for result in results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
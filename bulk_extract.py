@@ -0,0 +1,406 @@
+"""
+Extract line items from a directory or archive of invoices to CSV, JSONL or Parquet.
+
+    python bulk_extract.py invoices/ -o items.csv
+    python bulk_extract.py archive.zip -o items.parquet --workers 8
+
+For backfills: no login, and nothing is written to Google Sheets. Files are
+spread over a process pool, PDFs one per task and images in groups the size
+of one Vision batch request. Rows are written as each file finishes, with
+the same columns as the sheet.
+
+Progress is checkpointed in a manifest next to the output
+(`items.csv.manifest.jsonl`), one line per finished file. Running the same
+command again after an interruption skips the files already written, and
+drops any rows written after the last checkpoint so none are duplicated.
+Files that failed are retried. `--restart` starts over.
+"""
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from batch import is_invoice_file
+from invoice_processor import InvoiceProcessor, process_invoice_file
+from ocr import VISION_BATCH_SIZE
+from sheets import SHEET_HEADERS, sheet_row
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ['csv', 'jsonl', 'parquet']
+# Parquet can't be appended to, so rows are written as part files of this many rows
+PARQUET_PART_ROWS = 50000
+# Tasks queued per worker; bounds how many archive members are held in memory
+TASKS_PER_WORKER = 2
+
+
+# -- Input ---------------------------------------------------------------------
+
+def list_inputs(path: str) -> List[Tuple[str, str]]:
+    """
+    The invoice files under `path` as (key, member) pairs, in a stable order.
+    The key identifies the file in the manifest: its path relative to a
+    directory, or its name inside a ZIP or tar archive.
+    """
+    if os.path.isdir(path):
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                if is_invoice_file(name) and not name.startswith('.'):
+                    full = os.path.join(root, name)
+                    files.append((os.path.relpath(full, path), full))
+        return files
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as archive:
+            names = [member.name for member in archive.getmembers() if member.isfile()]
+    else:
+        raise ValueError(f'{path} is not a directory, ZIP or tar archive')
+    return [(os.path.normpath(name), name) for name in names
+            if is_invoice_file(name) and '__MACOSX' not in name
+            and not os.path.basename(name).startswith('.')]
+
+
+class InputReader:
+    """Loads files for the workers: paths are passed as is, archive members as bytes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._archive = None
+        if os.path.isdir(path):
+            return
+        if zipfile.is_zipfile(path):
+            self._archive = zipfile.ZipFile(path)
+        else:
+            self._archive = tarfile.open(path)
+
+    def load(self, member: str):
+        if self._archive is None:
+            return member
+        if isinstance(self._archive, zipfile.ZipFile):
+            return self._archive.read(member)
+        return self._archive.extractfile(member).read()
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+
+
+def extract_files(files: List[Tuple[str, object]]) -> List[Dict]:
+    """
+    Extract one PDF or a group of images in a worker process. Returns an
+    outcome per file with its rows or its error.
+    Module-level so it can be sent to the process pool.
+    """
+    if len(files) == 1 and files[0][0].lower().endswith('.pdf'):
+        key, source = files[0]
+        try:
+            results = [process_invoice_file(source, key)]
+        except Exception as e:
+            results = [e]
+    else:
+        results = InvoiceProcessor().process_images([source for _, source in files])
+
+    outcomes = []
+    for (key, _), result in zip(files, results):
+        if isinstance(result, Exception):
+            outcomes.append({'file': key, 'status': 'error', 'error': str(result), 'rows': []})
+        else:
+            items, _ = result
+            outcomes.append({'file': key, 'status': 'ok', 'error': None,
+                             'rows': [sheet_row(item) for item in items]})
+    return outcomes
+
+
+def tasks(pending: List[Tuple[str, str]]) -> Iterator[List[Tuple[str, str]]]:
+    """Group the files into tasks: each PDF alone, images VISION_BATCH_SIZE at a time."""
+    images = []
+    for key, member in pending:
+        if key.lower().endswith('.pdf'):
+            yield [(key, member)]
+            continue
+        images.append((key, member))
+        if len(images) == VISION_BATCH_SIZE:
+            yield images
+            images = []
+    if images:
+        yield images
+
+
+# -- Output --------------------------------------------------------------------
+
+class RowWriter:
+    """
+    Appends rows to the output. `commit()` makes everything written so far
+    durable and returns a position the output can later be truncated back
+    to with `resume()`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def resume(self, position) -> None:
+        raise NotImplementedError
+
+    def write(self, rows: List[List]) -> None:
+        raise NotImplementedError
+
+    def commit_due(self) -> bool:
+        return True
+
+    def commit(self):
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class CsvWriter(RowWriter):
+    def resume(self, position: Optional[int]) -> None:
+        exists = position is not None and os.path.exists(self.path)
+        self._file = open(self.path, 'r+' if exists else 'w', newline='', encoding='utf-8')
+        if exists:
+            self._file.seek(position)
+            self._file.truncate()
+        else:
+            csv.writer(self._file).writerow(SHEET_HEADERS)
+        self._writer = csv.writer(self._file)
+
+    def write(self, rows: List[List]) -> None:
+        self._writer.writerows(rows)
+
+    def commit(self) -> int:
+        self._file.flush()
+        return self._file.tell()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class JsonlWriter(CsvWriter):
+    def resume(self, position: Optional[int]) -> None:
+        exists = position is not None and os.path.exists(self.path)
+        self._file = open(self.path, 'r+' if exists else 'w', encoding='utf-8')
+        if exists:
+            self._file.seek(position)
+            self._file.truncate()
+
+    def write(self, rows: List[List]) -> None:
+        for row in rows:
+            self._file.write(json.dumps(dict(zip(SHEET_HEADERS, row))) + '\n')
+
+
+class ParquetWriter(RowWriter):
+    """
+    A directory of part files, which pyarrow and most tools read as one
+    dataset. Each part is written complete under a temporary name and then
+    renamed, so a part on disk is never half written.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError('Parquet output needs pyarrow: pip install pyarrow')
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        text, number = pyarrow.string(), pyarrow.float64()
+        self._schema = pyarrow.schema(list(zip(
+            SHEET_HEADERS, [text, text, text, number, number, number, text]
+        )))
+        self._rows = []
+
+    def resume(self, position: Optional[int]) -> None:
+        self._parts = position or 0
+        os.makedirs(self.path, exist_ok=True)
+        # Parts after the last checkpoint belong to files that will be redone
+        for name in os.listdir(self.path):
+            if name.startswith('part-') and (not name.endswith('.parquet')
+                                             or int(name[5:10]) >= self._parts):
+                os.remove(os.path.join(self.path, name))
+
+    def write(self, rows: List[List]) -> None:
+        self._rows.extend(rows)
+
+    def commit_due(self) -> bool:
+        return len(self._rows) >= PARQUET_PART_ROWS
+
+    def commit(self) -> int:
+        if self._rows:
+            columns = [list(column) for column in zip(*self._rows)]
+            table = self._pa.Table.from_arrays(
+                [self._pa.array(column, type=field.type) for column, field in zip(columns, self._schema)],
+                schema=self._schema
+            )
+            path = os.path.join(self.path, f'part-{self._parts:05d}.parquet')
+            self._pq.write_table(table, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            self._parts += 1
+            self._rows = []
+        return self._parts
+
+
+WRITERS = {'csv': CsvWriter, 'jsonl': JsonlWriter, 'parquet': ParquetWriter}
+
+
+class Manifest:
+    """
+    One JSON line per finished file, written after its rows are committed,
+    with the output position to resume from.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Tuple[Set[str], Optional[int]]:
+        """The files already written and the last committed output position."""
+        done = set()
+        position = None
+        if not os.path.exists(self.path):
+            return done, position
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by the interruption
+                    continue
+                position = entry['position']
+                if entry['status'] == 'ok':
+                    done.add(entry['file'])
+                else:
+                    done.discard(entry['file'])
+        return done, position
+
+    def open(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def record(self, outcomes: List[Dict], position) -> None:
+        for outcome in outcomes:
+            self._file.write(json.dumps({
+                'file': outcome['file'],
+                'status': outcome['status'],
+                'items': len(outcome['rows']),
+                'error': outcome['error'],
+                'position': position,
+            }) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# -- Driver --------------------------------------------------------------------
+
+def run(input_path: str, output: str, output_format: str, workers: int,
+        restart: bool = False) -> Dict:
+    """Extract every invoice under `input_path` that isn't in the manifest yet. Returns totals."""
+    manifest = Manifest(output + '.manifest.jsonl')
+    if restart and os.path.exists(manifest.path):
+        os.remove(manifest.path)
+    done, position = manifest.load()
+
+    files = list_inputs(input_path)
+    pending = [(key, member) for key, member in files if key not in done]
+    if done:
+        logger.info(f"Resuming: {len(files) - len(pending)} of {len(files)} files already extracted")
+
+    writer = WRITERS[output_format](output)
+    writer.resume(position)
+    manifest.open()
+    reader = InputReader(input_path)
+    totals = {'files': len(pending), 'ok': 0, 'failed': 0, 'items': 0}
+    uncommitted = []
+    next_report = 100
+    start = time.perf_counter()
+    # Spawn rather than fork, as everywhere else: gRPC and pdfminer state
+    # doesn't survive a fork
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        task_iter = tasks(pending)
+        in_flight = set()
+        while True:
+            # Keep a few tasks per worker queued, reading archive members lazily
+            while len(in_flight) < workers * TASKS_PER_WORKER:
+                group = next(task_iter, None)
+                if group is None:
+                    break
+                in_flight.add(pool.submit(extract_files, [(key, reader.load(member)) for key, member in group]))
+            if not in_flight:
+                break
+
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                for outcome in future.result():
+                    if outcome['status'] == 'ok':
+                        totals['ok'] += 1
+                        totals['items'] += len(outcome['rows'])
+                        writer.write(outcome['rows'])
+                    else:
+                        totals['failed'] += 1
+                        logger.error(f"Error processing {outcome['file']}: {outcome['error']}")
+                    uncommitted.append(outcome)
+            if writer.commit_due():
+                manifest.record(uncommitted, writer.commit())
+                uncommitted = []
+
+            finished_count = totals['ok'] + totals['failed']
+            if finished_count >= next_report:
+                rate = finished_count / (time.perf_counter() - start)
+                logger.info(f"{finished_count}/{totals['files']} files, {totals['items']} items ({rate:.1f} files/s)")
+                next_report = finished_count + 100
+        manifest.record(uncommitted, writer.commit())
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        writer.close()
+        manifest.close()
+        reader.close()
+    totals['seconds'] = round(time.perf_counter() - start, 1)
+    return totals
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('input', help='directory, ZIP or tar archive of PDF/PNG/JPEG invoices')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output file (a directory of part files for Parquet)')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='output format (default: from the output extension)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='worker processes (default: number of CPUs)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or fill the result cache")
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the manifest and extract everything again')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                        format='%(asctime)s %(levelname)s %(message)s')
+    output_format = args.format or os.path.splitext(args.output)[1].lstrip('.').lower()
+    if output_format not in FORMATS:
+        parser.error(f"can't tell the format from '{args.output}'; pass --format")
+    if args.no_cache:
+        # Read by the worker processes when they start
+        os.environ['INVOICE_CACHE'] = '0'
+
+    totals = run(args.input, args.output, output_format, max(1, args.workers), restart=args.restart)
+    print(f"Extracted {totals['items']} items from {totals['ok']} files "
+          f"({totals['failed']} failed) in {totals['seconds']}s")
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
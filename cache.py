@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sources import Source
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.environ.get('INVOICE_CACHE_PATH', os.path.join('data', 'cache.db'))
+CACHE_MAX_BYTES = int(os.environ.get('INVOICE_CACHE_MAX_MB', 256)) * 1024 * 1024
+CACHE_MAX_AGE = int(os.environ.get('INVOICE_CACHE_MAX_AGE_DAYS', 30)) * 24 * 3600
+
+# Run eviction after this many writes rather than on every one
+EVICT_EVERY = 50
+
+
+def file_sha256(file_path: str) -> str:
+    """Hex SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_sha256(source: Source) -> str:
+    """Hex SHA-256 of a path's, bytes' or stream's contents. Streams keep their position."""
+    if isinstance(source, str):
+        return file_sha256(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    position = source.tell()
+    source.seek(0)
+    for chunk in iter(lambda: source.read(1024 * 1024), b''):
+        digest.update(chunk)
+    source.seek(position)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent cache of extraction work, keyed by the SHA-256 of the upload.
+
+    Extracted text and parsed line items are stored separately. Parsed results
+    are tagged with the parser version that produced them, so after a parser
+    change the cached text is re-parsed without repeating the OCR call. Line
+    items read from a PDF's table are stored with its text, as they don't
+    come from the text.
+    Entries are evicted least-recently-used first once the cache grows past
+    `max_bytes`, and when they haven't been used for `max_age` seconds.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = CACHE_MAX_BYTES,
+                 max_age: int = CACHE_MAX_AGE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._writes = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS texts (
+                    hash TEXT PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    -- Table line items as JSON ('null' if the PDF has none);
+                    -- NULL if they weren't read
+                    tables TEXT,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS texts_accessed_at ON texts (accessed_at);
+                CREATE TABLE IF NOT EXISTS results (
+                    hash TEXT NOT NULL,
+                    parser_version INTEGER NOT NULL,
+                    items TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (hash, parser_version)
+                );
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+            """)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(texts)')]
+            if 'tables' not in columns:
+                # Caches created before table items were stored
+                conn.execute('ALTER TABLE texts ADD COLUMN tables TEXT')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_results(self, key: str, parser_version: int) -> Optional[List[Dict]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT items FROM results WHERE hash = ? AND parser_version = ?',
+                (key, parser_version)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE texts SET accessed_at = ? WHERE hash = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def get_text(self, key: str) -> Optional[str]:
+        extraction = self.get_extraction(key)
+        return extraction[0] if extraction is not None else None
+
+    def get_extraction(self, key: str) -> Optional[Tuple[str, Optional[str]]]:
+        """The cached text and table line items (JSON, or None if they weren't read)."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT text, tables FROM texts WHERE hash = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE texts SET accessed_at = ? WHERE hash = ?', (time.time(), key))
+        return row[0], row[1]
+
+    def put_text(self, key: str, text: str, tables: Optional[str] = None) -> None:
+        """Cache extracted text and, for a PDF whose table was read, its table line items as JSON."""
+        now = time.time()
+        size = len(text.encode('utf-8')) + (len(tables) if tables is not None else 0)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO texts (hash, text, tables, size, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, text, tables, size, now, now)
+            )
+        self._maybe_evict()
+
+    def put_results(self, key: str, parser_version: int, items: List[Dict]) -> None:
+        data = json.dumps(items)
+        with self._connect() as conn:
+            # Results from older parser versions will never be read again
+            conn.execute('DELETE FROM results WHERE hash = ? AND parser_version != ?', (key, parser_version))
+            conn.execute(
+                'INSERT OR REPLACE INTO results (hash, parser_version, items, size, created_at) VALUES (?, ?, ?, ?, ?)',
+                (key, parser_version, data, len(data), time.time())
+            )
+        self._maybe_evict()
+
+    def record(self, status: str) -> None:
+        """Count a lookup outcome ('hit', 'text_hit' or 'miss')."""
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO counters (name, value) VALUES (?, 1) '
+                'ON CONFLICT(name) DO UPDATE SET value = value + 1',
+                (status,)
+            )
+
+    def stats(self) -> Dict:
+        with self._connect() as conn:
+            texts, text_bytes, oldest = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(created_at) FROM texts'
+            ).fetchone()
+            results, result_bytes = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results'
+            ).fetchone()
+            counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+        lookups = sum(counters.values())
+        return {
+            'texts': texts,
+            'results': results,
+            'bytes': text_bytes + result_bytes,
+            'max_bytes': self.max_bytes,
+            'max_age_seconds': self.max_age,
+            'oldest_entry_age_seconds': round(time.time() - oldest) if oldest else None,
+            'hits': counters.get('hit', 0),
+            'text_hits': counters.get('text_hit', 0),
+            'misses': counters.get('miss', 0),
+            'hit_rate': round((counters.get('hit', 0) + counters.get('text_hit', 0)) / lookups, 4) if lookups else None,
+        }
+
+    def purge(self) -> int:
+        """Delete every cached entry and reset the counters. Returns the number of texts removed."""
+        with self._connect() as conn:
+            removed = conn.execute('SELECT COUNT(*) FROM texts').fetchone()[0]
+            conn.execute('DELETE FROM texts')
+            conn.execute('DELETE FROM results')
+            conn.execute('DELETE FROM counters')
+        with self._connect() as conn:
+            conn.execute('VACUUM')
+        return removed
+
+    def evict(self) -> int:
+        """Drop expired entries, then least recently used ones until under max_bytes."""
+        cutoff = time.time() - self.max_age
+        victims = []
+        with self._connect() as conn:
+            total = conn.execute(
+                'SELECT (SELECT COALESCE(SUM(size), 0) FROM texts) + (SELECT COALESCE(SUM(size), 0) FROM results)'
+            ).fetchone()[0]
+            rows = conn.execute("""
+                SELECT t.hash, t.accessed_at,
+                       t.size + COALESCE((SELECT SUM(r.size) FROM results r WHERE r.hash = t.hash), 0)
+                FROM texts t ORDER BY t.accessed_at
+            """).fetchall()
+            for key, accessed_at, size in rows:
+                if accessed_at >= cutoff and total <= self.max_bytes:
+                    break
+                victims.append((key,))
+                total -= size
+            conn.executemany('DELETE FROM texts WHERE hash = ?', victims)
+            conn.executemany('DELETE FROM results WHERE hash = ?', victims)
+        if victims:
+            logger.info(f"Evicted {len(victims)} cache entries")
+        return len(victims)
+
+    def _maybe_evict(self):
+        with self._lock:
+            self._writes += 1
+            due = self._writes % EVICT_EVERY == 0
+        if due:
+            self.evict()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache() -> Optional[ResultCache]:
+    """The process-wide cache, or None if disabled with INVOICE_CACHE=0."""
+    global _default_cache
+    if os.environ.get('INVOICE_CACHE', '1') == '0':
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = ResultCache()
+    return _default_cache
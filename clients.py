@@ -0,0 +1,173 @@
+import threading
+import time
+import logging
+from typing import Callable, Dict, Optional
+
+from google.auth.transport.requests import Request
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+from google.cloud import vision
+
+logger = logging.getLogger(__name__)
+
+CREDENTIALS_FILE = 'credentials.json'
+VISION_SCOPES = ['https://www.googleapis.com/auth/cloud-vision']
+SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+# Errors that indicate a broken channel/connection rather than a bad request.
+# When one of these is raised the client is thrown away and rebuilt once.
+RECONNECT_ERRORS = (ConnectionError, TimeoutError)
+try:
+    from google.api_core import exceptions as api_exceptions
+    from google.auth import exceptions as auth_exceptions
+    RECONNECT_ERRORS += (
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.DeadlineExceeded,
+        auth_exceptions.TransportError,
+        auth_exceptions.RefreshError,
+    )
+except ImportError:
+    pass
+
+
+class ClientRegistry:
+    """
+    Process-wide cache of Google API clients.
+
+    Each gunicorn worker builds its clients once, on first use, instead of
+    re-reading credentials.json and rebuilding the Vision channel and Sheets
+    discovery document on every upload. The Vision client is shared by all
+    threads (gRPC channels are thread-safe); the Sheets service is built once
+    per thread because httplib2 connections are not.
+
+    Stub clients can be injected with `override()` for tests and benchmarks.
+    """
+
+    def __init__(self, credentials_file: str = CREDENTIALS_FILE,
+                 factories: Optional[Dict[str, Callable]] = None):
+        self.credentials_file = credentials_file
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._credentials = {}
+        self._vision = None
+        self._overrides = {}
+        self._factories = {
+            'vision': self._build_vision,
+            'sheets': self._build_sheets,
+        }
+        if factories:
+            self._factories.update(factories)
+        self.build_counts = {'vision': 0, 'sheets': 0}
+        self.build_seconds = {'vision': 0.0, 'sheets': 0.0}
+
+    def override(self, name: str, client) -> None:
+        """Use `client` for `name` instead of building a real one."""
+        with self._lock:
+            self._overrides[name] = client
+
+    def set_factory(self, name: str, factory: Callable) -> None:
+        """
+        Build `name` clients with `factory()` instead of from credentials.json,
+        e.g. against a local emulator. Unlike `override()`, each thread still
+        gets its own Sheets service.
+        """
+        with self._lock:
+            self._factories[name] = factory
+        self.reset(name)
+
+    def clear_overrides(self) -> None:
+        with self._lock:
+            self._overrides.clear()
+
+    def vision(self):
+        """Return the shared Vision ImageAnnotatorClient."""
+        if 'vision' in self._overrides:
+            return self._overrides['vision']
+        client = self._vision
+        if client is None:
+            with self._lock:
+                if self._vision is None:
+                    self._vision = self._timed_build('vision')
+                client = self._vision
+        return client
+
+    def sheets(self):
+        """Return the Sheets service for the calling thread."""
+        if 'sheets' in self._overrides:
+            return self._overrides['sheets']
+        service = getattr(self._local, 'sheets', None)
+        if service is None:
+            service = self._timed_build('sheets')
+            self._local.sheets = service
+        return service
+
+    def get(self, name: str):
+        return getattr(self, name)()
+
+    def reset(self, name: Optional[str] = None) -> None:
+        """Drop cached clients so the next call rebuilds them."""
+        with self._lock:
+            if name in (None, 'vision'):
+                self._vision = None
+            if name in (None, 'sheets'):
+                self._local = threading.local()
+            if name is None:
+                self._credentials.clear()
+
+    def call(self, name: str, fn: Callable):
+        """
+        Run `fn(client)`, rebuilding the client and retrying once if the
+        connection turns out to be broken.
+        """
+        try:
+            return fn(self.get(name))
+        except RECONNECT_ERRORS as e:
+            if name in self._overrides:
+                raise
+            logger.warning(f"{name} client failed ({e}); reconnecting")
+            self.reset(name)
+            return fn(self.get(name))
+
+    def credentials(self, scopes):
+        """Return service account credentials for `scopes`, refreshed if expired."""
+        key = tuple(scopes)
+        with self._lock:
+            creds = self._credentials.get(key)
+            if creds is None:
+                creds = service_account.Credentials.from_service_account_file(
+                    self.credentials_file,
+                    scopes=list(scopes)
+                )
+                self._credentials[key] = creds
+            if not creds.valid:
+                creds.refresh(Request())
+        return creds
+
+    def stats(self) -> Dict:
+        return {
+            'build_counts': dict(self.build_counts),
+            'build_seconds': {k: round(v, 4) for k, v in self.build_seconds.items()},
+            'overrides': sorted(self._overrides),
+        }
+
+    def _timed_build(self, name: str):
+        start = time.perf_counter()
+        client = self._factories[name]()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.build_counts[name] += 1
+            self.build_seconds[name] += elapsed
+        logger.info(f"Built {name} client in {elapsed:.3f}s")
+        return client
+
+    def _build_vision(self):
+        return vision.ImageAnnotatorClient(credentials=self.credentials(VISION_SCOPES))
+
+    def _build_sheets(self):
+        return build('sheets', 'v4', credentials=self.credentials(SHEETS_SCOPES),
+                     cache_discovery=False)
+
+
+# Shared by everything in this process. Gunicorn forks workers before any
+# request is handled, so each worker ends up with its own lazily built clients.
+registry = ClientRegistry()
@@ -1,6 +1,52 @@
+import os
+import shutil
+
 workers = 4
 bind = "0.0.0.0:10000"
 timeout = 120
-worker_class = "sync"
 accesslog = "-"
-errorlog = "-" 
\ No newline at end of file
+errorlog = "-"
+
+# "sync" handles one request per worker at a time. "gevent" runs requests
+# and upload jobs as greenlets, so uploads waiting on Vision and Sheets don't
+# hold a worker or a thread; CPU-bound extraction and parsing are handed to
+# real threads (see offload.py).
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+if worker_class == 'gevent':
+    # Concurrent connections per worker
+    worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+    # Seconds an idle connection is kept open; longer than the page's
+    # one-second status polls
+    keepalive = 5
+    # Job "threads" are greenlets here, so many more can wait on the APIs at once
+    os.environ.setdefault('JOB_WORKERS', '100')
+    os.environ.setdefault('JOB_QUEUE_SIZE', '1000')
+    os.environ.setdefault('VISION_MAX_IN_FLIGHT', '32')
+    # An open progress stream costs a greenlet, not a worker, and gevent
+    # workers keep heartbeating while it's open
+    os.environ.setdefault('STREAM_MAX_SECONDS', '600')
+
+# Workers write their metrics to files here so /metrics can add up every
+# worker. Set before the workers import the app (and prometheus_client).
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join('data', 'metrics'))
+
+
+def on_starting(server):
+    # Samples left by a previous run would be added to this one's
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def post_worker_init(worker):
+    if worker_class == 'gevent':
+        # The Vision client's gRPC channel blocks the whole worker unless
+        # grpc is told to cooperate with gevent
+        import grpc.experimental.gevent
+        grpc.experimental.gevent.init_gevent()
+
+
+def child_exit(server, worker):
+    # Drops the exited worker's live gauges (in-flight requests, queue depth);
+    # its counters and histograms are kept
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
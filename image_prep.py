@@ -0,0 +1,269 @@
+"""
+Shrinks uploaded images before they are sent to OCR.
+
+Invoices are often photographed with a phone: 12-megapixel colour JPEGs of
+several MB, far more than OCR needs, and uploaded as they are. Each image is
+decoded as grayscale and downscaled so its longest side is at most
+IMAGE_MAX_EDGE. In a photo, the desk around the page is cut away and
+blanked. The text is then straightened if it's slightly rotated, the blank
+margins are cropped, and the image is scaled down further if its text is
+larger than OCR needs, before it's re-encoded as JPEG. Small images, and
+anything that can't be decoded or wouldn't get smaller, are sent as uploaded.
+
+OpenCV releases the GIL, so the images of a batch are prepared in parallel
+on a thread pool.
+"""
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import metrics
+from ocr import OCR_JPEG_QUALITY, OCR_MAX_EDGE, OCR_THREADS
+from offload import run_cpu_bound
+from tracing import current_trace
+
+logger = logging.getLogger(__name__)
+
+# Prepare uploaded images before OCR; IMAGE_PREP=0 sends them as uploaded
+IMAGE_PREP = os.environ.get('IMAGE_PREP', '1') != '0'
+# Longest side of a prepared image, in pixels
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', OCR_MAX_EDGE))
+# Images with large text are scaled down until their characters are about
+# this tall, but never below IMAGE_MIN_EDGE
+TARGET_TEXT_HEIGHT = 32
+IMAGE_MIN_EDGE = 1200
+IMAGE_PREP_THREADS = int(os.environ.get('IMAGE_PREP_THREADS', OCR_THREADS))
+# Smaller images have little to gain and are sent as uploaded
+IMAGE_PREP_MIN_BYTES = int(os.environ.get('IMAGE_PREP_MIN_KB', 256)) * 1024
+
+# A bright region covering between these shares of a photo is the page
+MIN_PAGE_SHARE = 0.2
+MAX_PAGE_SHARE = 0.97
+# Width the image is reduced to when looking for the page and measuring skew
+SAMPLE_WIDTH = 600
+# Rows and columns with less ink than this share are blank margin
+MIN_INK_SHARE = 0.002
+# Pixels of margin kept around the printed area
+CROP_MARGIN = 16
+# Skew is looked for within +-MAX_SKEW_DEGREES; smaller corrections than
+# MIN_SKEW_DEGREES aren't worth resampling the image for
+MAX_SKEW_DEGREES = 10
+MIN_SKEW_DEGREES = 0.3
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _prep_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=IMAGE_PREP_THREADS, thread_name_prefix='image-prep')
+    return _pool
+
+
+def prepare_images(images: List[bytes]) -> List[bytes]:
+    """
+    Prepare encoded images for OCR, in parallel. Each entry is the prepared
+    image or, if it couldn't be made smaller, the image as it was.
+    """
+    before = sum(len(image) for image in images)
+    metrics.OCR_IMAGE_BYTES.labels('uploaded').inc(before)
+    if not any(len(image) >= IMAGE_PREP_MIN_BYTES for image in images):
+        metrics.OCR_IMAGE_BYTES.labels('sent').inc(before)
+        return images
+    trace = current_trace()
+    start = time.perf_counter()
+    if len(images) == 1:
+        prepared = [run_cpu_bound(prepare_image, images[0])]
+    else:
+        prepared = list(_prep_pool().map(lambda image: run_cpu_bound(prepare_image, image), images))
+    elapsed = time.perf_counter() - start
+
+    after = sum(len(image) for image in prepared)
+    metrics.IMAGE_PREP_SECONDS.observe(elapsed)
+    metrics.OCR_IMAGE_BYTES.labels('sent').inc(after)
+    trace.count('ocr_bytes', after)
+    logger.info(f"Prepared {len(images)} images for OCR in {elapsed * 1000:.0f} ms: "
+                f"{before:,} -> {after:,} bytes ({1 - after / before:.0%} smaller)")
+    return prepared
+
+
+def prepare_image(content: bytes, max_edge: Optional[int] = None) -> bytes:
+    """Downscale, crop, deskew and re-encode one image; the original if that doesn't shrink it."""
+    if len(content) < IMAGE_PREP_MIN_BYTES:
+        return content
+    max_edge = max_edge or IMAGE_MAX_EDGE
+    try:
+        image = cv2.imdecode(np.frombuffer(content, np.uint8), _decode_flags(content, max_edge))
+    except cv2.error:
+        image = None
+    if image is None:
+        # Not an image OpenCV reads; OCR reports anything wrong with it
+        return content
+    try:
+        image = _downscale(image, max_edge)
+        image = _isolate_page(image)
+        image = _deskew(image)
+        image = _crop(image)
+        image = _downscale_text(image)
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, OCR_JPEG_QUALITY])
+    except cv2.error as e:
+        logger.warning(f"Could not prepare image for OCR, sending it as uploaded: {e}")
+        return content
+    if not ok or len(encoded) >= len(content):
+        return content
+    return encoded.tobytes()
+
+
+def _decode_flags(content: bytes, max_edge: int) -> int:
+    """
+    Decode as grayscale and, for a JPEG at least twice as large as needed,
+    at a half, quarter or eighth of its size, which the JPEG decoder does
+    much faster than decoding it whole and resizing.
+    """
+    try:
+        with Image.open(io.BytesIO(content)) as header:
+            if header.format != 'JPEG':
+                return cv2.IMREAD_GRAYSCALE
+            longest = max(header.size)
+    except Exception:
+        return cv2.IMREAD_GRAYSCALE
+    for factor, flags in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                          (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+        if longest // factor >= max_edge:
+            return flags
+    return cv2.IMREAD_GRAYSCALE
+
+
+def _ink(image: np.ndarray) -> np.ndarray:
+    """Dark pixels (text, lines, background) as 1, paper as 0, by Otsu's threshold."""
+    _, ink = cv2.threshold(image, 0, 1, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    return ink
+
+
+def _resize(image: np.ndarray, scale: float) -> np.ndarray:
+    height, width = image.shape
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def _sample(image: np.ndarray) -> np.ndarray:
+    """`image` reduced to SAMPLE_WIDTH wide, for measurements that don't need every pixel."""
+    scale = SAMPLE_WIDTH / image.shape[1]
+    return _resize(image, scale) if scale < 1 else image
+
+
+def _downscale(image: np.ndarray, max_edge: int) -> np.ndarray:
+    longest = max(image.shape)
+    return _resize(image, max_edge / longest) if longest > max_edge else image
+
+
+def _isolate_page(image: np.ndarray) -> np.ndarray:
+    """
+    In a photo of a page on a darker background, crop to the page and make
+    everything around it white. Scans, where the page fills the image, are
+    left alone.
+    """
+    sample = cv2.GaussianBlur(_sample(image), (5, 5), 0)
+    _, bright = cv2.threshold(sample, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    # Close the gaps the text leaves so the page is one region
+    bright = cv2.morphologyEx(bright, cv2.MORPH_CLOSE, np.ones((15, 15), np.uint8))
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(bright, connectivity=4)
+    if count < 2:
+        return image
+    largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    share = stats[largest, cv2.CC_STAT_AREA] / sample.size
+    if not MIN_PAGE_SHARE <= share <= MAX_PAGE_SHARE:
+        return image
+    height, width = image.shape
+    page = cv2.resize((labels == largest).astype(np.uint8), (width, height),
+                      interpolation=cv2.INTER_NEAREST)
+    # Shrink the mask a little so the page's shadowed edge goes too
+    page = cv2.erode(page, np.ones((5, 5), np.uint8))
+    x, y, w, h = cv2.boundingRect(page)
+    return np.where(page[y:y + h, x:x + w] > 0, image[y:y + h, x:x + w], 255).astype(np.uint8)
+
+
+def _downscale_text(image: np.ndarray) -> np.ndarray:
+    """
+    Scale down while the text is larger than TARGET_TEXT_HEIGHT, judged by
+    the median height of the ink's connected components, but not below
+    IMAGE_MIN_EDGE.
+    """
+    longest = max(image.shape)
+    if longest <= IMAGE_MIN_EDGE:
+        return image
+    count, _, stats, _ = cv2.connectedComponentsWithStats(_ink(image), connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    # Specks and ruled lines aren't characters
+    heights = heights[(heights >= 4) & (heights < image.shape[0] / 20)]
+    if len(heights) < 20:
+        return image
+    scale = max(TARGET_TEXT_HEIGHT / np.median(heights), IMAGE_MIN_EDGE / longest)
+    return _resize(image, scale) if scale < 0.9 else image
+
+
+def _crop(image: np.ndarray) -> np.ndarray:
+    """Cut the blank margins off, keeping CROP_MARGIN pixels."""
+    ink = _ink(image)
+    bounds = []
+    for axis in (1, 0):
+        content = np.flatnonzero(ink.mean(axis=axis) > MIN_INK_SHARE)
+        if not len(content):
+            return image
+        bounds.append((max(content[0] - CROP_MARGIN, 0),
+                       min(content[-1] + CROP_MARGIN + 1, ink.shape[1 - axis])))
+    (top, bottom), (left, right) = bounds
+    if (bottom - top) * (right - left) < 0.1 * image.size:
+        # Too little is left to be the page; keep it whole
+        return image
+    return image[top:bottom, left:right]
+
+
+def _skew_angle(image: np.ndarray) -> float:
+    """
+    The rotation, in degrees, that makes the text lines horizontal: the
+    angle at which the ink's row profile is sharpest, searched coarsely and
+    then around the best coarse angle. The ink pixels' coordinates are
+    rotated rather than the image, one array operation per angle.
+    """
+    rows, columns = np.nonzero(_sample(_ink(image)))
+    if len(rows) < 100:
+        return 0.0
+
+    def sharpest(angles: np.ndarray) -> float:
+        radians = np.deg2rad(angles)[:, None]
+        # Each pixel's row after rotating by each angle, as cv2 rotates images
+        rotated = np.rint(rows * np.cos(radians) - columns * np.sin(radians)).astype(np.intp)
+        rotated -= rotated.min(axis=1, keepdims=True)
+        # Text lines that are level pile their ink into few rows
+        scores = [np.square(np.bincount(line_rows).astype(np.float64)).sum() for line_rows in rotated]
+        return float(angles[int(np.argmax(scores))])
+
+    best = sharpest(np.arange(-MAX_SKEW_DEGREES, MAX_SKEW_DEGREES + 0.5, 1.0))
+    return sharpest(np.arange(best - 0.9, best + 0.95, 0.1))
+
+
+def _deskew(image: np.ndarray) -> np.ndarray:
+    """Rotate slightly skewed text level, growing the canvas so no corner is cut off."""
+    angle = _skew_angle(image)
+    if abs(angle) < MIN_SKEW_DEGREES:
+        return image
+    height, width = image.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_width, new_height = int(height * sin + width * cos), int(height * cos + width * sin)
+    matrix[0, 2] += new_width / 2 - width / 2
+    matrix[1, 2] += new_height / 2 - height / 2
+    return cv2.warpAffine(image, matrix, (new_width, new_height), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=255)
@@ -0,0 +1,486 @@
+import logging
+import re
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from layouts import Layout, vendor_key
+
+logger = logging.getLogger(__name__)
+
+# Common section headers that might indicate where line items start
+SECTION_HEADERS = [
+    'Services',
+    'Items',
+    'Description',
+    'Product',
+    'Details',
+    'Charges',
+    'Line Items'
+]
+
+# Common headers that indicate the end of line items
+END_HEADERS = [
+    'Services Subtotal:',
+    'Subtotal:',
+    'Total:',
+    'Balance Due',
+    'Amount Due',
+    'Payment Terms',
+    'Terms',
+    'Notes'
+]
+
+# Common date patterns, in order of preference
+DATE_PATTERNS = [
+    re.compile(r'\d{2}/\d{2}/\d{4}'),
+    re.compile(r'\d{2}-\d{2}-\d{4}'),
+    re.compile(r'\d{4}/\d{2}/\d{2}'),
+    re.compile(r'\d{4}-\d{2}-\d{2}'),
+    re.compile(r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]* \d{1,2},? \d{4}'),
+]
+
+INVOICE_NUMBER_PATTERNS = [
+    re.compile(r'Invoice\s*#:\s*(\d+)'),
+    re.compile(r'Invoice\s*#\s*(\d+)'),
+]
+DIGITS = re.compile(r'(\d+)')
+
+# Headers are matched case-insensitively by searching the lowercased line.
+# Headers that contain a shorter header ('Line Items' / 'Items') are implied
+# by it, so each list collapses into one alternation.
+SECTION_RE = re.compile('|'.join(re.escape(h.lower()) for h in SECTION_HEADERS))
+END_RE = re.compile('|'.join(re.escape(h.lower()) for h in END_HEADERS))
+
+DATE_PREFIX_RE = re.compile(r'\d{2}[-/]\d{2}[-/]\d{2}')
+NUMBERED_RE = re.compile(r'^\s*(?:\d+[\.)]\s+|\(\d+\)\s+)')
+# Like NUMBERED_RE but for a single token, which has no trailing space
+NUMBERED_TOKEN_RE = re.compile(r'^\s*(?:\d+[\.)]\s*|\(\d+\)\s*)')
+AMOUNT_RE = re.compile(r'\$?\s*\d{1,3}(?:,\d{3})*\.\d{2}\b')
+NUMBER_RE = re.compile(r'-?\d*\.?\d+')
+
+# Line classification bits
+DATED = 1
+NUMBERED = 2
+AMOUNT = 4
+SECTION = 8
+COLUMNS = 16
+END = 32
+
+
+def classify(line: str) -> int:
+    """Classify a stripped, non-empty line into a bitmask of the flags above."""
+    lowered = line.lower()
+    flags = 0
+    if DATE_PREFIX_RE.match(line):
+        flags |= DATED
+    if NUMBERED_RE.match(line):
+        flags |= NUMBERED
+    if AMOUNT_RE.search(line):
+        flags |= AMOUNT
+    if SECTION_RE.search(lowered):
+        flags |= SECTION
+    # Common column header combinations: date + description, item + amount,
+    # quantity + price, description + rate
+    if (('description' in lowered and ('date' in lowered or 'rate' in lowered)) or
+            ('item' in lowered and 'amount' in lowered) or
+            ('quantity' in lowered and 'price' in lowered)):
+        flags |= COLUMNS
+    if END_RE.search(lowered):
+        flags |= END
+    return flags
+
+
+def _terminator(line: str) -> str:
+    """The end header a terminator line matched, e.g. 'subtotal:'."""
+    return END_RE.search(line.lower()).group(0)
+
+
+def classify_item_line(line: str) -> int:
+    """
+    `classify()` without the section and column header bits, for lines
+    already known to be inside the line item section.
+    """
+    flags = 0
+    if DATE_PREFIX_RE.match(line):
+        flags |= DATED
+    if NUMBERED_RE.match(line):
+        flags |= NUMBERED
+    if AMOUNT_RE.search(line):
+        flags |= AMOUNT
+    if END_RE.search(line.lower()):
+        flags |= END
+    return flags
+
+
+class SectionTracker:
+    """
+    Follows a document page by page to tell when the text read so far holds
+    its whole line item section, so the remaining pages can be skipped.
+
+    Each line is classified once, as it arrives. Only a section found by a
+    section header and column header row counts, once its terminator has
+    been read: later pages can't change where that section starts or ends.
+    A section found only by its first item-like line never counts, since an
+    amount on the first page ('Amount Due: $250.00') may come before items
+    on a later one.
+    """
+
+    def __init__(self):
+        self.complete = False
+        self._count = 0
+        # Section header lines whose next five lines may still hold a column header row
+        self._sections = []
+        self._start = -1
+
+    def feed(self, text: str) -> bool:
+        """Read the next page's text; returns `complete`."""
+        for raw in text.split('\n'):
+            line = raw.strip()
+            if not line:
+                continue
+            index = self._count
+            self._count += 1
+            if self._start != -1:
+                if END_RE.search(line.lower()):
+                    self.complete = True
+                    break
+                continue
+            line_flags = classify(line)
+            if line_flags & SECTION:
+                self._sections.append(index)
+            # The first column header row within five lines of a section
+            # header is the one the heuristics pick
+            self._sections = [section for section in self._sections if index - section < 5]
+            if line_flags & COLUMNS and self._sections:
+                self._start = index + 1
+        return self.complete
+
+
+class ParsedInvoice(NamedTuple):
+    invoice_date: str
+    invoice_number: str
+    line_items: List[Dict]
+
+
+class InvoiceParser:
+    """
+    Single-pass invoice text parser.
+
+    The text is split once; every line is stripped and classified once
+    (date-prefixed, numbered, amount-bearing, section/column header,
+    terminator) with precompiled patterns, and the invoice number fallback is
+    tracked during the same pass. The line item section and items are then
+    read from the classified lines without re-running any pattern.
+
+    With a LayoutIndex, `parse()` also learns each vendor's layout (column
+    header row, terminator, where the invoice number is) from invoices it
+    parses successfully. A known vendor's invoices are then read with that
+    plan: lines are skipped up to the header row, only the item lines are
+    classified, and the invoice number must be found the way it was before.
+    If none of the vendor's plans fit, the heuristics run as usual.
+    """
+
+    def __init__(self, layouts=None):
+        self.layouts = layouts
+
+    def parse(self, text: str) -> ParsedInvoice:
+        vendor = vendor_key(text) if self.layouts is not None else None
+        if vendor is None:
+            return self._parse(text)[0]
+        known = self.layouts.get(vendor)
+        for layout in known:
+            parsed = self._parse_with_layout(text, layout)
+            if parsed is not None:
+                self.layouts.record('hit', vendor)
+                return parsed
+        parsed, learned = self._parse(text)
+        self.layouts.record('fallback' if known else 'miss')
+        if parsed.line_items:
+            self.layouts.learn(vendor, learned)
+        return parsed
+
+    def _parse(self, text: str) -> Tuple[ParsedInvoice, Layout]:
+        """Parse with the heuristics; also returns the layout they found."""
+        invoice_number, pattern = self._labelled_invoice_number(text)
+        lines, flags, fallback = self._scan(text, find_number=invoice_number is None)
+        if invoice_number is not None:
+            number_location = f'label:{pattern}'
+        elif fallback is not None:
+            invoice_number, number_location = fallback, 'line'
+        else:
+            invoice_number, number_location = 'Invoice', None
+        header_row, start, end = self._section_bounds(flags)
+        layout = Layout(
+            header_row=lines[header_row] if header_row != -1 else None,
+            columns=lines[header_row].lower().split() if header_row != -1 else [],
+            terminator=_terminator(lines[end]) if end != -1 else None,
+            number=number_location,
+        )
+        parsed = ParsedInvoice(
+            self.extract_date(text),
+            invoice_number,
+            self._items(lines, flags, start, end),
+        )
+        return parsed, layout
+
+    def _parse_with_layout(self, text: str, layout: Layout) -> Optional[ParsedInvoice]:
+        """Parse following a learned layout; None if the invoice doesn't match it."""
+        invoice_number = self._planned_invoice_number(text, layout.number)
+        if invoice_number is None:
+            return None
+        if layout.header_row is None:
+            return self._parse_headerless(text, layout, invoice_number)
+        lines = []
+        flags = []
+        terminator = None
+        in_section = False
+        for raw in text.split('\n'):
+            line = raw.strip()
+            if not line:
+                continue
+            if not in_section:
+                in_section = line == layout.header_row
+                continue
+            line_flags = classify_item_line(line)
+            if line_flags & END:
+                terminator = _terminator(line)
+                break
+            lines.append(line)
+            flags.append(line_flags)
+        # A different terminator (or none) means the template changed
+        if terminator != layout.terminator:
+            return None
+        line_items = self._items(lines, flags, 0, len(lines))
+        if not line_items:
+            return None
+        return ParsedInvoice(self.extract_date(text), invoice_number, line_items)
+
+    def _parse_headerless(self, text: str, layout: Layout, invoice_number: str) -> Optional[ParsedInvoice]:
+        """
+        Follow a layout whose items were found without a column header row.
+        Every line is classified, since an invoice that does have a header
+        row (e.g. from a different template under a generic letterhead) has
+        its items below it, not from the first item-like line; such an
+        invoice doesn't match the layout.
+        """
+        lines, flags, _ = self._scan(text, find_number=False)
+        header_row, start, end = self._section_bounds(flags)
+        if header_row != -1 or (_terminator(lines[end]) if end != -1 else None) != layout.terminator:
+            return None
+        line_items = self._items(lines, flags, start, end)
+        if not line_items:
+            return None
+        return ParsedInvoice(self.extract_date(text), invoice_number, line_items)
+
+    def _planned_invoice_number(self, text: str, location: Optional[str]) -> Optional[str]:
+        """
+        The invoice number, looked for where a layout says it is; None if it
+        isn't there. Labels are always tried in order, as the heuristics do,
+        since a later pattern can match a different number ('Credit applied
+        from Invoice # 1001') than the earlier one would.
+        """
+        if location is None:
+            return self.extract_invoice_number(text)
+        number, _ = self._labelled_invoice_number(text)
+        if location == 'line':
+            # A label the layout's invoices didn't have takes precedence
+            return self._scan(text, classify_lines=False)[2] if number is None else None
+        return number
+
+    def extract_date(self, text: str) -> str:
+        """Extract the invoice date from the text."""
+        for pattern in DATE_PATTERNS:
+            match = pattern.search(text)
+            if match:
+                return match.group(0)
+        return datetime.now().strftime('%Y-%m-%d')
+
+    def extract_invoice_number(self, text: str) -> str:
+        """Extract the invoice number from the text."""
+        number, _ = self._labelled_invoice_number(text)
+        if number is None:
+            _, _, number = self._scan(text, classify_lines=False)
+        return number if number is not None else 'Invoice'
+
+    def extract_line_items(self, text: str) -> List[Dict]:
+        """Extract line items from the text."""
+        lines, flags, _ = self._scan(text, find_number=False)
+        return self._line_items(lines, flags)
+
+    def find_items_section(self, text: str) -> Tuple[int, int]:
+        """
+        Locate the line items among the non-empty lines of `text`.
+        Returns (start, end) indices; start is -1 if no items were found and
+        end is -1 if the section runs to the end of the text.
+        """
+        lines, flags, _ = self._scan(text, find_number=False)
+        return self._section(flags)
+
+    def _scan(self, text: str, find_number: bool = True,
+              classify_lines: bool = True) -> Tuple[List[str], List[int], Optional[str]]:
+        """
+        Split and classify every line. With `find_number`, also returns the
+        invoice number found by the line-based fallback: the first line with
+        digits after a '#' that is within four lines of a line mentioning
+        'INVOICE'.
+        """
+        lines = []
+        flags = []
+        number = None
+        last_invoice_line = -10
+        for index, raw in enumerate(text.split('\n')):
+            if find_number and number is None:
+                if 'INVOICE' in raw.upper():
+                    last_invoice_line = index
+                if index - last_invoice_line < 5 and '#' in raw:
+                    match = DIGITS.search(raw.split('#')[1])
+                    if match:
+                        number = match.group(1)
+            if not classify_lines:
+                if number is not None:
+                    break
+                continue
+            line = raw.strip()
+            if line:
+                lines.append(line)
+                flags.append(classify(line))
+        return lines, flags, number
+
+    def _labelled_invoice_number(self, text: str) -> Tuple[Optional[str], int]:
+        """
+        The number after 'Invoice #:' or 'Invoice #', if there is one, and
+        the index of the pattern that found it.
+        """
+        for index, pattern in enumerate(INVOICE_NUMBER_PATTERNS):
+            match = pattern.search(text)
+            if match:
+                return match.group(1), index
+        return None, -1
+
+    def _section(self, flags: List[int]) -> Tuple[int, int]:
+        _, start, end = self._section_bounds(flags)
+        return start, end
+
+    def _section_bounds(self, flags: List[int]) -> Tuple[int, int, int]:
+        """
+        (header_row, start, end) of the line items: header_row is the index
+        of their column header row, or -1 if they were found without one.
+        """
+        count = len(flags)
+        start = -1
+
+        # Look for a section header with a column header row within the
+        # next five lines (the header itself included). Walking backwards
+        # keeps track of the nearest column header row below each line; the
+        # last match seen belongs to the first section header.
+        next_columns = count
+        header_row = -1
+        for i in range(count - 1, -1, -1):
+            if flags[i] & COLUMNS:
+                next_columns = i
+            if flags[i] & SECTION and next_columns < min(i + 5, count):
+                header_row = next_columns
+        if header_row != -1:
+            start = header_row + 1
+
+        if start == -1:
+            # Fall back to the first line that looks like a line item
+            for i in range(count):
+                if flags[i] & (DATED | NUMBERED | AMOUNT):
+                    start = i
+                    break
+
+        if start == -1:
+            return -1, -1, -1
+
+        for i in range(start, count):
+            if flags[i] & END:
+                return header_row, start, i
+        return header_row, start, -1
+
+    def _line_items(self, lines: List[str], flags: List[int]) -> List[Dict]:
+        start, end = self._section(flags)
+        return self._items(lines, flags, start, end)
+
+    def _items(self, lines: List[str], flags: List[int], start: int, end: int) -> List[Dict]:
+        """Read the line items from lines[start:end] (end -1: to the end)."""
+        line_items = []
+        if start == -1:
+            return line_items
+        if end == -1:
+            end = len(lines)
+
+        # Lines between start and end never contain a terminator
+        current_item = None
+        for i in range(start, end):
+            line = lines[i]
+            line_flags = flags[i]
+            try:
+                # Split the line and clean up parts
+                parts = line.split()
+
+                # Check if this is a new line item
+                is_new_item = (
+                    line_flags & (DATED | NUMBERED) or
+                    (len(parts) >= 3 and line_flags & AMOUNT)
+                )
+
+                if is_new_item:
+                    # Add previous item if exists
+                    if current_item:
+                        line_items.append(current_item)
+
+                    # Find all numbers in the line (including those with $ and ,)
+                    numbers = []
+                    first_number_idx = -1
+                    for idx, part in enumerate(parts):
+                        clean_part = part.replace('$', '').replace(',', '')
+                        if NUMBER_RE.fullmatch(clean_part):
+                            numbers.append(float(clean_part))
+                            if first_number_idx == -1:
+                                first_number_idx = idx
+
+                    if len(numbers) >= 2:  # Need at least rate and total
+                        # Handle different number arrangements
+                        if len(numbers) >= 3:
+                            # Assume last three numbers are quantity, rate, total
+                            quantity = numbers[-3]
+                            rate = numbers[-2]
+                            total = numbers[-1]
+                        else:
+                            # Assume last two numbers are rate and total
+                            rate = numbers[-2]
+                            total = numbers[-1]
+                            # Calculate quantity
+                            quantity = round(total / rate, 2) if rate != 0 else 1
+
+                        # Skip date or number prefix if present
+                        first = parts[0]
+                        start_idx = 1 if line_flags & DATED else 0
+                        if NUMBERED_TOKEN_RE.match(first):
+                            start_idx += 1
+
+                        # Description is everything between start and first number
+                        description = ' '.join(parts[start_idx:first_number_idx])
+
+                        current_item = {
+                            'description': description,
+                            'quantity': quantity,
+                            'amount': rate,
+                            'total': total
+                        }
+
+                elif current_item:
+                    # Lines without amounts continue the previous description
+                    if not line_flags & AMOUNT:
+                        current_item['description'] += ' ' + line
+
+            except Exception as e:
+                logger.error(f"Error processing line item '{line}': {str(e)}")
+                current_item = None
+
+        # Add the last item if we have one
+        if current_item:
+            line_items.append(current_item)
+
+        return line_items
@@ -1,83 +1,344 @@
-from google.cloud import vision
+import json
 import os
 from datetime import datetime
-import re
-from typing import Dict, List, Optional
-from google.oauth2 import service_account
-import pdfplumber
-import tempfile
+from typing import Dict, List, Optional, Tuple, Union
 import logging
+import metrics
+from clients import registry
+from cache import default_cache, source_sha256
+from image_prep import IMAGE_PREP, prepare_images
+from pdf_pages import iter_pdf_pages
+from pdf_tables import TableItem, TableReader
+from invoice_parser import InvoiceParser, SectionTracker
+from layouts import default_layout_index, vendor_key
+from ocr import PageOcr, VisionOcrBackend, default_ocr_backend, needs_ocr
+from offload import run_cpu_bound
+from sources import Source, is_pdf_source, read_source
+from tracing import current_trace
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Stop reading a PDF once the line item section has ended
+PDF_STOP_AT_TOTALS = os.environ.get('PDF_STOP_AT_TOTALS', '1') != '0'
+# Read PDF line items from the word positions when the items are laid out as
+# a table, instead of from the flattened text
+PDF_TABLES = os.environ.get('PDF_TABLES', '1') != '0'
+
+# Bump whenever a change to parse_text can change its output, so results
+# cached by an older parser are re-parsed from the cached text
+PARSER_VERSION = 3
+
+def extract_pdf_text(source: Source, stop_at_totals: bool = PDF_STOP_AT_TOTALS,
+                     ocr=None, tables: Optional[TableReader] = None) -> str:
+    """
+    Extract the text layer of a PDF (a path, bytes or a binary stream), page
+    by page.
+
+    Pages without a usable text layer (scans) are rasterized and sent to OCR
+    in the background while the remaining pages are read. With
+    `stop_at_totals`, reading stops after the page where a line item
+    section found by its headers ends, since nothing after it is parsed. With a TableReader,
+    each page's words are fed to it too, and reading stops once its table
+    has ended. Each page read is reported to the trace's listener, with the
+    table's line items as soon as no later page can change them.
+    Module-level so it can be sent to a process pool.
+    """
+    trace = current_trace()
+    pages = []
+    # Table items already reported to the listener
+    reported = 0
+    page_ocr = PageOcr(source, backend=ocr)
+    section = SectionTracker() if stop_at_totals else None
+    page_iter = iter_pdf_pages(source, words=tables is not None)
+    try:
+        for page_number, page in enumerate(page_iter, start=1):
+            page_text = page.text
+            scanned = needs_ocr(page_text)
+            if scanned:
+                page_ocr.submit(page_number)
+            pages.append(page_text)
+            if tables is not None:
+                run_cpu_bound(tables.feed, None if scanned else page.words)
+            if trace.listening:
+                reported = _report_page(trace, page_number, tables, reported)
+            if tables is not None and stop_at_totals and tables.complete:
+                logger.debug("Table ends on page %d, skipping remaining pages", len(pages))
+                trace.note('stopped_at_page', len(pages))
+                break
+            # A scanned page's text isn't known until OCR returns, so the
+            # section can't be followed past it
+            if section is not None and scanned:
+                section = None
+            if section is not None and run_cpu_bound(section.feed, page_text):
+                logger.debug("Line items end on page %d, skipping remaining pages", len(pages))
+                trace.note('stopped_at_page', len(pages))
+                if tables is not None:
+                    tables.stop()
+                break
+        if tables is not None and tables.result() and reported < len(tables.items) and trace.listening:
+            trace.event('items', first=reported, items=[item._asdict() for item in tables.items[reported:]])
+        trace.count('pages', len(pages))
+        if len(page_ocr):
+            trace.count('ocr_pages', len(page_ocr))
+            with trace.span('ocr'):
+                ocr_texts = page_ocr.results()
+            for page_number, page_text in ocr_texts.items():
+                pages[page_number - 1] = page_text
+    except Exception as e:
+        logger.error(f"Error extracting text from PDF: {str(e)}")
+        raise
+    finally:
+        page_iter.close()
+        page_ocr.close()
+    return "\n".join(pages) + "\n"
+
+def _dump_table_items(table_items: Optional[List[TableItem]]) -> str:
+    return json.dumps([item._asdict() for item in table_items] if table_items is not None else None)
+
+
+def _load_table_items(tables: str) -> Optional[List[TableItem]]:
+    items = json.loads(tables)
+    return [TableItem(**item) for item in items] if items is not None else None
+
+
+def _report_page(trace, page_number: int, tables: Optional[TableReader], reported: int) -> int:
+    """
+    Send a 'page' event with the table items read since the last one, if
+    any (`first` is the index of the first). Returns how many items have
+    been reported.
+    """
+    event = {'page': page_number}
+    if tables is not None and tables.usable:
+        # The last item may still continue on the next page
+        ready = len(tables.items) if tables.complete else len(tables.items) - 1
+        if ready > reported:
+            event.update(first=reported, items=[item._asdict() for item in tables.items[reported:ready]])
+            reported = ready
+    trace.event('page', **event)
+    return reported
+
+def process_invoice_file(source: Union[str, bytes], filename: Optional[str] = None) -> Tuple[List[Dict], str]:
+    """
+    Process one invoice with a fresh processor and return its line items and
+    cache status. Module-level so it can be sent to a process pool. A
+    spawned child shares no clients with its parent: the first scanned page
+    it OCRs builds the child's own Vision client.
+    """
+    processor = InvoiceProcessor()
+    results = processor.process_invoice(source, filename)
+    return results, processor.last_cache_status
+
 class InvoiceProcessor:
-    def __init__(self):
-        credentials = service_account.Credentials.from_service_account_file(
-            'credentials.json',
-            scopes=['https://www.googleapis.com/auth/cloud-vision']
-        )
-        self.client = vision.ImageAnnotatorClient(credentials=credentials)
+    def __init__(self, client=None, cache=None, ocr=None, layouts=None, tables=None,
+                 prepare_images=None):
+        # The Vision client comes from the process-wide registry unless one is
+        # passed in, so constructing a processor per request is cheap.
+        self._client = client
+        # OCR for images and scanned PDF pages; a client passed in is used
+        # for OCR too
+        if ocr is None:
+            ocr = VisionOcrBackend(client) if client is not None else default_ocr_backend()
+        self.ocr = ocr
+        # Uses the shared result cache by default; pass cache=False to skip it
+        self.cache = default_cache() if cache is None else (cache or None)
+        # 'hit', 'text_hit', 'miss' or 'disabled' for the last processed file
+        self.last_cache_status = None
+        # Learns and reuses vendor layouts with the shared index by default;
+        # pass layouts=False to always use the heuristics
+        self.parser = InvoiceParser(default_layout_index() if layouts is None else (layouts or None))
+        # Reads PDF line items laid out as a table from the word positions
+        # (PDF_TABLES); pass tables=False to always parse them from the text
+        self.tables = PDF_TABLES if tables is None else tables
+        # Shrinks uploaded images before OCR (IMAGE_PREP); pass
+        # prepare_images=False to send them as uploaded
+        self.prepare_images = IMAGE_PREP if prepare_images is None else prepare_images
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = registry.vision()
+        return self._client
 
-    def process_invoice(self, file_path: str) -> List[Dict]:
+    def process_invoice(self, source: Source, filename: Optional[str] = None) -> List[Dict]:
         """
-        Process an invoice file and extract relevant information.
+        Process an invoice and extract relevant information. `source` is a
+        file path, the file's bytes or a binary file-like object; `filename`
+        tells PDFs from images when the source has no name of its own.
         Returns a list of line items with their details.
         """
-        # Check if file is PDF
-        is_pdf = file_path.lower().endswith('.pdf')
-        
-        if is_pdf:
-            logger.info("Extracting text from PDF...")
+        trace = current_trace()
+        if self.cache is None:
+            self.last_cache_status = 'disabled'
+            trace.note('cache', self.last_cache_status)
+            return self.parse_text(*self.extract(source, filename))
+
+        with trace.span('cache_lookup'):
+            key = source_sha256(source)
+            results = self._cached_results(key)
+            extraction = self.cache.get_extraction(key) if results is None else None
+        if results is not None:
+            self.last_cache_status = 'hit'
+        else:
+            # A PDF's table items are cached with its text; text cached
+            # without them is read again, or its items would come from the text
+            read_tables = self.tables and is_pdf_source(source, filename)
+            if extraction is not None and not (read_tables and extraction[1] is None):
+                self.last_cache_status = 'text_hit'
+                text, tables = extraction
+                table_items = _load_table_items(tables) if read_tables else None
+                if table_items is not None and trace.listening:
+                    # No pages are read to report them as they come
+                    trace.event('items', first=0, items=[item._asdict() for item in table_items])
+            else:
+                self.last_cache_status = 'miss'
+                text, table_items = self.extract(source, filename)
+                self.cache.put_text(key, text, _dump_table_items(table_items) if read_tables else None)
+            results = self.parse_text(text, table_items)
+            self.cache.put_results(key, PARSER_VERSION, results)
+
+        self.cache.record(self.last_cache_status)
+        trace.note('cache', self.last_cache_status)
+        logger.debug("Result cache %s for %s", self.last_cache_status, key[:12])
+        return results
+
+    def process_images(self, sources: List[Source]) -> List[Union[Tuple[List[Dict], str], Exception]]:
+        """
+        Process several image invoices (paths, bytes or streams), sending
+        every image that isn't cached to OCR together so the backend can
+        batch them.
+        Returns (line items, cache status) or the exception for each file, in order.
+        """
+        outcomes = [None] * len(sources)
+        keys = {}
+        texts = {}
+        to_ocr = []
+        for i, source in enumerate(sources):
             try:
-                with pdfplumber.open(file_path) as pdf:
-                    text = ""
-                    for page in pdf.pages:
-                        text += page.extract_text() + "\n"
-                logger.info("Successfully extracted text from PDF")
+                if self.cache is None:
+                    to_ocr.append(i)
+                    continue
+                keys[i] = source_sha256(source)
+                results = self._cached_results(keys[i])
+                if results is not None:
+                    self.cache.record('hit')
+                    outcomes[i] = (results, 'hit')
+                    continue
+                text = self.cache.get_text(keys[i])
+                if text is not None:
+                    texts[i] = (text, 'text_hit')
+                else:
+                    to_ocr.append(i)
             except Exception as e:
-                logger.error(f"Error extracting text from PDF: {str(e)}")
-                raise
-        else:
-            # For non-PDF files, use Google Cloud Vision
-            with open(file_path, 'rb') as image_file:
-                content = image_file.read()
-            
-            image = vision.Image(content=content)
-            response = self.client.document_text_detection(image=image)
-            
-            if response.error.message:
-                logger.error(f"Error during OCR: {response.error.message}")
-                raise Exception(f"Error during OCR: {response.error.message}")
-                
-            text = response.full_text_annotation.text
-        
-        # Log the full extracted text for debugging
-        logger.info("=" * 80)
-        logger.info("FULL EXTRACTED TEXT:")
-        logger.info("=" * 80)
-        logger.info(text)
-        logger.info("=" * 80)
+                outcomes[i] = e
 
-        # Extract information
-        invoice_date = self._extract_date(text)
-        logger.info(f"Extracted date: {invoice_date}")
-        
-        invoice_number = self._extract_invoice_number(text)
-        logger.info(f"Extracted invoice number: {invoice_number}")
+        images = [read_source(sources[i]) for i in to_ocr]
+        for i, text in zip(to_ocr, self.ocr_images(images)):
+            if isinstance(text, Exception):
+                outcomes[i] = text
+                continue
+            if self.cache is not None:
+                self.cache.put_text(keys[i], text)
+            texts[i] = (text, 'miss' if self.cache is not None else 'disabled')
+
+        for i, (text, status) in texts.items():
+            try:
+                results = self.parse_text(text)
+                if self.cache is not None:
+                    self.cache.put_results(keys[i], PARSER_VERSION, results)
+                    self.cache.record(status)
+                outcomes[i] = (results, status)
+            except Exception as e:
+                outcomes[i] = e
+        return outcomes
+
+    def ocr_images(self, images: List[bytes]) -> List[Union[str, Exception]]:
+        """
+        OCR several encoded images at once. The backend groups them into as
+        few requests as it can; each entry is the text of that image or the
+        exception it failed with.
+        """
+        if self.prepare_images:
+            with current_trace().span('prepare'):
+                images = prepare_images(images)
+        return self.ocr.recognize_each(images)
+
+    def _cached_results(self, key: str) -> Optional[List[Dict]]:
+        results = self.cache.get_results(key, PARSER_VERSION)
+        if results is not None:
+            today = datetime.now().strftime('%Y-%m-%d')
+            for item in results:
+                item['date_accessed'] = today
+        return results
+
+    def extract_text(self, source: Source, filename: Optional[str] = None) -> str:
+        """Get the raw text of an invoice, from the PDF text layer and/or via OCR."""
+        return self.extract(source, filename)[0]
+
+    def extract(self, source: Source,
+                filename: Optional[str] = None) -> Tuple[str, Optional[List[TableItem]]]:
+        """
+        Get the raw text of an invoice and, for a PDF whose line items are
+        laid out as a table, the items read from the table (otherwise None).
+        """
+        trace = current_trace()
+        table_items = None
+        # Check if file is PDF
+        is_pdf = is_pdf_source(source, filename)
+        path = 'pdf' if is_pdf else 'ocr'
+        trace.note('path', path)
         
-        # Log text structure before line item extraction
-        logger.info("Text structure before line item extraction:")
-        lines = text.split('\n')
-        for i, line in enumerate(lines):
-            logger.info(f"Line {i}: {line}")
+        with trace.span('extract'), metrics.EXTRACT_SECONDS.labels(path).time():
+            if is_pdf:
+                tables = TableReader() if self.tables else None
+                text = extract_pdf_text(source, ocr=self.ocr, tables=tables)
+                if tables is not None:
+                    table_items = tables.result()
+            else:
+                # For non-PDF files, use OCR (Google Cloud Vision by default)
+                content = read_source(source)
+                trace.count('image_bytes', len(content))
+                if self.prepare_images:
+                    with trace.span('prepare'):
+                        content = prepare_images([content])[0]
+                text = self.ocr.recognize([content])[0]
+        trace.count('text_chars', len(text))
+        return text, table_items
+
+    def parse_text(self, text: str, table_items: Optional[List[TableItem]] = None) -> List[Dict]:
+        """
+        Turn extracted invoice text into sheet-ready line items. Line items
+        already read from a table are used as they are; the date and invoice
+        number still come from the text.
+        """
+        trace = current_trace()
+        # The full text is only dumped for verbose (requested or sampled) traces
+        trace.dump('extracted text', lambda: '\n'.join(
+            f"Line {i}: {line}" for i, line in enumerate(text.split('\n'))
+        ))
         
-        line_items = self._extract_line_items(text)
-        logger.info(f"Extracted {len(line_items)} line items")
-        for item in line_items:
-            logger.info(f"Line item: {item}")
+        # Extract date, invoice number and line items in one pass, off the
+        # gevent hub if there is one
+        with trace.span('parse'), metrics.PARSE_SECONDS.time():
+            if table_items is not None:
+                invoice_date = self.parser.extract_date(text)
+                invoice_number = self.parser.extract_invoice_number(text)
+                line_items = [item._asdict() for item in table_items]
+            else:
+                invoice_date, invoice_number, line_items = run_cpu_bound(self.parser.parse, text)
+        trace.note('items_from', 'table' if table_items is not None else 'text')
+        if table_items is None and trace.listening:
+            # Table items were reported page by page as they were read
+            trace.event('items', first=0, items=line_items)
+        trace.count('items', len(line_items))
+        metrics.LINE_ITEMS.observe(len(line_items))
+        logger.debug("Parsed invoice %s dated %s: %d line items",
+                     invoice_number, invoice_date, len(line_items))
+        trace.dump('line items', lambda: '\n'.join(str(item) for item in line_items))
 
-        # Format the results
+        # Format the results; the vendor tells invoices with the same number
+        # apart in the ledger
+        date_accessed = datetime.now().strftime('%Y-%m-%d')  # Only show date
+        vendor = vendor_key(text)
         results = []
         for item in line_items:
             results.append({
@@ -87,234 +348,20 @@ class InvoiceProcessor:
                 'expense_qty': item['quantity'],
                 'expense_amount': item['amount'],
                 'total_expense_cost': item['total'],
-                'date_accessed': datetime.now().strftime('%Y-%m-%d')  # Only show date
+                'date_accessed': date_accessed,
+                'vendor': vendor
             })
 
         return results
 
     def _extract_date(self, text: str) -> str:
         """Extract the invoice date from the text."""
-        # Common date patterns
-        date_patterns = [
-            r'\d{2}/\d{2}/\d{4}',
-            r'\d{2}-\d{2}-\d{4}',
-            r'\d{4}/\d{2}/\d{2}',
-            r'\d{4}-\d{2}-\d{2}',
-            r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]* \d{1,2},? \d{4}',
-        ]
-        
-        for pattern in date_patterns:
-            match = re.search(pattern, text)
-            if match:
-                return match.group(0)
-        
-        return datetime.now().strftime('%Y-%m-%d')
+        return self.parser.extract_date(text)
 
     def _extract_invoice_number(self, text: str) -> str:
         """Extract the invoice number from the text."""
-        # Look for Invoice #: pattern
-        match = re.search(r'Invoice\s*#:\s*(\d+)', text)
-        if match:
-            return match.group(1)
-        
-        # Look for Invoice #
-        match = re.search(r'Invoice\s*#\s*(\d+)', text)
-        if match:
-            return match.group(1)
-            
-        # Look for specific patterns near "Invoice"
-        lines = text.split('\n')
-        for i, line in enumerate(lines):
-            if 'INVOICE' in line.upper():
-                # Check next few lines for the invoice number
-                for j in range(i, min(i + 5, len(lines))):
-                    if '#' in lines[j]:
-                        # Extract the number after #
-                        parts = lines[j].split('#')
-                        if len(parts) > 1:
-                            # Extract just the digits
-                            number = re.search(r'(\d+)', parts[1])
-                            if number:
-                                return number.group(1)
-        
-        return 'Invoice'
+        return self.parser.extract_invoice_number(text)
 
     def _extract_line_items(self, text: str) -> List[Dict]:
         """Extract line items from the text."""
-        lines = text.split('\n')
-        line_items = []
-        
-        # Log the start of line item extraction
-        logger.info("Starting line item extraction...")
-        
-        # First, clean up the lines and remove any empty ones
-        lines = [line.strip() for line in lines if line.strip()]
-        
-        # Find the services section
-        services_start = -1
-        services_end = -1
-        
-        # Common section headers that might indicate where line items start
-        section_headers = [
-            'Services',
-            'Items',
-            'Description',
-            'Product',
-            'Details',
-            'Charges',
-            'Line Items'
-        ]
-        
-        # Common headers that indicate the end of line items
-        end_headers = [
-            'Services Subtotal:',
-            'Subtotal:',
-            'Total:',
-            'Balance Due',
-            'Amount Due',
-            'Payment Terms',
-            'Terms',
-            'Notes'
-        ]
-        
-        # Look for the section header and its associated column headers
-        for i, line in enumerate(lines):
-            # Check if line contains any of our section headers
-            if any(header.lower() in line.lower() for header in section_headers):
-                # Look ahead for column headers
-                for j in range(i, min(i + 5, len(lines))):
-                    # Common column header combinations
-                    if any([
-                        all(col in lines[j].lower() for col in ['date', 'description']),
-                        all(col in lines[j].lower() for col in ['item', 'amount']),
-                        all(col in lines[j].lower() for col in ['quantity', 'price']),
-                        all(col in lines[j].lower() for col in ['description', 'rate']),
-                    ]):
-                        services_start = j + 1
-                        logger.info(f"Found header row at line {j}: {lines[j]}")
-                        break
-                if services_start != -1:
-                    break
-        
-        if services_start == -1:
-            logger.info("Could not find section header, trying alternative approaches")
-            # Try to find the first line that matches common line item patterns
-            for i, line in enumerate(lines):
-                # Check for date-prefixed lines
-                if re.match(r'\d{2}[-/]\d{2}[-/]\d{2}', line):
-                    services_start = i
-                    logger.info(f"Found date-prefixed line at {i}: {line}")
-                    break
-                # Check for numbered items (e.g., "1.", "1)", "(1)")
-                elif re.match(r'^\s*(?:\d+[\.)]\s+|\(\d+\)\s+)', line):
-                    services_start = i
-                    logger.info(f"Found numbered item at {i}: {line}")
-                    break
-                # Check for lines with amount patterns (e.g., "$100.00", "100.00")
-                elif re.search(r'\$?\s*\d{1,3}(?:,\d{3})*\.\d{2}\b', line):
-                    services_start = i
-                    logger.info(f"Found amount pattern at {i}: {line}")
-                    break
-        
-        if services_start == -1:
-            logger.info("Could not find line items section")
-            return line_items
-
-        # Find the end of the section
-        for i in range(services_start, len(lines)):
-            if any(header.lower() in lines[i].lower() for header in end_headers):
-                services_end = i
-                break
-        
-        if services_end == -1:
-            services_end = len(lines)
-
-        # Process each line in the section
-        current_item = None
-        for i in range(services_start, services_end):
-            line = lines[i].strip()
-            logger.info(f"Processing line {i}: {line}")
-            
-            # Skip empty lines or summary lines
-            if not line or any(header.lower() in line.lower() for header in end_headers):
-                if current_item:
-                    line_items.append(current_item)
-                    current_item = None
-                continue
-            
-            try:
-                # Split the line and clean up parts
-                parts = line.split()
-                
-                # Check if this is a new line item
-                is_new_item = (
-                    re.match(r'\d{2}[-/]\d{2}[-/]\d{2}', line) or  # Date prefix
-                    re.match(r'^\s*(?:\d+[\.)]\s+|\(\d+\)\s+)', line) or  # Numbered item
-                    (len(parts) >= 3 and re.search(r'\$?\s*\d{1,3}(?:,\d{3})*\.\d{2}\b', line))  # Has amount
-                )
-                
-                if is_new_item:
-                    # Add previous item if exists
-                    if current_item:
-                        line_items.append(current_item)
-                    
-                    # Find all numbers in the line (including those with $ and ,)
-                    numbers = []
-                    number_indices = []
-                    for idx, part in enumerate(parts):
-                        clean_part = part.replace('$', '').replace(',', '')
-                        if re.match(r'^-?\d*\.?\d+$', clean_part):
-                            numbers.append(float(clean_part))
-                            number_indices.append(idx)
-                    
-                    if len(numbers) >= 2:  # Need at least rate and total
-                        # Handle different number arrangements
-                        if len(numbers) >= 3:
-                            # Assume last three numbers are quantity, rate, total
-                            quantity = numbers[-3]
-                            rate = numbers[-2]
-                            total = numbers[-1]
-                        else:
-                            # Assume last two numbers are rate and total
-                            rate = numbers[-2]
-                            total = numbers[-1]
-                            # Calculate quantity
-                            quantity = round(total / rate, 2) if rate != 0 else 1
-                        
-                        # Get description
-                        # Skip date or number prefix if present
-                        start_idx = 1 if re.match(r'\d{2}[-/]\d{2}[-/]\d{2}', parts[0]) else 0
-                        start_idx = start_idx + 1 if re.match(r'^\s*(?:\d+[\.)]\s*|\(\d+\)\s*)', parts[0]) else start_idx
-                        
-                        # Description is everything between start and first number
-                        first_number_idx = min(number_indices)
-                        description = ' '.join(parts[start_idx:first_number_idx])
-                        
-                        current_item = {
-                            'description': description,
-                            'quantity': quantity,
-                            'amount': rate,
-                            'total': total
-                        }
-                        logger.info(f"Found line item: {current_item}")
-                
-                elif current_item:
-                    # Check if this line doesn't contain amounts and looks like a description continuation
-                    if not re.search(r'\$?\s*\d{1,3}(?:,\d{3})*\.\d{2}\b', line):
-                        current_item['description'] += ' ' + line
-                        logger.info(f"Added continuation to description: {line}")
-            
-            except Exception as e:
-                logger.error(f"Error processing line item '{line}': {str(e)}")
-                current_item = None
-
-        # Add the last item if we have one
-        if current_item:
-            line_items.append(current_item)
-            logger.info("Added final line item")
-
-        logger.info(f"Extracted {len(line_items)} line items")
-        for item in line_items:
-            logger.info(f"Final line item: {item}")
-        
-        return line_items 
\ No newline at end of file
+        return self.parser.extract_line_items(text)
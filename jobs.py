@@ -0,0 +1,315 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import metrics
+from tracing import Trace
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Finished jobs are deleted once they are this old; 0 keeps them
+JOBS_MAX_AGE = int(os.environ.get('JOBS_MAX_AGE_DAYS', 7)) * 24 * 3600
+# Sweep old jobs after this many have finished rather than after every one
+SWEEP_EVERY = 100
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+class JobStore:
+    """
+    Job records in SQLite.
+
+    The queue itself lives in each gunicorn worker, but the records are kept
+    on disk so a status poll can be answered by any worker, not just the one
+    that accepted the upload. Finished jobs are deleted by `sweep()` once
+    they are `max_age` seconds old.
+    """
+
+    def __init__(self, path: str, max_age: int = JOBS_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    filename TEXT,
+                    state TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    worker_pid INTEGER,
+                    timings TEXT,
+                    results TEXT,
+                    error TEXT
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)')
+            # Progress of running jobs; a job's events are deleted when it finishes
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    event TEXT NOT NULL
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS job_events_job_id ON job_events (job_id, id)')
+
+    def _connect(self):
+        # A short-lived connection per call keeps this safe to use from the
+        # request thread and every worker thread at once.
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create(self, job_id: str, filename: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, filename, state, created_at, worker_pid) VALUES (?, ?, ?, ?, ?)',
+                (job_id, filename, QUEUED, time.time(), os.getpid())
+            )
+
+    def update(self, job_id: str, **fields) -> None:
+        for key in ('timings', 'results'):
+            if key in fields and fields[key] is not None:
+                fields[key] = json.dumps(fields[key])
+        columns = ', '.join(f'{key} = ?' for key in fields)
+        with self._connect() as conn:
+            conn.execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+    def delete(self, job_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def state(self, job_id: str) -> Optional[str]:
+        """The job's state, without reading its results."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def add_event(self, job_id: str, event: Dict) -> None:
+        with self._connect() as conn:
+            conn.execute('INSERT INTO job_events (job_id, event) VALUES (?, ?)', (job_id, json.dumps(event)))
+
+    def events(self, job_id: str, after: int = 0) -> List[Dict]:
+        """The job's progress events after the one with id `after`, oldest first, each with its id."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT id, event FROM job_events WHERE job_id = ? AND id > ? ORDER BY id',
+                (job_id, after)
+            ).fetchall()
+        return [dict(json.loads(event), id=event_id) for event_id, event in rows]
+
+    def delete_events(self, job_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute('DELETE FROM job_events WHERE job_id = ?', (job_id,))
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._to_dict(row, include_results=True) if row else None
+
+    def list(self, limit: int = 50, state: Optional[str] = None) -> List[Dict]:
+        query = 'SELECT * FROM jobs'
+        params = []
+        if state:
+            query += ' WHERE state = ?'
+            params.append(state)
+        query += ' ORDER BY created_at DESC LIMIT ?'
+        params.append(limit)
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(query, params).fetchall()
+        return [self._to_dict(row, include_results=False) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs in each state."""
+        with self._connect() as conn:
+            return dict(conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def fail_orphaned(self) -> int:
+        """Mark unfinished jobs whose worker process has exited as failed."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT id, worker_pid FROM jobs WHERE state IN (?, ?)', (QUEUED, RUNNING)
+            ).fetchall()
+            orphaned = [job_id for job_id, pid in rows if not pid_alive(pid)]
+            for job_id in orphaned:
+                conn.execute(
+                    'UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE id = ?',
+                    (FAILED, 'Worker exited before the job finished', time.time(), job_id)
+                )
+                conn.execute('DELETE FROM job_events WHERE job_id = ?', (job_id,))
+        return len(orphaned)
+
+    def sweep(self) -> int:
+        """Delete finished jobs older than max_age. Returns the number removed."""
+        if self.max_age <= 0:
+            return 0
+        with self._connect() as conn:
+            removed = conn.execute(
+                'DELETE FROM jobs WHERE finished_at < ? AND state IN (?, ?)',
+                (time.time() - self.max_age, DONE, FAILED)
+            ).rowcount
+        if removed:
+            logger.info(f"Deleted {removed} jobs finished over {self.max_age // 3600} hours ago")
+        return removed
+
+    @staticmethod
+    def _to_dict(row, include_results: bool) -> Dict:
+        job = {
+            'id': row['id'],
+            'filename': row['filename'],
+            'state': row['state'],
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at'],
+            'timings': json.loads(row['timings']) if row['timings'] else None,
+            'error': row['error'],
+        }
+        results = json.loads(row['results']) if row['results'] else None
+        job['item_count'] = len(results) if results is not None else None
+        if include_results:
+            job['results'] = results
+        return job
+
+
+def pid_alive(pid: Optional[int]) -> bool:
+    """True if a process with this pid is still running."""
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """
+    Bounded in-process queue drained by a fixed pool of worker threads.
+
+    `handler(payload, trace)` does the actual work and returns the results to
+    store; anything it raises marks the job as failed, as does failing to
+    record the job, which never stops a worker thread. The trace is current
+    while the handler runs and its summary is stored as the job's timings;
+    its progress events are stored until the job finishes.
+    Threads are started on the first submit so they are created after
+    gunicorn forks the worker.
+    """
+
+    def __init__(self, handler: Callable, store: JobStore, workers: int = 2, max_queued: int = 20):
+        self.handler = handler
+        self.store = store
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._finished = 0
+
+    def submit(self, payload, filename: str = '', trace: Optional[Trace] = None) -> str:
+        """
+        Queue `payload` and return the new job's id. Raises QueueFull.
+        Pass the request's trace to keep its spans (e.g. saving the upload)
+        in the job's timings.
+        """
+        self._ensure_started()
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id, filename)
+        trace = trace or Trace('job')
+        try:
+            self._queue.put_nowait((job_id, payload, trace, time.perf_counter()))
+        except queue.Full:
+            self.store.delete(job_id)
+            raise QueueFull(f'Job queue is full ({self._queue.maxsize} jobs waiting)')
+        metrics.QUEUE_DEPTH.inc()
+        return job_id
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            orphaned = self.store.fail_orphaned()
+            if orphaned:
+                logger.warning(f"Marked {orphaned} orphaned jobs as failed")
+            self.store.sweep()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            job_id, payload, trace, enqueued = self._queue.get()
+            metrics.QUEUE_DEPTH.dec()
+            try:
+                self._execute(job_id, payload, trace, enqueued)
+            except Exception as e:
+                # The store failed (e.g. the database stayed locked) or the
+                # results couldn't be stored; the thread must live on
+                logger.exception(f"Could not record job {job_id}")
+                self._fail(job_id, f'Could not record the job: {e}')
+            finally:
+                self._queue.task_done()
+            self._maybe_sweep()
+
+    def _execute(self, job_id, payload, trace, enqueued):
+        trace.add_span('queued', time.perf_counter() - enqueued)
+        trace.note('job', job_id)
+        trace.listen(lambda event: self.store.add_event(job_id, event))
+        self.store.update(job_id, state=RUNNING, started_at=time.time())
+        try:
+            with trace.activate():
+                results = self.handler(payload, trace)
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed")
+            trace.note('error', type(e).__name__)
+            self.store.update(job_id, state=FAILED, error=str(e),
+                              finished_at=time.time(), timings=trace.finish())
+        else:
+            self.store.update(job_id, state=DONE, results=results,
+                              finished_at=time.time(), timings=trace.finish())
+        # The finished job's record has everything its events said
+        self.store.delete_events(job_id)
+
+    def _fail(self, job_id: str, error: str) -> None:
+        """Mark a job failed if the store allows it, so it isn't left running."""
+        try:
+            self.store.update(job_id, state=FAILED, error=error, finished_at=time.time())
+            self.store.delete_events(job_id)
+        except Exception:
+            logger.exception(f"Could not mark job {job_id} as failed")
+
+    def _maybe_sweep(self):
+        with self._lock:
+            self._finished += 1
+            due = self._finished % SWEEP_EVERY == 0
+        if due:
+            try:
+                self.store.sweep()
+            except Exception:
+                logger.exception("Could not delete old jobs")
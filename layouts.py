@@ -0,0 +1,255 @@
+import atexit
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_INDEX_PATH = os.environ.get('LAYOUT_INDEX_PATH', os.path.join('data', 'layouts.db'))
+# Vendors kept; the least recently used are forgotten past this
+LAYOUT_INDEX_MAX_VENDORS = int(os.environ.get('LAYOUT_INDEX_MAX_VENDORS', 1000))
+# Layouts kept per vendor, for vendors that use more than one template
+LAYOUTS_PER_VENDOR = 3
+
+# Lookup counts are written to the database in batches rather than per parse
+FLUSH_EVERY = 100
+
+# A vendor key line longer than this is probably body text, not a letterhead
+MAX_KEY_LENGTH = 80
+# Words of lines that name the document rather than its vendor ('INVOICE',
+# 'Tax Invoice', 'Invoice #: 1234', a date). Such a line doesn't tell vendors
+# apart, so the key takes in the lines after it, up to MAX_KEY_LINES.
+GENERIC_WORDS = {'invoice', 'tax', 'bill', 'statement', 'receipt', 'original', 'copy', 'duplicate',
+                 'page', 'of', 'no', 'number', 'date', 'due', 'credit', 'note', 'proforma', 'pro',
+                 'forma', 'sales', 'commercial', 'the'}
+MAX_KEY_LINES = 3
+DIGITS_RE = re.compile(r'\d+')
+SPACES_RE = re.compile(r'\s+')
+WORDS_RE = re.compile(r'[a-z]+')
+
+
+class Layout(NamedTuple):
+    """
+    How a vendor's invoices were parsed. `header_row` is the column header
+    row the line items follow (None if they start at the first item-like
+    line), `columns` its lowercased words in order, `terminator` the line
+    that ended the items (None if they ran to the end of the text), and
+    `number` where the invoice number was: 'label:<n>' for the nth pattern in
+    INVOICE_NUMBER_PATTERNS, 'line' for the '#'-near-INVOICE fallback, or
+    None if it wasn't found.
+    """
+    header_row: Optional[str]
+    columns: List[str]
+    terminator: Optional[str]
+    number: Optional[str]
+
+
+def vendor_key(text: str) -> Optional[str]:
+    """
+    The vendor's letterhead: the first non-empty line, lowercased, with
+    whitespace collapsed and digits masked. If that line only names the
+    document ('INVOICE'), the following lines are added until one doesn't,
+    joined with ' | '. None if there is no plausible letterhead.
+    """
+    lines = []
+    start = 0
+    while True:
+        end = text.find('\n', start)
+        line = (text[start:] if end == -1 else text[start:end]).strip()
+        if line:
+            if len(line) > MAX_KEY_LENGTH:
+                return None
+            key = DIGITS_RE.sub('#', SPACES_RE.sub(' ', line.lower()))
+            lines.append(key)
+            if not GENERIC_WORDS.issuperset(WORDS_RE.findall(key)):
+                return ' | '.join(lines)
+            if len(lines) == MAX_KEY_LINES:
+                return None
+        if end == -1:
+            return None
+        start = end + 1
+
+
+class LayoutIndex:
+    """
+    Persistent index of vendor invoice layouts, learned from successful
+    parses and keyed by `vendor_key()`. Up to LAYOUTS_PER_VENDOR layouts are
+    kept per vendor, newest first.
+
+    Layouts are kept in memory, so looking one up costs a dictionary access;
+    the database is only read the first time this process sees a vendor and
+    written when a layout is learned or changes. Lookup outcomes ('hit':
+    one of the vendor's layouts was used, 'fallback': none fit and the
+    heuristics ran, 'miss': no layout for the vendor) are counted in memory
+    and flushed every FLUSH_EVERY lookups and whenever stats are read.
+    """
+
+    def __init__(self, path: str = LAYOUT_INDEX_PATH, max_vendors: int = LAYOUT_INDEX_MAX_VENDORS):
+        self.path = path
+        self.max_vendors = max_vendors
+        self._lock = threading.Lock()
+        self._layouts = {}
+        self._pending = {}
+        self._pending_hits = {}
+        self._unflushed = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS layouts (
+                    vendor TEXT PRIMARY KEY,
+                    layouts TEXT NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    learned_at REAL NOT NULL,
+                    used_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS layouts_used_at ON layouts (used_at);
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, vendor: str) -> List[Layout]:
+        """The layouts learned for `vendor`, possibly by another process."""
+        with self._lock:
+            if vendor in self._layouts:
+                return self._layouts[vendor]
+        with self._connect() as conn:
+            row = conn.execute('SELECT layouts FROM layouts WHERE vendor = ?', (vendor,)).fetchone()
+        layouts = [Layout(**layout) for layout in json.loads(row[0])] if row else []
+        # Unknown vendors are remembered too, so their invoices don't query the
+        # database every time; this process learns their layout itself
+        with self._lock:
+            if len(self._layouts) >= self.max_vendors * 2:
+                self._layouts.clear()
+            self._layouts[vendor] = layouts
+        return layouts
+
+    def learn(self, vendor: str, layout: Layout) -> None:
+        """Store the layout a successful parse of `vendor`'s invoice used, if it's new."""
+        with self._lock:
+            known = self._layouts.get(vendor, [])
+            if layout in known:
+                return
+            layouts = [layout] + known[:LAYOUTS_PER_VENDOR - 1]
+            self._layouts[vendor] = layouts
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO layouts (vendor, layouts, learned_at, used_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(vendor) DO UPDATE SET layouts = excluded.layouts, '
+                'learned_at = excluded.learned_at, used_at = excluded.used_at',
+                (vendor, json.dumps([layout._asdict() for layout in layouts]), now, now)
+            )
+            conn.execute(
+                'DELETE FROM layouts WHERE vendor IN '
+                '(SELECT vendor FROM layouts ORDER BY used_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_vendors,)
+            )
+        logger.info(f"Learned invoice layout for '{vendor}'")
+
+    def record(self, outcome: str, vendor: Optional[str] = None) -> None:
+        """Count a lookup outcome ('hit', 'fallback' or 'miss')."""
+        metrics.LAYOUT_LOOKUPS.labels(outcome).inc()
+        with self._lock:
+            self._pending[outcome] = self._pending.get(outcome, 0) + 1
+            if outcome == 'hit':
+                self._pending_hits[vendor] = self._pending_hits.get(vendor, 0) + 1
+            self._unflushed += 1
+            due = self._unflushed >= FLUSH_EVERY
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the lookup counts gathered so far to the database."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            hits, self._pending_hits = self._pending_hits, {}
+            self._unflushed = 0
+        if not pending:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                'INSERT INTO counters (name, value) VALUES (?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                list(pending.items())
+            )
+            conn.executemany(
+                'UPDATE layouts SET hits = hits + ?, used_at = ? WHERE vendor = ?',
+                [(count, now, vendor) for vendor, count in hits.items()]
+            )
+
+    def stats(self) -> Dict:
+        self.flush()
+        with self._connect() as conn:
+            vendors = conn.execute('SELECT COUNT(*) FROM layouts').fetchone()[0]
+            counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+        lookups = sum(counters.values())
+        return {
+            'vendors': vendors,
+            'max_vendors': self.max_vendors,
+            'hits': counters.get('hit', 0),
+            'fallbacks': counters.get('fallback', 0),
+            'misses': counters.get('miss', 0),
+            'hit_rate': round(counters.get('hit', 0) / lookups, 4) if lookups else None,
+        }
+
+    def list(self, limit: int = 100) -> List[Dict]:
+        """Vendors and their learned layouts, most used first."""
+        self.flush()
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT vendor, layouts, hits, learned_at, used_at FROM layouts '
+                'ORDER BY hits DESC, used_at DESC LIMIT ?',
+                (limit,)
+            ).fetchall()
+        return [
+            {'vendor': vendor, 'layouts': json.loads(layouts), 'hits': hits,
+             'learned_at': learned_at, 'used_at': used_at}
+            for vendor, layouts, hits, learned_at, used_at in rows
+        ]
+
+    def purge(self) -> int:
+        """Forget every layout and reset the counters. Returns the number of vendors removed."""
+        with self._lock:
+            self._layouts.clear()
+            self._pending.clear()
+            self._pending_hits.clear()
+            self._unflushed = 0
+        with self._connect() as conn:
+            removed = conn.execute('SELECT COUNT(*) FROM layouts').fetchone()[0]
+            conn.execute('DELETE FROM layouts')
+            conn.execute('DELETE FROM counters')
+        return removed
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def default_layout_index() -> Optional[LayoutIndex]:
+    """The process-wide layout index, or None if disabled with LAYOUT_INDEX=0."""
+    global _default_index
+    if os.environ.get('LAYOUT_INDEX', '1') == '0':
+        return None
+    if _default_index is None:
+        with _default_index_lock:
+            if _default_index is None:
+                _default_index = LayoutIndex()
+                # Counts since the last flush would otherwise be lost with the worker
+                atexit.register(_default_index.flush)
+    return _default_index
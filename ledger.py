@@ -0,0 +1,421 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LEDGER_PATH = os.environ.get('LEDGER_PATH', os.path.join('data', 'ledger.db'))
+# What happens to an invoice that is already in the ledger: 'reject' it before
+# anything is written to the sheet, or 'flag' it and write its rows anyway
+LEDGER_DUPLICATES = os.environ.get('LEDGER_DUPLICATES', 'reject')
+
+# The invoice number the parser reports when it finds none; such invoices are
+# only ever matched by content
+UNKNOWN_NUMBER = 'Invoice'
+# Invoice date styles the parser finds, month first, and the ones Sheets
+# shows dates entered in those styles as
+DATE_FORMATS = ['%Y-%m-%d', '%Y/%m/%d', '%m/%d/%Y', '%m-%d-%Y', '%b %d, %Y', '%B %d, %Y',
+                '%b %d %Y', '%B %d %Y']
+# Periods the summary can be grouped by, as the length of the ISO date prefix
+PERIODS = {'day': 10, 'month': 7, 'year': 4}
+
+_COLUMNS = ('id', 'vendor', 'invoice_number', 'invoice_date', 'day', 'date_accessed', 'content_hash',
+            'filename', 'source', 'items', 'total', 'duplicate_of', 'booked_at')
+
+
+class DuplicateInvoice(Exception):
+    """Raised when an invoice being booked is already in the ledger; `booking` is the earlier one."""
+
+    def __init__(self, booking: Dict):
+        super().__init__(
+            f"Invoice {booking['invoice_number']} dated {booking['invoice_date']} was already booked "
+            f"on {datetime.fromtimestamp(booking['booked_at']).strftime('%Y-%m-%d')}"
+            + (f" from {booking['filename']}" if booking['filename'] else '')
+        )
+        self.booking = booking
+
+
+def iso_date(text) -> Optional[str]:
+    """`text` as a YYYY-MM-DD date, or None if it isn't a date in one of DATE_FORMATS."""
+    text = str(text).strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def number_key(invoice_number) -> Optional[str]:
+    """The invoice number as it's matched: leading zeros dropped (Sheets drops them), None if unknown."""
+    number = str(invoice_number).strip()
+    if not number or number == UNKNOWN_NUMBER:
+        return None
+    return number.lstrip('0') or '0'
+
+
+def _amount(value) -> float:
+    """A number as the sheet returns it: a number, or text with $ and thousands separators."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace('$', '').replace(',', '').strip() or 0)
+    except ValueError:
+        return 0.0
+
+
+class Ledger:
+    """
+    Persistent record of every invoice written to the sheet, with its line
+    items, so questions about what was booked are answered without reading
+    the sheet.
+
+    Invoices are indexed by invoice number, date and vendor, invoice date
+    and the SHA-256 of the uploaded file, so the duplicate check before a sheet
+    write and date range queries are index lookups however large the
+    ledger grows. `book()` checks and records an invoice in one transaction,
+    so two workers booking the same invoice at once can't both succeed.
+    Different vendors can use the same invoice numbers; an invoice whose
+    vendor isn't known (see layouts.vendor_key) is flagged rather than
+    rejected when only its number and date match.
+
+    The sheet stays the source of truth: `rebuild()` replaces the ledger
+    with the sheet's rows.
+    """
+
+    def __init__(self, path: str = LEDGER_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS invoices (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    vendor TEXT,
+                    invoice_number TEXT NOT NULL,
+                    number_key TEXT,
+                    invoice_date TEXT NOT NULL,
+                    day TEXT,
+                    date_accessed TEXT,
+                    content_hash TEXT,
+                    filename TEXT,
+                    source TEXT NOT NULL,
+                    items INTEGER NOT NULL,
+                    total REAL NOT NULL,
+                    duplicate_of INTEGER,
+                    booked_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS invoices_day ON invoices (day);
+                CREATE INDEX IF NOT EXISTS invoices_content_hash ON invoices (content_hash);
+                CREATE TABLE IF NOT EXISTS items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    invoice_id INTEGER NOT NULL,
+                    description TEXT NOT NULL,
+                    quantity REAL NOT NULL,
+                    amount REAL NOT NULL,
+                    total REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS items_invoice_id ON items (invoice_id);
+            """)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(invoices)')]
+            if 'vendor' not in columns:
+                # Ledgers created before vendors were recorded; their bookings have none
+                conn.execute('ALTER TABLE invoices ADD COLUMN vendor TEXT')
+                conn.execute('DROP INDEX IF EXISTS invoices_number')
+            conn.execute('CREATE INDEX IF NOT EXISTS invoices_number ON invoices (number_key, day, vendor)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def find(self, content_hash: Optional[str] = None, invoice_number=None,
+             invoice_date: Optional[str] = None, vendor: Optional[str] = None) -> Optional[Dict]:
+        """
+        The first booking of the same file, or of the same vendor's invoice
+        number and date; None if there is none. `match` tells which:
+        'content', 'number', or 'unknown_vendor' when the number and date
+        match but the vendor of either invoice isn't known.
+        """
+        with self._connect() as conn:
+            return self._find(conn, content_hash, invoice_number, invoice_date, vendor)
+
+    def _find(self, conn, content_hash, invoice_number, invoice_date, vendor) -> Optional[Dict]:
+        conn.row_factory = sqlite3.Row
+        if content_hash:
+            row = conn.execute(
+                'SELECT * FROM invoices WHERE content_hash = ? ORDER BY id LIMIT 1', (content_hash,)
+            ).fetchone()
+            if row is not None:
+                return self._to_dict(row, match='content')
+        key = number_key(invoice_number) if invoice_number is not None else None
+        if key is not None and invoice_date:
+            # Dates Sheets reformatted still match by day; others by their text
+            day = iso_date(invoice_date)
+            # The same vendor's booking first; one without a vendor could be it too
+            row = conn.execute(
+                'SELECT * FROM invoices WHERE number_key = ? AND day IS ? AND (day IS NOT NULL OR invoice_date = ?) '
+                'AND (vendor IS ? OR vendor IS NULL OR ? IS NULL) ORDER BY vendor IS NOT ?, id LIMIT 1',
+                (key, day, invoice_date, vendor, vendor, vendor)
+            ).fetchone()
+            if row is not None:
+                same_vendor = vendor is not None and row['vendor'] == vendor
+                return self._to_dict(row, match='number' if same_vendor else 'unknown_vendor')
+        return None
+
+    def book(self, results: List[Dict], content_hash: Optional[str] = None,
+             filename: Optional[str] = None, source: str = 'upload',
+             duplicates: str = None) -> Optional[Dict]:
+        """
+        Record one invoice's line items (as parse_text returns them) before
+        they are written to the sheet. If the invoice is already booked, it
+        is rejected with DuplicateInvoice or, with duplicates='flag', booked
+        with `duplicate_of` set to the earlier booking's id. A match that
+        could be another vendor's invoice is always flagged. Returns the
+        booking, or None if there were no line items.
+        """
+        if not results:
+            return None
+        duplicates = duplicates or LEDGER_DUPLICATES
+        first = results[0]
+        invoice_number, invoice_date = str(first['invoice_number']), str(first['invoice_date'])
+        vendor = first.get('vendor')
+        conn = self._connect()
+        try:
+            # Taken before the lookup, so nothing can be booked in between
+            conn.execute('BEGIN IMMEDIATE')
+            earlier = self._find(conn, content_hash, invoice_number, invoice_date, vendor)
+            if earlier is not None:
+                flag = duplicates == 'flag' or earlier['match'] == 'unknown_vendor'
+                metrics.LEDGER_DUPLICATES.labels('flagged' if flag else 'rejected').inc()
+                if not flag:
+                    conn.rollback()
+                    raise DuplicateInvoice(earlier)
+                logger.warning(f"Invoice {invoice_number} dated {invoice_date} may be a duplicate of "
+                               f"booking {earlier['id']} ({earlier['match']} match); writing it anyway")
+            booking = self._insert(conn, vendor, invoice_number, invoice_date, first['date_accessed'],
+                                   content_hash, filename, source, results,
+                                   earlier['id'] if earlier is not None else None, time.time())
+            conn.commit()
+        finally:
+            conn.close()
+        return dict(booking, duplicate=earlier)
+
+    def _insert(self, conn, vendor: Optional[str], invoice_number: str, invoice_date: str,
+                date_accessed: Optional[str], content_hash: Optional[str], filename: Optional[str], source: str,
+                results: List[Dict], duplicate_of: Optional[int], booked_at: float) -> Dict:
+        items = [(item['expense_description'], _amount(item['expense_qty']), _amount(item['expense_amount']),
+                  _amount(item['total_expense_cost'])) for item in results]
+        booking = {
+            'vendor': vendor,
+            'invoice_number': invoice_number,
+            'invoice_date': invoice_date,
+            'day': iso_date(invoice_date),
+            'date_accessed': date_accessed,
+            'content_hash': content_hash,
+            'filename': filename,
+            'source': source,
+            'items': len(items),
+            'total': round(sum(item[3] for item in items), 2),
+            'duplicate_of': duplicate_of,
+            'booked_at': booked_at,
+        }
+        cursor = conn.execute(
+            'INSERT INTO invoices (vendor, invoice_number, number_key, invoice_date, day, date_accessed, '
+            'content_hash, filename, source, items, total, duplicate_of, booked_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (vendor, invoice_number, number_key(invoice_number), invoice_date, booking['day'], date_accessed,
+             content_hash, filename, source, booking['items'], booking['total'], duplicate_of, booked_at)
+        )
+        conn.executemany(
+            'INSERT INTO items (invoice_id, description, quantity, amount, total) VALUES (?, ?, ?, ?, ?)',
+            [(cursor.lastrowid,) + item for item in items]
+        )
+        return dict(booking, id=cursor.lastrowid)
+
+    def unbook(self, invoice_id: int) -> None:
+        """Remove a booking whose rows the sheet didn't take."""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM items WHERE invoice_id = ?', (invoice_id,))
+            conn.execute('DELETE FROM invoices WHERE id = ?', (invoice_id,))
+
+    def invoices(self, start: Optional[str] = None, end: Optional[str] = None, invoice_number=None,
+                 limit: int = 100, with_items: bool = False) -> List[Dict]:
+        """
+        Booked invoices dated from `start` to `end` (YYYY-MM-DD, inclusive)
+        and/or with the given number, latest first.
+        """
+        query = 'SELECT * FROM invoices'
+        conditions, params = self._range(start, end)
+        if invoice_number is not None:
+            conditions.append('number_key = ?')
+            params.append(number_key(invoice_number))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY day DESC, id DESC LIMIT ?'
+        params.append(limit)
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            invoices = [self._to_dict(row) for row in conn.execute(query, params).fetchall()]
+            if with_items:
+                for invoice in invoices:
+                    invoice['line_items'] = [
+                        {'description': description, 'quantity': quantity, 'amount': amount, 'total': total}
+                        for description, quantity, amount, total in conn.execute(
+                            'SELECT description, quantity, amount, total FROM items '
+                            'WHERE invoice_id = ? ORDER BY id', (invoice['id'],)
+                        ).fetchall()
+                    ]
+        return invoices
+
+    def summary(self, start: Optional[str] = None, end: Optional[str] = None, by: str = 'month') -> Dict:
+        """
+        Invoice count, line items and total expense cost per day, month or
+        year from `start` to `end`. Flagged duplicates aren't counted again.
+        """
+        conditions, params = self._range(start, end)
+        where = ' AND '.join(conditions + ['day IS NOT NULL'])
+        with self._connect() as conn:
+            rows = conn.execute(
+                f'SELECT substr(day, 1, {PERIODS[by]}) AS period, COUNT(*), SUM(items), SUM(total) '
+                f'FROM invoices WHERE {where} AND duplicate_of IS NULL GROUP BY period ORDER BY period',
+                params
+            ).fetchall()
+            duplicates = conn.execute(
+                f'SELECT COUNT(*) FROM invoices WHERE {where} AND duplicate_of IS NOT NULL', params
+            ).fetchone()[0]
+        periods = [{'period': period, 'invoices': invoices, 'items': items, 'total': round(total, 2)}
+                   for period, invoices, items, total in rows]
+        return {
+            'start': start,
+            'end': end,
+            'by': by,
+            'periods': periods,
+            'invoices': sum(period['invoices'] for period in periods),
+            'items': sum(period['items'] for period in periods),
+            'total': round(sum(period['total'] for period in periods), 2),
+            'duplicates': duplicates,
+        }
+
+    def rebuild(self, rows: List[List], started_at: Optional[float] = None) -> Dict:
+        """
+        Replace the ledger with the sheet's rows (as sheet_row() lays them
+        out). Consecutive rows with the same invoice number, invoice date
+        and date accessed are one invoice. Vendors, file hashes and names of
+        bookings that are still in the sheet are kept; bookings made after
+        `started_at`, while the sheet was being read, are kept as they are.
+        """
+        started_at = time.time() if started_at is None else started_at
+        invoices = []
+        for row in rows:
+            row = list(row) + [''] * (7 - len(row))
+            if not any(str(value).strip() for value in row[:3]):
+                continue
+            invoice_date, invoice_number, description, quantity, amount, total, date_accessed = row[:7]
+            # Sheets returns numbers as numbers, e.g. invoice number 1234
+            invoice_date, invoice_number, date_accessed = str(invoice_date), str(invoice_number), str(date_accessed)
+            key = self._rebuild_key(invoice_number, invoice_date, date_accessed)
+            if not invoices or invoices[-1][0] != key:
+                invoices.append((key, invoice_number, invoice_date, date_accessed, []))
+            invoices[-1][4].append({'expense_description': str(description), 'expense_qty': quantity,
+                                    'expense_amount': amount, 'total_expense_cost': total})
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            kept = {}
+            for booking_id, number, date, accessed, vendor, content_hash, filename, booked_at in conn.execute(
+                    'SELECT id, invoice_number, invoice_date, date_accessed, vendor, content_hash, filename, '
+                    'booked_at FROM invoices ORDER BY id').fetchall():
+                kept.setdefault(self._rebuild_key(number, date, accessed),
+                                (booking_id, vendor, content_hash, filename, booked_at >= started_at))
+            conn.execute('DELETE FROM items WHERE invoice_id IN (SELECT id FROM invoices WHERE booked_at < ?)',
+                         (started_at,))
+            conn.execute('DELETE FROM invoices WHERE booked_at < ?', (started_at,))
+            # (vendor, booking id) of the invoices booked so far with each number and date
+            earlier = {}
+            counts = {'invoices': 0, 'items': 0, 'duplicates': 0}
+            for key, invoice_number, invoice_date, date_accessed, results in invoices:
+                booking_id, vendor, content_hash, filename, recent = kept.get(key, (None, None, None, None, False))
+                if recent:
+                    # Booked during the rebuild and already appended; it's kept as booked
+                    continue
+                match = (number_key(invoice_number), key[1])
+                duplicate_of = None
+                if match[0] is not None:
+                    duplicate_of = next((earlier_id for earlier_vendor, earlier_id in earlier.get(match, [])
+                                         if earlier_vendor is None or vendor is None or earlier_vendor == vendor),
+                                        None)
+                booking = self._insert(conn, vendor, invoice_number, invoice_date, date_accessed, content_hash,
+                                       filename, 'sheet', results, duplicate_of, started_at)
+                earlier.setdefault(match, []).append((vendor, booking['id']))
+                counts['invoices'] += 1
+                counts['items'] += booking['items']
+                counts['duplicates'] += duplicate_of is not None
+            conn.commit()
+        finally:
+            conn.close()
+        logger.info(f"Rebuilt the ledger from {len(rows)} sheet rows: {counts['invoices']} invoices, "
+                    f"{counts['duplicates']} duplicates")
+        return counts
+
+    @staticmethod
+    def _rebuild_key(invoice_number, invoice_date, date_accessed) -> Tuple:
+        return (number_key(invoice_number) or str(invoice_number).strip(),
+                iso_date(invoice_date) or str(invoice_date).strip(),
+                iso_date(date_accessed) if date_accessed else None)
+
+    def stats(self) -> Dict:
+        with self._connect() as conn:
+            invoices, duplicates, first, last = conn.execute(
+                'SELECT COUNT(*), COUNT(duplicate_of), MIN(day), MAX(day) FROM invoices'
+            ).fetchone()
+            items = conn.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+        return {
+            'invoices': invoices,
+            'items': items,
+            'duplicates': duplicates,
+            'first_invoice_date': first,
+            'last_invoice_date': last,
+            'on_duplicate': LEDGER_DUPLICATES,
+        }
+
+    @staticmethod
+    def _range(start: Optional[str], end: Optional[str]) -> Tuple[List[str], List]:
+        conditions, params = [], []
+        if start:
+            conditions.append('day >= ?')
+            params.append(start)
+        if end:
+            conditions.append('day <= ?')
+            params.append(end)
+        return conditions, params
+
+    @staticmethod
+    def _to_dict(row, match: Optional[str] = None) -> Dict:
+        booking = {column: row[column] for column in _COLUMNS}
+        if match is not None:
+            booking['match'] = match
+        return booking
+
+
+_default_ledger = None
+_default_ledger_lock = threading.Lock()
+
+
+def default_ledger() -> Optional[Ledger]:
+    """The process-wide ledger, or None if disabled with LEDGER=0."""
+    global _default_ledger
+    if os.environ.get('LEDGER', '1') == '0':
+        return None
+    if _default_ledger is None:
+        with _default_ledger_lock:
+            if _default_ledger is None:
+                _default_ledger = Ledger()
+    return _default_ledger
@@ -0,0 +1,165 @@
+"""
+Prometheus metrics for uploads, extraction and the Google APIs.
+
+Under gunicorn each worker (and each process pool child) writes its samples
+to files in PROMETHEUS_MULTIPROC_DIR, which gunicorn.conf.py sets up, and
+`exposition()` adds them up, so any worker can answer a scrape for all of
+them. Without that variable, e.g. under the Flask dev server, the metrics
+of the current process are exported.
+
+Recording a sample is a dictionary lookup and an mmap write, and happens
+once per invoice or API call rather than per line, so it adds nothing
+measurable to the hot path.
+"""
+import logging
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 2 * 1024 ** 2, 4 * 1024 ** 2,
+                 8 * 1024 ** 2, 16 * 1024 ** 2)
+PAGE_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+ITEM_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+UPLOAD_BYTES = Histogram('invoice_upload_bytes', 'Size of uploaded invoice files',
+                         buckets=BYTES_BUCKETS)
+PDF_PAGES = Histogram('invoice_pdf_pages', 'Pages in each PDF opened for extraction',
+                      buckets=PAGE_BUCKETS)
+EXTRACT_SECONDS = Histogram('invoice_extract_seconds',
+                            'Time to extract invoice text, by path (pdf text layer or ocr)',
+                            ['path'], buckets=SECONDS_BUCKETS)
+PARSE_SECONDS = Histogram('invoice_parse_seconds', 'Time to parse extracted invoice text',
+                          buckets=SECONDS_BUCKETS)
+LINE_ITEMS = Histogram('invoice_line_items', 'Line items parsed per invoice',
+                       buckets=ITEM_BUCKETS)
+IMAGE_PREP_SECONDS = Histogram('invoice_image_prep_seconds',
+                               'Time to prepare a batch of uploaded images for OCR',
+                               buckets=SECONDS_BUCKETS)
+OCR_IMAGE_BYTES = Counter('invoice_ocr_image_bytes',
+                          'Bytes of uploaded images, as uploaded and as sent to OCR after preparing them',
+                          ['stage'])
+API_SECONDS = Histogram('invoice_api_call_seconds',
+                        'Latency of Google API calls (one Vision batch or Sheets request)',
+                        ['api'], buckets=SECONDS_BUCKETS)
+API_ERRORS = Counter('invoice_api_errors', 'Failed Google API calls, by HTTP/RPC status or exception',
+                     ['api', 'error'])
+LAYOUT_LOOKUPS = Counter('invoice_layout_lookups',
+                         'Vendor layout lookups when parsing: hit, fallback (heuristics used) or miss',
+                         ['result'])
+LEDGER_DUPLICATES = Counter('invoice_ledger_duplicates',
+                            'Invoices found already booked in the ledger, by what was done: rejected or flagged',
+                            ['action'])
+IN_FLIGHT = Gauge('invoice_http_requests_in_flight', 'Requests being handled',
+                  multiprocess_mode='livesum')
+QUEUE_DEPTH = Gauge('invoice_job_queue_depth', 'Uploads waiting for a job worker',
+                    multiprocess_mode='livesum')
+
+
+def error_label(error: Exception) -> str:
+    """The status code of an API error if it has one, otherwise its type, to keep labels few."""
+    for attr in ('status_code', 'code'):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return str(value)
+    return type(error).__name__
+
+
+class StoreCollector:
+    """
+    Gauges read at scrape time from the SQLite stores shared by all workers
+    (result cache, job records, sheet row spool, vendor layouts, ledger), so
+    they are already totals. Any store may be None.
+    """
+
+    def __init__(self, cache=None, job_store=None, spool=None, layouts=None, ledger=None):
+        self.cache = cache
+        self.job_store = job_store
+        self.spool = spool
+        self.layouts = layouts
+        self.ledger = ledger
+
+    def collect(self):
+        for name, collect in (('cache', self._cache), ('jobs', self._jobs), ('spool', self._spool),
+                              ('layouts', self._layouts), ('ledger', self._ledger)):
+            try:
+                yield from collect()
+            except Exception as e:
+                # A locked or missing database shouldn't fail the whole scrape
+                logger.warning(f"Could not collect {name} metrics: {e}")
+
+    def _cache(self):
+        if self.cache is None:
+            return
+        stats = self.cache.stats()
+        entries = GaugeMetricFamily('invoice_cache_entries', 'Entries in the result cache',
+                                    labels=['kind'])
+        entries.add_metric(['text'], stats['texts'])
+        entries.add_metric(['results'], stats['results'])
+        yield entries
+        yield GaugeMetricFamily('invoice_cache_bytes', 'Size of the cached text and results',
+                                value=stats['bytes'])
+        lookups = CounterMetricFamily('invoice_cache_lookups', 'Result cache lookups by outcome',
+                                      labels=['status'])
+        for status, key in (('hit', 'hits'), ('text_hit', 'text_hits'), ('miss', 'misses')):
+            lookups.add_metric([status], stats[key])
+        yield lookups
+
+    def _jobs(self):
+        if self.job_store is None:
+            return
+        jobs = GaugeMetricFamily('invoice_jobs', 'Job records by state', labels=['state'])
+        for state, count in sorted(self.job_store.counts().items()):
+            jobs.add_metric([state], count)
+        yield jobs
+
+    def _spool(self):
+        if self.spool is None:
+            return
+        rows = GaugeMetricFamily('invoice_sheet_spool_rows',
+                                 'Rows waiting to be appended to the sheet, or rejected by it',
+                                 labels=['state'])
+        for state, count in sorted(self.spool.counts().items()):
+            rows.add_metric([state], count)
+        yield rows
+
+    def _layouts(self):
+        if self.layouts is None:
+            return
+        yield GaugeMetricFamily('invoice_layout_vendors', 'Vendors with a learned invoice layout',
+                                value=self.layouts.stats()['vendors'])
+
+    def _ledger(self):
+        if self.ledger is None:
+            return
+        stats = self.ledger.stats()
+        yield GaugeMetricFamily('invoice_ledger_invoices', 'Invoices booked in the ledger',
+                                value=stats['invoices'])
+        yield GaugeMetricFamily('invoice_ledger_items', 'Line items booked in the ledger',
+                                value=stats['items'])
+
+
+_collectors = []
+
+
+def register_collector(collector) -> None:
+    """Include `collector` in every exposition, e.g. a StoreCollector."""
+    _collectors.append(collector)
+
+
+def exposition() -> bytes:
+    """All metrics in the Prometheus text format, summed over worker processes."""
+    registry = CollectorRegistry()
+    if MULTIPROCESS:
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(REGISTRY)
+    for collector in _collectors:
+        registry.register(collector)
+    return generate_latest(registry)
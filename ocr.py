@@ -0,0 +1,288 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+from google.api_core import exceptions as api_exceptions
+from google.cloud import vision
+from pdf2image import convert_from_bytes, convert_from_path
+
+import metrics
+from clients import registry
+from offload import run_cpu_bound
+from sources import Source, read_source
+
+logger = logging.getLogger(__name__)
+
+# 'vision' (Google Cloud Vision) or 'tesseract' (local, needs pytesseract)
+OCR_BACKEND = os.environ.get('OCR_BACKEND', 'vision')
+# Pages with fewer extracted characters than this are treated as scans
+OCR_MIN_CHARS = int(os.environ.get('OCR_MIN_CHARS', 10))
+OCR_DPI = int(os.environ.get('OCR_DPI', 200))
+# Rasterized pages are downscaled so their longest side is at most this
+OCR_MAX_EDGE = int(os.environ.get('OCR_MAX_EDGE', 2000))
+OCR_JPEG_QUALITY = int(os.environ.get('OCR_JPEG_QUALITY', 85))
+OCR_THREADS = int(os.environ.get('OCR_THREADS', 4))
+
+# Vision accepts at most 16 images per batch_annotate_images request
+VISION_BATCH_SIZE = min(int(os.environ.get('VISION_BATCH_SIZE', 16)), 16)
+VISION_MAX_IN_FLIGHT = int(os.environ.get('VISION_MAX_IN_FLIGHT', 4))
+VISION_MAX_RETRIES = int(os.environ.get('VISION_MAX_RETRIES', 3))
+VISION_BACKOFF = float(os.environ.get('VISION_BACKOFF', 0.5))
+
+# gRPC status codes worth retrying: DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED,
+# INTERNAL, UNAVAILABLE
+RETRYABLE_CODES = {4, 8, 13, 14}
+RETRYABLE_RPC_ERRORS = (
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.InternalServerError,
+    api_exceptions.ServiceUnavailable,
+    ConnectionError,
+    TimeoutError,
+)
+
+# Caps concurrent batch_annotate_images calls across every thread in the process
+_in_flight = threading.BoundedSemaphore(VISION_MAX_IN_FLIGHT)
+
+
+class OcrBackend:
+    """Turns encoded images into text. Subclass and override `recognize_each`."""
+
+    def recognize_each(self, images: List[bytes]) -> List[Union[str, Exception]]:
+        """
+        Return the text of each image, in order, or the exception that image
+        failed with. One bad image doesn't fail the others.
+        """
+        raise NotImplementedError
+
+    def recognize(self, images: List[bytes]) -> List[str]:
+        """Return the text of each image, in order. Raises if any image failed."""
+        texts = self.recognize_each(images)
+        for text in texts:
+            if isinstance(text, Exception):
+                raise text
+        return texts
+
+
+class VisionOcrBackend(OcrBackend):
+    """
+    Google Cloud Vision document text detection.
+
+    Images are sent in batch_annotate_images calls of up to VISION_BATCH_SIZE
+    images, with at most VISION_MAX_IN_FLIGHT calls outstanding per process.
+    Items that fail with a transient error are retried on their own, with
+    exponential backoff; the rest of their batch is not resent.
+    """
+
+    def __init__(self, client=None, batch_size: int = None, max_retries: int = None,
+                 backoff: float = None):
+        # Without an explicit client, the registry's shared one is used and
+        # rebuilt if its channel breaks
+        self._client = client
+        self.batch_size = batch_size or VISION_BATCH_SIZE
+        self.max_retries = VISION_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = VISION_BACKOFF if backoff is None else backoff
+
+    def recognize_each(self, images: List[bytes]) -> List[Union[str, Exception]]:
+        results = [None] * len(images)
+        pending = list(range(len(images)))
+        attempt = 0
+        while pending:
+            chunks = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+            if len(chunks) == 1:
+                outcomes = [self._annotate_chunk(images, chunks[0])]
+            else:
+                with ThreadPoolExecutor(max_workers=min(len(chunks), VISION_MAX_IN_FLIGHT)) as pool:
+                    outcomes = list(pool.map(lambda chunk: self._annotate_chunk(images, chunk), chunks))
+
+            retry = []
+            for outcome in outcomes:
+                for index, text, error, retryable in outcome:
+                    if error is None:
+                        results[index] = text
+                    elif retryable and attempt < self.max_retries:
+                        retry.append(index)
+                    else:
+                        logger.error(f"Error during OCR: {error}")
+                        results[index] = Exception(f"Error during OCR: {error}")
+            if retry:
+                delay = self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+                logger.warning(f"Retrying OCR for {len(retry)} images in {delay:.2f}s")
+                time.sleep(delay)
+            pending = retry
+            attempt += 1
+        return results
+
+    def _annotate_chunk(self, images: List[bytes], indices: List[int]) -> List[Tuple]:
+        """Send one batch; return (index, text, error, retryable) for each image in it."""
+        feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+        requests = [
+            vision.AnnotateImageRequest(image=vision.Image(content=images[i]), features=[feature])
+            for i in indices
+        ]
+        try:
+            with _in_flight, metrics.API_SECONDS.labels('vision').time():
+                if self._client is None:
+                    response = registry.call(
+                        'vision', lambda client: client.batch_annotate_images(requests=requests)
+                    )
+                else:
+                    response = self._client.batch_annotate_images(requests=requests)
+        except RETRYABLE_RPC_ERRORS as e:
+            metrics.API_ERRORS.labels('vision', metrics.error_label(e)).inc()
+            return [(i, None, str(e), True) for i in indices]
+        except Exception as e:
+            metrics.API_ERRORS.labels('vision', metrics.error_label(e)).inc()
+            return [(i, None, str(e), False) for i in indices]
+
+        outcome = []
+        for index, item in zip(indices, response.responses):
+            if item.error.message:
+                # Per-image failures inside a successful call, by gRPC code
+                metrics.API_ERRORS.labels('vision', str(item.error.code)).inc()
+                outcome.append((index, None, item.error.message, item.error.code in RETRYABLE_CODES))
+            else:
+                outcome.append((index, item.full_text_annotation.text, None, False))
+        # A short response means the missing items were never processed
+        for index in indices[len(response.responses):]:
+            outcome.append((index, None, 'No response for image', True))
+        return outcome
+
+
+class TesseractOcrBackend(OcrBackend):
+    """Local OCR with Tesseract. Needs the optional pytesseract package."""
+
+    def __init__(self, lang: str = 'eng'):
+        try:
+            import pytesseract
+        except ImportError:
+            raise RuntimeError('OCR_BACKEND=tesseract needs pytesseract: pip install pytesseract')
+        self._pytesseract = pytesseract
+        self.lang = lang
+
+    def recognize_each(self, images: List[bytes]) -> List[Union[str, Exception]]:
+        texts = []
+        for content in images:
+            try:
+                image = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_GRAYSCALE)
+                texts.append(self._pytesseract.image_to_string(image, lang=self.lang))
+            except Exception as e:
+                texts.append(e)
+        return texts
+
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+def default_ocr_backend() -> OcrBackend:
+    """The process-wide backend selected by OCR_BACKEND."""
+    global _default_backend
+    if _default_backend is None:
+        with _default_backend_lock:
+            if _default_backend is None:
+                if OCR_BACKEND == 'tesseract':
+                    _default_backend = TesseractOcrBackend()
+                elif OCR_BACKEND == 'vision':
+                    _default_backend = VisionOcrBackend()
+                else:
+                    raise ValueError(f"Unknown OCR_BACKEND '{OCR_BACKEND}'")
+    return _default_backend
+
+
+def set_default_ocr_backend(backend: Optional[OcrBackend]) -> None:
+    """Replace the process-wide backend, e.g. with a local fake in tests."""
+    global _default_backend
+    with _default_backend_lock:
+        _default_backend = backend
+
+
+def needs_ocr(page_text: str) -> bool:
+    """True if a page's text layer is too thin to be anything but a scan."""
+    return len(page_text.strip()) < OCR_MIN_CHARS
+
+
+def rasterize_page(pdf: Union[str, bytes], page_number: int, dpi: int = None,
+                   max_edge: int = None) -> bytes:
+    """
+    Render one page (1-based) of a PDF, given by path or as bytes, to a
+    grayscale JPEG for OCR, downscaled so its longest side is at most
+    `max_edge` pixels.
+    """
+    dpi = dpi or OCR_DPI
+    max_edge = max_edge or OCR_MAX_EDGE
+    convert = convert_from_path if isinstance(pdf, str) else convert_from_bytes
+    pages = convert(pdf, dpi=dpi, first_page=page_number,
+                    last_page=page_number, grayscale=True)
+    return run_cpu_bound(_encode_page, pages[0], page_number, max_edge)
+
+
+def _encode_page(page, page_number: int, max_edge: int) -> bytes:
+    image = np.asarray(page.convert('L'))
+    height, width = image.shape[:2]
+    scale = max_edge / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (int(width * scale), int(height * scale)),
+                           interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, OCR_JPEG_QUALITY])
+    if not ok:
+        raise Exception(f"Could not encode page {page_number} for OCR")
+    return encoded.tobytes()
+
+
+class PageOcr:
+    """
+    OCRs individual pages of a PDF.
+
+    Pages are rasterized in the background on a small thread pool (pdftoppm
+    runs as a subprocess, so threads overlap well) while the caller keeps
+    reading the native text of the other pages. The images are then
+    recognized together so the backend can batch them.
+    """
+
+    def __init__(self, source: Source, backend: Optional[OcrBackend] = None,
+                 threads: int = None):
+        self.source = source
+        self.backend = backend or default_ocr_backend()
+        self._pool = ThreadPoolExecutor(max_workers=threads or OCR_THREADS,
+                                        thread_name_prefix='page-ocr')
+        self._futures = {}
+        self._pdf = None
+
+    def submit(self, page_number: int) -> None:
+        if self._pdf is None:
+            # A path is rendered from disk; anything else is read once, since
+            # a stream can't be shared between rendering threads
+            self._pdf = self.source if isinstance(self.source, str) else read_source(self.source)
+        self._futures[page_number] = self._pool.submit(rasterize_page, self._pdf, page_number)
+
+    def results(self) -> dict:
+        """Wait for every submitted page and return {page_number: text}."""
+        if not self._futures:
+            return {}
+        numbers = list(self._futures)
+        images = []
+        for number in numbers:
+            try:
+                images.append(self._futures[number].result())
+            except Exception as e:
+                raise Exception(f"Could not render page {number} for OCR: {str(e)}") from e
+
+        texts = {}
+        for number, text in zip(numbers, self.backend.recognize_each(images)):
+            if isinstance(text, Exception):
+                raise Exception(f"OCR failed on page {number}: {str(text)}") from text
+            texts[number] = text
+        return texts
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def __len__(self):
+        return len(self._futures)
@@ -0,0 +1,44 @@
+"""
+Keeps CPU-bound work off the gevent hub.
+
+Under the gevent worker (GUNICORN_WORKER_CLASS=gevent) every request and job
+"thread" is a greenlet sharing one OS thread, which is what lets hundreds of
+uploads wait on Vision and Sheets at once. A greenlet that spends 50ms in
+pdfplumber or the parser stalls all of them, though, so that work is run on
+a small pool of real OS threads and the calling greenlet waits for it
+cooperatively. In sync workers and scripts it simply runs in place.
+"""
+import os
+import sys
+import threading
+from typing import Callable
+
+# Real threads for CPU-bound work per gevent worker. More than the CPU count
+# only adds GIL contention.
+CPU_THREADS = int(os.environ.get('CPU_THREADS', 0)) or os.cpu_count() or 1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def cooperative() -> bool:
+    """True if gevent has monkey-patched this process, i.e. threads are greenlets."""
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def run_cpu_bound(fn: Callable, *args, **kwargs):
+    """Call `fn`, on a real thread if this process is running greenlets."""
+    if not cooperative():
+        return fn(*args, **kwargs)
+    return _cpu_pool().apply(fn, args, kwargs)
+
+
+def _cpu_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from gevent.threadpool import ThreadPool
+                _pool = ThreadPool(CPU_THREADS)
+    return _pool
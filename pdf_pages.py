@@ -0,0 +1,133 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, NamedTuple, Optional
+
+import numpy as np
+import pdfplumber
+from pdfplumber.utils.text import WordExtractor
+
+import metrics
+from offload import run_cpu_bound
+from pdf_tables import PageWords
+from sources import Source, open_source, source_path
+
+logger = logging.getLogger(__name__)
+
+# Pages beyond this are ignored; 0 means no limit
+PDF_MAX_PAGES = int(os.environ.get('PDF_MAX_PAGES', 500))
+# Documents with fewer pages than this are extracted in-process
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', 16))
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 0)) or os.cpu_count() or 1
+# Pages handed to a worker process at a time
+PDF_CHUNK_PAGES = 8
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _page_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+    return _pool
+
+
+class PdfPage(NamedTuple):
+    text: str
+    # The words and their boxes, if asked for
+    words: Optional[PageWords]
+
+
+def _page_text(page, words: bool = False) -> PdfPage:
+    if words:
+        # The words pdfplumber groups the characters into, kept with their
+        # boxes; the text is laid out from the same words, as extract_text()
+        # would, so they are only found once
+        word_map = WordExtractor().extract_wordmap(page.chars)
+        text = word_map.to_textmap(layout_width=page.width, layout_height=page.height,
+                                   x_shift=page.bbox[0], y_shift=page.bbox[1], presorted=True).as_string
+        found = [word for word, _ in word_map.tuples]
+        page_words = PageWords(
+            [word['text'] for word in found],
+            np.array([(word['x0'], word['x1'], word['top'], word['bottom']) for word in found],
+                     dtype=float).reshape(-1, 4)
+        )
+    else:
+        # extract_text() returns None for pages with no text layer
+        text = page.extract_text() or ''
+        page_words = None
+    # Drop the parsed layout and cached text map so memory doesn't grow
+    # with the page count
+    page.flush_cache()
+    if hasattr(page, 'get_textmap'):
+        page.get_textmap.cache_clear()
+    return PdfPage(text, page_words)
+
+
+def extract_page_range(file_path: str, first: int, last: int, words: bool = False) -> List[PdfPage]:
+    """Pages `first`..`last` (1-based, inclusive). Runs in a worker process."""
+    with pdfplumber.open(file_path, pages=list(range(first, last + 1))) as pdf:
+        return [_page_text(page, words) for page in pdf.pages]
+
+
+def count_pages(file_path: str) -> int:
+    with pdfplumber.open(file_path) as pdf:
+        return len(pdf.pages)
+
+
+def iter_pdf_pages(source: Source, max_pages: Optional[int] = None,
+                   workers: Optional[int] = None, words: bool = False) -> Iterator[PdfPage]:
+    """
+    Yield the text of each page of a PDF, in order, and with `words` its
+    words and their boxes too. `source` is a path, the PDF's bytes or a
+    binary stream.
+
+    Large documents are split into chunks of pages that are extracted in
+    parallel worker processes; only a few chunks are in flight at once, so
+    memory stays flat however long the document is. Closing the generator
+    early cancels any chunks that haven't started. Workers open the file by
+    path, so an in-memory document large enough to be split is written to a
+    temporary file first.
+    """
+    max_pages = PDF_MAX_PAGES if max_pages is None else max_pages
+    workers = PDF_WORKERS if workers is None else workers
+    # Worker processes (e.g. batch extraction) don't start pools of their own
+    if multiprocessing.parent_process() is not None:
+        workers = 1
+
+    with pdfplumber.open(open_source(source)) as pdf:
+        page_count = len(pdf.pages)
+        metrics.PDF_PAGES.observe(page_count)
+        if max_pages and page_count > max_pages:
+            logger.warning(f"PDF has {page_count} pages, only reading the first {max_pages}")
+            page_count = max_pages
+
+        if workers <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+            for page in pdf.pages[:page_count]:
+                yield run_cpu_bound(_page_text, page, words)
+            return
+
+    pool = _page_pool()
+    chunks = deque(
+        (first, min(first + PDF_CHUNK_PAGES - 1, page_count))
+        for first in range(1, page_count + 1, PDF_CHUNK_PAGES)
+    )
+    in_flight = deque()
+    with source_path(source, suffix='.pdf') as file_path:
+        try:
+            while chunks or in_flight:
+                while chunks and len(in_flight) < workers * 2:
+                    first, last = chunks.popleft()
+                    in_flight.append(pool.submit(extract_page_range, file_path, first, last, words))
+                yield from in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
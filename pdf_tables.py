@@ -0,0 +1,271 @@
+"""
+Line items read from where the words sit on PDF pages rather than from the
+flattened text.
+
+Each page's words come with their bounding boxes (see pdf_pages). Words are
+grouped into rows by their vertical position and into columns by the
+column header row ('Description', 'Qty', 'Rate', 'Amount', ...), with array
+operations over the whole page. Numbers are then read from the quantity,
+rate and total columns, so numbers inside descriptions ('Model 3000 bracket')
+are never mistaken for amounts, and a row with words only in the description
+column continues the item above it.
+
+Invoices that aren't laid out as a table are left to the text parser: a page
+whose rate and total columns aren't nearly all numbers (e.g. text that isn't
+aligned under the header) makes the whole document fall back.
+"""
+import logging
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+from invoice_parser import END_RE
+
+logger = logging.getLogger(__name__)
+
+# Words whose tops are this many points apart or less are on the same row
+# (pdfplumber's own line tolerance)
+ROW_TOLERANCE = 3
+# Words in a row closer than this many line heights are in the same cell
+CELL_GAP = 0.8
+# A description-only row continues the item above if it's at most this many
+# line heights below the previous row
+CONTINUATION_GAP = 2.0
+# Share of the words in the rate and total columns that must be numbers
+MIN_NUMERIC_SHARE = 0.9
+
+# Column roles, and the header words that name them. A header cell takes the
+# role of its first word that names one.
+DESCRIPTION, QUANTITY, RATE, TOTAL, DATE = 1, 2, 3, 4, 5
+HEADER_WORDS = {
+    'description': DESCRIPTION, 'details': DESCRIPTION, 'particulars': DESCRIPTION,
+    'service': DESCRIPTION, 'services': DESCRIPTION, 'product': DESCRIPTION, 'item': DESCRIPTION,
+    'qty': QUANTITY, 'quantity': QUANTITY, 'hours': QUANTITY, 'hrs': QUANTITY, 'units': QUANTITY,
+    'rate': RATE, 'price': RATE, 'unit': RATE, 'cost': RATE,
+    'amount': TOTAL, 'total': TOTAL, 'extended': TOTAL,
+    'date': DATE,
+}
+# Words that name the description column outright win over 'item' etc.
+STRONG_DESCRIPTION_WORDS = {'description', 'details', 'particulars'}
+CURRENCY_SYMBOLS = {'$', '€', '£'}
+
+
+class PageWords(NamedTuple):
+    """The words of one page: their text and an (n, 4) array of x0, x1, top, bottom."""
+    text: List[str]
+    boxes: np.ndarray
+
+
+class TableItem(NamedTuple):
+    description: str
+    quantity: float
+    amount: float
+    total: float
+
+
+class _Columns(NamedTuple):
+    # Column i spans bounds[i - 1]..bounds[i]
+    bounds: np.ndarray
+    roles: np.ndarray
+
+
+def numbers(words: np.ndarray) -> np.ndarray:
+    """The numeric value of each word ($ and thousands separators dropped), NaN if it isn't one."""
+    cleaned = np.char.replace(np.char.replace(words, '$', ''), ',', '')
+    digits = np.char.replace(np.char.lstrip(cleaned, '-'), '.', '')
+    valid = (np.char.isdigit(digits) & (np.char.count(cleaned, '.') <= 1) &
+             (np.char.count(cleaned, '-') == np.char.startswith(cleaned, '-')) &
+             ~np.char.endswith(cleaned, '.'))
+    values = np.full(len(words), np.nan)
+    if valid.any():
+        values[valid] = cleaned[valid].astype(float)
+    return values
+
+
+class TableReader:
+    """
+    Reads line items from a PDF's pages, fed in order.
+
+    The first column header row sets the columns; pages without one (long
+    statements) carry on with the columns of the last header. Reading is
+    `complete` once a terminator row ('Subtotal:', 'Total:', ...) follows
+    some items. `result()` is None if the document didn't read as a table,
+    e.g. a page had to be OCRed or its columns didn't hold numbers.
+    """
+
+    def __init__(self):
+        self.columns = None
+        self.items = []
+        self.complete = False
+        self.usable = True
+
+    def feed(self, words: Optional[PageWords]) -> None:
+        """Read the next page; None for a page without a text layer."""
+        if self.complete or not self.usable:
+            return
+        if words is None:
+            # The table may continue in the scan, where there are no boxes
+            self.usable = False
+            return
+        if words.text:
+            self._read_page(np.array(words.text), words.boxes)
+
+    def stop(self) -> None:
+        """The remaining pages won't be fed; unless the table ended, what was read is partial."""
+        if not self.complete:
+            self.usable = False
+
+    def result(self) -> Optional[List[TableItem]]:
+        return self.items if self.usable and self.items else None
+
+    def _read_page(self, text: np.ndarray, boxes: np.ndarray) -> None:
+        x0, x1, top, bottom = boxes.T
+        # Rows: split the words, in order down the page, wherever the gap
+        # between tops exceeds the tolerance
+        by_top = np.argsort(top, kind='stable')
+        row = np.empty(len(text), dtype=np.intp)
+        row[by_top] = np.concatenate(([0], np.cumsum(np.diff(top[by_top]) > ROW_TOLERANCE)))
+        row_count = row.max() + 1
+        keys = np.char.lower(np.char.strip(text, ':#.'))
+
+        header = self._find_header(keys, row, row_count)
+        if header != -1:
+            self.columns = self._header_columns(header, keys, row, x0, x1, top, bottom)
+        if self.columns is None:
+            # The table hasn't started yet
+            return
+
+        header_top = top[row == header].min() if header != -1 else None
+        # The words below the header, in reading order, and their columns
+        body = np.flatnonzero(row > header)
+        body = body[np.lexsort((x0[body], row[body]))]
+        if not len(body):
+            return
+        text, row, x0, x1, top, bottom = text[body], row[body], x0[body], x1[body], top[body], bottom[body]
+        # Words a space apart form a cell, which goes to the column its
+        # middle is in, so a long description running past the middle of
+        # the gap to the next column stays a description
+        new_cell = np.concatenate((
+            [True], (row[1:] != row[:-1]) | (x0[1:] - x1[:-1] > CELL_GAP * np.median(bottom - top))))
+        cell_starts = np.flatnonzero(new_cell)
+        cell_middle = (x0[cell_starts] + np.maximum.reduceat(x1, cell_starts)) / 2
+        cell_role = self.columns.roles[np.searchsorted(self.columns.bounds, cell_middle)]
+        role = cell_role[np.cumsum(new_cell) - 1]
+        values = numbers(text)
+
+        # One entry per row from here on
+        rows, starts = np.unique(row, return_index=True)
+        ends = np.append(starts[1:], len(row))
+        index = np.searchsorted(rows, row)
+        column_values = {}
+        for column_role in (QUANTITY, RATE, TOTAL):
+            # Words are in reading order, so the rightmost number in a cell wins
+            column = np.full(len(rows), np.nan)
+            found = (role == column_role) & ~np.isnan(values)
+            column[index[found]] = values[found]
+            column_values[column_role] = column
+        quantity, rate, total = column_values[QUANTITY], column_values[RATE], column_values[TOTAL]
+
+        item = ~np.isnan(total)
+        if RATE in self.columns.roles:
+            item &= ~np.isnan(rate)
+        elif QUANTITY in self.columns.roles:
+            item &= ~np.isnan(quantity)
+
+        # Nothing from the terminator row down is read
+        end = len(rows)
+        lowered = np.char.lower(text)
+        for i in np.flatnonzero(~item):
+            if END_RE.search(' '.join(lowered[starts[i]:ends[i]].tolist())):
+                end = i
+                break
+
+        # The rate and total columns of a real table hold numbers; text that
+        # merely sits under a header line doesn't
+        in_numbers = (((role == RATE) | (role == TOTAL)) & (index < end) &
+                      ~np.isin(text, list(CURRENCY_SYMBOLS)))
+        if in_numbers.any() and np.isnan(values[in_numbers]).mean() > 1 - MIN_NUMERIC_SHARE:
+            logger.debug("Page columns aren't numeric; leaving the line items to the text parser")
+            self.usable = False
+            return
+
+        # A row with words only in the description column, close below the
+        # previous row, continues the last item above it unless another kind
+        # of row comes in between. At the top of a page that is the last
+        # item of the page before.
+        description_words = np.bincount(index, weights=role == DESCRIPTION, minlength=len(rows))
+        gap = np.diff(top[starts], prepend=header_top if header != -1 else top[0])
+        continuation = (~item & (description_words == ends - starts) &
+                        (gap <= CONTINUATION_GAP * np.median(bottom - top)))
+        position = np.arange(len(rows))
+        last_item = np.maximum.accumulate(np.where(item, position, -1))
+        last_other = np.maximum.accumulate(np.where(~item & ~continuation, position, -1))
+        continuation &= (last_item > last_other) | ((last_other == -1) & bool(self.items))
+
+        # Fill in what the columns don't give, as the text parser does: the
+        # rate from total / quantity, the quantity from total / rate
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.where(np.isnan(rate), np.where(quantity > 0, np.round(total / quantity, 2), total), rate)
+            quantity = np.where(np.isnan(quantity), np.where(rate != 0, np.round(total / rate, 2), 1), quantity)
+
+        descriptions = self._descriptions(text, role, index, len(rows))
+        for i in np.flatnonzero((item | continuation)[:end]).tolist():
+            if item[i]:
+                self.items.append(TableItem(descriptions[i], float(quantity[i]), float(rate[i]), float(total[i])))
+            else:
+                previous = self.items[-1]
+                self.items[-1] = previous._replace(description=f'{previous.description} {descriptions[i]}')
+        if end < len(rows) and self.items:
+            self.complete = True
+
+    def _find_header(self, keys: np.ndarray, row: np.ndarray, row_count: int) -> int:
+        """The first row naming a description and a total column, mostly in header words; -1 if none."""
+        roles = np.array([HEADER_WORDS.get(word, 0) for word in keys.tolist()])
+        has_description = np.bincount(row, weights=roles == DESCRIPTION, minlength=row_count) > 0
+        has_total = np.bincount(row, weights=roles == TOTAL, minlength=row_count) > 0
+        header_words = np.bincount(row, weights=roles > 0, minlength=row_count)
+        words = np.bincount(row, minlength=row_count)
+        candidates = np.flatnonzero(has_description & has_total & (header_words >= 0.5 * words))
+        return int(candidates[0]) if len(candidates) else -1
+
+    def _header_columns(self, header: int, keys, row, x0, x1, top, bottom) -> Optional[_Columns]:
+        words = np.flatnonzero(row == header)
+        words = words[np.argsort(x0[words])]
+        gap = CELL_GAP * np.median(bottom[words] - top[words])
+        # A new cell wherever the space before a word is wider than the gap
+        new_cell = np.concatenate(([True], x0[words[1:]] - x1[words[:-1]] > gap))
+        cell = np.cumsum(new_cell) - 1
+        cell_x0 = x0[words][new_cell]
+        cell_x1 = np.maximum.reduceat(x1[words], np.flatnonzero(new_cell))
+        roles = np.zeros(len(cell_x0), dtype=np.intp)
+        strong = None
+        for i, word in zip(cell.tolist(), keys[words].tolist()):
+            if not roles[i] and word in HEADER_WORDS:
+                roles[i] = HEADER_WORDS[word]
+            if word in STRONG_DESCRIPTION_WORDS and strong is None:
+                strong = i
+        # One column per role: the strongly named description column, the
+        # rightmost total, otherwise the leftmost
+        for column_role in (DESCRIPTION, QUANTITY, RATE, TOTAL, DATE):
+            cells = np.flatnonzero(roles == column_role)
+            if len(cells) > 1:
+                keep = strong if column_role == DESCRIPTION and strong in cells else (
+                    cells[-1] if column_role == TOTAL else cells[0])
+                roles[cells[cells != keep]] = 0
+        if DESCRIPTION not in roles or TOTAL not in roles:
+            return None
+        return _Columns(bounds=(cell_x1[:-1] + cell_x0[1:]) / 2, roles=roles)
+
+    def _descriptions(self, text: np.ndarray, role: np.ndarray, index: np.ndarray,
+                      row_count: int) -> List[str]:
+        """The description column's text in each row (`index` is each word's row)."""
+        words = np.flatnonzero(role == DESCRIPTION)
+        descriptions = [''] * row_count
+        if not len(words):
+            return descriptions
+        described = index[words]
+        splits = np.flatnonzero(np.diff(described)) + 1
+        for i, group in zip(described[np.concatenate(([0], splits))].tolist(),
+                            np.split(text[words], splits)):
+            descriptions[i] = ' '.join(group.tolist())
+        return descriptions
@@ -0,0 +1,448 @@
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from googleapiclient.errors import HttpError
+
+import metrics
+from clients import registry
+from jobs import pid_alive
+
+logger = logging.getLogger(__name__)
+
+# Column headers for the first row of the sheet
+SHEET_HEADERS = ['Invoice Date', 'Invoice Number', 'Expense Description',
+                 'Expense Quantity', 'Expense Amount', 'Total Expense Cost',
+                 'Date Accessed']
+HEADER_RANGE = 'Sheet1!A1:G1'
+RANGE_NAME = 'Sheet1!A2:G'  # Starting from A2 to leave room for headers
+
+SHEETS_SPOOL_PATH = os.environ.get('SHEETS_SPOOL', os.path.join('data', 'sheet_spool.db'))
+# Buffered rows are flushed once there are this many...
+SHEETS_FLUSH_ROWS = int(os.environ.get('SHEETS_FLUSH_ROWS', 200))
+# ...or once the oldest has waited this long
+SHEETS_FLUSH_SECONDS = float(os.environ.get('SHEETS_FLUSH_SECONDS', 1.0))
+# Rows sent in a single append call
+SHEETS_APPEND_MAX_ROWS = int(os.environ.get('SHEETS_APPEND_MAX_ROWS', 2000))
+SHEETS_MAX_RETRIES = int(os.environ.get('SHEETS_MAX_RETRIES', 5))
+SHEETS_BACKOFF = float(os.environ.get('SHEETS_BACKOFF', 1.0))
+# How long write() waits for its rows to be flushed
+SHEETS_WAIT_SECONDS = float(os.environ.get('SHEETS_WAIT_SECONDS', 120))
+# Rows fetched per request when reading the sheet back
+SHEETS_READ_ROWS = 10000
+
+# Quota exceeded and server-side errors; anything else is a bad request
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class SheetWriteDeferred(Exception):
+    """Raised when Sheets is unavailable; the rows stay spooled and are retried."""
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUS
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout))
+
+
+def sheet_row(item: Dict) -> List:
+    """One extracted line item as a row of the sheet."""
+    return [
+        item['invoice_date'],
+        item['invoice_number'],
+        item['expense_description'],
+        item['expense_qty'],
+        item['expense_amount'],
+        item['total_expense_cost'],
+        item['date_accessed']
+    ]
+
+
+class RowSpool:
+    """
+    Rows waiting to be appended, in SQLite.
+
+    write() stores rows here before handing them to the flusher, and they
+    are only deleted once Sheets has accepted them, so a worker that dies with rows
+    buffered doesn't lose them: another worker claims them when it starts
+    writing. Delivery is at least once; a crash between a successful append
+    and the delete can repeat those rows.
+    """
+
+    def __init__(self, path: str = SHEETS_SPOOL_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rows (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    spreadsheet_id TEXT NOT NULL,
+                    row TEXT NOT NULL,
+                    owner_pid INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    error TEXT
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS rows_owner ON rows (owner_pid, error)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add(self, spreadsheet_id: str, rows: List[List]) -> List[int]:
+        """Spool rows for this process to flush; returns their ids."""
+        ids = []
+        now = time.time()
+        with self._connect() as conn:
+            for row in rows:
+                cursor = conn.execute(
+                    'INSERT INTO rows (spreadsheet_id, row, owner_pid, created_at) VALUES (?, ?, ?, ?)',
+                    (spreadsheet_id, json.dumps(row), os.getpid(), now)
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def pending(self, limit: int) -> List[tuple]:
+        """The oldest unsent rows owned by this process, as (id, spreadsheet_id, row)."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT id, spreadsheet_id, row FROM rows WHERE owner_pid = ? AND error IS NULL '
+                'ORDER BY id LIMIT ?', (os.getpid(), limit)
+            ).fetchall()
+        return [(row_id, spreadsheet_id, json.loads(row)) for row_id, spreadsheet_id, row in rows]
+
+    def remove(self, ids: List[int]) -> None:
+        with self._connect() as conn:
+            conn.executemany('DELETE FROM rows WHERE id = ?', [(row_id,) for row_id in ids])
+
+    def mark_failed(self, ids: List[int], error: str) -> None:
+        """Set rows aside that Sheets rejected, so they don't block the rest."""
+        with self._connect() as conn:
+            conn.executemany('UPDATE rows SET error = ? WHERE id = ?',
+                             [(error, row_id) for row_id in ids])
+
+    def claim_orphaned(self) -> int:
+        """Take over unsent rows of processes that have exited. Returns how many."""
+        claimed = 0
+        with self._connect() as conn:
+            owners = conn.execute(
+                'SELECT DISTINCT owner_pid FROM rows WHERE error IS NULL AND owner_pid != ?',
+                (os.getpid(),)
+            ).fetchall()
+            for (pid,) in owners:
+                if not pid_alive(pid):
+                    claimed += conn.execute(
+                        'UPDATE rows SET owner_pid = ? WHERE owner_pid = ? AND error IS NULL',
+                        (os.getpid(), pid)
+                    ).rowcount
+        return claimed
+
+    def counts(self) -> Dict:
+        with self._connect() as conn:
+            pending, failed = conn.execute(
+                'SELECT COUNT(*) - COUNT(error), COUNT(error) FROM rows'
+            ).fetchone()
+        return {'pending': pending, 'failed': failed}
+
+
+class _Waiter:
+    def __init__(self, ids: List[int]):
+        self.ids = set(ids)
+        self.event = threading.Event()
+        self.error = None
+
+
+class SheetWriter:
+    """
+    Appends line items to Google Sheets in batches.
+
+    Rows from concurrent uploads are spooled and flushed by one background
+    thread per process as a single append, once SHEETS_FLUSH_ROWS rows are
+    buffered or the oldest has waited SHEETS_FLUSH_SECONDS. The header row is
+    checked once per spreadsheet per process rather than before every append.
+    Quota (429) and server (5xx) errors are retried with exponential backoff;
+    if Sheets stays unavailable the rows remain spooled and are retried on
+    the next flush.
+
+    Pass `service` to write to a fake Sheets service instead of the
+    registry's client.
+    """
+
+    def __init__(self, spool: Optional[RowSpool] = None, service=None,
+                 flush_rows: int = None, flush_seconds: float = None,
+                 max_retries: int = None, backoff: float = None):
+        self.spool = spool if spool is not None else RowSpool()
+        self._service = service
+        self.flush_rows = flush_rows or SHEETS_FLUSH_ROWS
+        self.flush_seconds = SHEETS_FLUSH_SECONDS if flush_seconds is None else flush_seconds
+        self.max_retries = SHEETS_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = SHEETS_BACKOFF if backoff is None else backoff
+        self._headers_ok = set()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._waiters = []
+        self._buffered = 0
+        self._oldest = None
+        self._thread = None
+        self._closed = False
+        self.appends = 0
+        self.rows_written = 0
+        self.retries = 0
+
+    def write(self, spreadsheet_id: str, results: List[Dict], wait: bool = True,
+              timeout: float = None) -> None:
+        """
+        Queue line items for the sheet. With `wait`, block until they have
+        been appended; raises SheetWriteDeferred if Sheets is unavailable
+        (the rows are kept and retried) or the error Sheets rejected them with.
+        """
+        rows = [sheet_row(item) for item in results]
+        if not rows:
+            return
+        ids = self.spool.add(spreadsheet_id, rows)
+        waiter = _Waiter(ids) if wait else None
+        self._ensure_started()
+        with self._cond:
+            if waiter:
+                self._waiters.append(waiter)
+            self._buffered += len(rows)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._cond.notify()
+        if waiter is None:
+            return
+        if not waiter.event.wait(SHEETS_WAIT_SECONDS if timeout is None else timeout):
+            raise SheetWriteDeferred(f'Sheet write is taking too long; {len(rows)} rows are spooled and will be retried')
+        if waiter.error is not None:
+            raise waiter.error
+
+    def flush(self) -> bool:
+        """
+        Append every spooled row of this process now. Returns False if
+        Sheets was unavailable and rows are still waiting.
+        """
+        with self._flush_lock:
+            while True:
+                batch = self.spool.pending(SHEETS_APPEND_MAX_ROWS)
+                if not batch:
+                    return True
+                by_sheet = {}
+                for row_id, spreadsheet_id, row in batch:
+                    ids, values = by_sheet.setdefault(spreadsheet_id, ([], []))
+                    ids.append(row_id)
+                    values.append(row)
+                for spreadsheet_id, (ids, values) in by_sheet.items():
+                    try:
+                        self.ensure_headers(spreadsheet_id)
+                        self._append(spreadsheet_id, values)
+                    except Exception as e:
+                        if is_retryable(e):
+                            logger.warning(f"Sheets unavailable, {len(ids)} rows left spooled: {e}")
+                            self._resolve(ids, SheetWriteDeferred(
+                                f'Google Sheets is unavailable; {len(ids)} rows are spooled and will be retried: {e}'
+                            ))
+                            return False
+                        logger.error(f"Sheets rejected {len(ids)} rows: {e}")
+                        self.spool.mark_failed(ids, str(e))
+                        self._resolve(ids, e)
+                    else:
+                        self.spool.remove(ids)
+                        self._resolve(ids, None)
+
+    def ensure_headers(self, spreadsheet_id: str) -> None:
+        """Write and style the header row if the sheet doesn't have one yet."""
+        if spreadsheet_id in self._headers_ok:
+            return
+        result = self._call(lambda service: service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id,
+            range=HEADER_RANGE
+        ).execute())
+
+        if 'values' not in result:
+            # Add headers if they don't exist
+            self._call(lambda service: service.spreadsheets().values().update(
+                spreadsheetId=spreadsheet_id,
+                range=HEADER_RANGE,
+                valueInputOption='RAW',
+                body={'values': [SHEET_HEADERS]}
+            ).execute())
+
+            # Apply header styling
+            requests = [{
+                'repeatCell': {
+                    'range': {
+                        'sheetId': 0,  # Assuming first sheet
+                        'startRowIndex': 0,
+                        'endRowIndex': 1,
+                        'startColumnIndex': 0,
+                        'endColumnIndex': 7
+                    },
+                    'cell': {
+                        'userEnteredFormat': {
+                            'backgroundColor': {
+                                'red': 0.9,
+                                'green': 0.9,
+                                'blue': 0.9
+                            },
+                            'textFormat': {
+                                'bold': True
+                            }
+                        }
+                    },
+                    'fields': 'userEnteredFormat(backgroundColor,textFormat)'
+                }
+            },
+            {
+                'updateSheetProperties': {
+                    'properties': {
+                        'sheetId': 0,
+                        'gridProperties': {
+                            'frozenRowCount': 1
+                        }
+                    },
+                    'fields': 'gridProperties.frozenRowCount'
+                }
+            }]
+
+            self._call(lambda service: service.spreadsheets().batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={'requests': requests}
+            ).execute())
+        self._headers_ok.add(spreadsheet_id)
+
+    def read_rows(self, spreadsheet_id: str) -> List[List]:
+        """
+        Every row below the header, as sheet_row() lays them out. Numbers
+        come back as numbers and dates as the sheet shows them.
+        """
+        rows = []
+        start = 2
+        while True:
+            end = start + SHEETS_READ_ROWS - 1
+            result = self._call(lambda service: service.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id,
+                range=f'Sheet1!A{start}:G{end}',
+                valueRenderOption='UNFORMATTED_VALUE',
+                dateTimeRenderOption='FORMATTED_STRING'
+            ).execute())
+            values = result.get('values', [])
+            rows.extend(values)
+            if len(values) < SHEETS_READ_ROWS:
+                return rows
+            start = end + 1
+
+    def stats(self) -> Dict:
+        with self._cond:
+            buffered = self._buffered
+        return dict(self.spool.counts(), buffered=buffered, appends=self.appends,
+                    rows_written=self.rows_written, retries=self.retries,
+                    headers_checked=sorted(self._headers_ok))
+
+    def close(self, timeout: float = 10) -> None:
+        """Stop the flusher after a final flush."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _append(self, spreadsheet_id: str, values: List[List]) -> None:
+        self._call(lambda service: service.spreadsheets().values().append(
+            spreadsheetId=spreadsheet_id,
+            range=RANGE_NAME,  # Start from row 2 to preserve headers
+            valueInputOption='USER_ENTERED',
+            insertDataOption='INSERT_ROWS',
+            body={'values': values}
+        ).execute())
+        self.appends += 1
+        self.rows_written += len(values)
+
+    def _call(self, fn):
+        """Run `fn(service)`, retrying quota and server errors with backoff."""
+        attempt = 0
+        while True:
+            try:
+                with metrics.API_SECONDS.labels('sheets').time():
+                    if self._service is not None:
+                        return fn(self._service)
+                    return registry.call('sheets', fn)
+            except Exception as e:
+                metrics.API_ERRORS.labels('sheets', metrics.error_label(e)).inc()
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+                self.retries += 1
+                logger.warning(f"Sheets call failed ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def _resolve(self, ids: List[int], error: Optional[Exception]) -> None:
+        flushed = set(ids)
+        with self._cond:
+            for waiter in list(self._waiters):
+                if waiter.ids & flushed:
+                    waiter.ids -= flushed
+                    if error is not None:
+                        waiter.error = error
+                    if not waiter.ids or error is not None:
+                        waiter.event.set()
+                        self._waiters.remove(waiter)
+
+    def _ensure_started(self):
+        # Started on first use so the thread is created after gunicorn forks
+        if self._thread is not None:
+            return
+        with self._cond:
+            if self._thread is not None:
+                return
+            claimed = self.spool.claim_orphaned()
+            if claimed:
+                logger.warning(f"Recovered {claimed} spooled sheet rows from an exited worker")
+                self._buffered += claimed
+                self._oldest = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name='sheet-writer', daemon=True)
+            self._thread.start()
+
+    def _due(self) -> bool:
+        if self._buffered >= self.flush_rows:
+            return True
+        return self._oldest is not None and time.monotonic() - self._oldest >= self.flush_seconds
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self._cond:
+                while not self._closed and not self._due():
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = max(0.0, self._oldest + self.flush_seconds - time.monotonic())
+                    self._cond.wait(timeout)
+                closed = self._closed
+                self._buffered = 0
+                self._oldest = None
+
+            try:
+                ok = self.flush()
+            except Exception:
+                logger.exception("Sheet flush failed")
+                ok = False
+            if closed:
+                return
+            if ok:
+                failures = 0
+                continue
+
+            # Sheets is down: back off before trying the spooled rows again
+            failures += 1
+            time.sleep(min(self.backoff * (2 ** failures), 60))
+            with self._cond:
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
@@ -0,0 +1,93 @@
+"""
+Helpers for invoice sources, which may be a file path, the file's bytes, or
+a binary file-like object such as an upload's spooled temporary file.
+"""
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, Union
+
+Source = Union[str, bytes, BinaryIO]
+
+PDF_MAGIC = b'%PDF'
+
+
+def read_source(source: Source) -> bytes:
+    """
+    The full contents of `source`. Streams are read from the start and left
+    where they were, since a PDF parser may still be reading them.
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return f.read()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    position = source.tell()
+    source.seek(0)
+    data = source.read()
+    source.seek(position)
+    return data
+
+
+def open_source(source: Source) -> Union[str, BinaryIO]:
+    """Something pdfplumber.open() accepts: the path itself, or a seekable stream."""
+    if isinstance(source, str):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    source.seek(0)
+    return source
+
+
+def source_name(source: Source, filename: Optional[str] = None) -> Optional[str]:
+    if filename:
+        return filename
+    if isinstance(source, str):
+        return source
+    name = getattr(source, 'name', None)
+    return name if isinstance(name, str) else None
+
+
+def is_pdf_source(source: Source, filename: Optional[str] = None) -> bool:
+    """By extension when there is a name to go by, otherwise by the PDF header."""
+    name = source_name(source, filename)
+    if name and '.' in os.path.basename(name):
+        return name.lower().endswith('.pdf')
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[:len(PDF_MAGIC)]) == PDF_MAGIC
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return f.read(len(PDF_MAGIC)) == PDF_MAGIC
+    position = source.tell()
+    source.seek(0)
+    head = source.read(len(PDF_MAGIC))
+    source.seek(position)
+    return head == PDF_MAGIC
+
+
+@contextmanager
+def source_path(source: Source, suffix: str = '') -> Iterator[str]:
+    """
+    A path to the source's contents, for code that must open the file by
+    name (e.g. worker processes). In-memory sources are written to a
+    temporary file that is removed afterwards.
+    """
+    if isinstance(source, str):
+        yield source
+        return
+    handle, path = tempfile.mkstemp(suffix=suffix, prefix='invoice_')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                f.write(source)
+            else:
+                source.seek(0)
+                while True:
+                    chunk = source.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        yield path
+    finally:
+        os.remove(path)
@@ -0,0 +1,153 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Fraction of traces that also log verbose dumps (extracted text, line items)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+# Log one structured summary line per finished trace
+TRACE_LOG = os.environ.get('TRACE_LOG', '1') != '0'
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    """
+    Timing and counts for one unit of work (an upload, a job, a batch).
+
+    Durations are collected per named span and summed if a span repeats;
+    counts and notes record what was done (pages, lines, items, cache hit).
+    Verbose dumps of invoice contents are only produced when the trace is
+    verbose, either because the request asked for it or because it was
+    sampled, and are only formatted in that case.
+
+    A listener, if one is set, is sent progress events as they happen: each
+    span as it starts and whatever the code reports with `event()` (pages
+    read, line items found).
+    """
+
+    def __init__(self, name: str, verbose: Optional[bool] = None):
+        self.name = name
+        self.id = uuid.uuid4().hex[:12]
+        self.verbose = verbose if verbose is not None else random.random() < TRACE_SAMPLE_RATE
+        self._start = time.perf_counter()
+        self.spans = {}
+        self.counts = {}
+        self.notes = {}
+        self._listener = None
+
+    @contextmanager
+    def span(self, name: str):
+        self.event('stage', stage=name)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.perf_counter() - start
+
+    def add_span(self, name: str, seconds: float) -> None:
+        """Record a duration measured elsewhere, e.g. time spent queued."""
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def note(self, name: str, value) -> None:
+        """Attach a non-timing detail, e.g. whether the result came from cache."""
+        self.notes[name] = value
+
+    def listen(self, listener: Callable[[Dict], None]) -> None:
+        """Send this trace's progress events to `listener(event)`."""
+        self._listener = listener
+
+    @property
+    def listening(self) -> bool:
+        """True if events go anywhere; check before building an expensive one."""
+        return self._listener is not None
+
+    def event(self, name: str, **fields) -> None:
+        """Report progress to the listener, if there is one. A failing listener doesn't fail the work."""
+        if self._listener is None:
+            return
+        try:
+            self._listener(dict(fields, event=name))
+        except Exception as e:
+            logger.warning(f"Could not report {name} event for trace {self.id}: {e}")
+
+    def dump(self, label: str, value) -> None:
+        """
+        Log `value` if this trace is verbose. Pass a callable to defer
+        building an expensive value until it is known to be needed.
+        """
+        if not self.verbose:
+            return
+        if callable(value):
+            value = value()
+        logger.info('trace %s %s:\n%s', self.id, label, value)
+
+    @contextmanager
+    def activate(self):
+        """Make this the current trace for code running in this context."""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def as_dict(self) -> Dict:
+        """Span durations in milliseconds, the total since creation, counts and notes."""
+        result = {name: round(seconds * 1000, 2) for name, seconds in self.spans.items()}
+        result['total'] = round((time.perf_counter() - self._start) * 1000, 2)
+        if self.counts:
+            result['counts'] = dict(self.counts)
+        result.update(self.notes)
+        return result
+
+    def finish(self) -> Dict:
+        """Log the structured summary and return it."""
+        summary = self.as_dict()
+        if TRACE_LOG and logger.isEnabledFor(logging.INFO):
+            logger.info('trace %s', json.dumps(dict(summary, trace=self.id, name=self.name), default=str))
+        return summary
+
+
+class _NullTrace(Trace):
+    """Stands in when nothing is being traced, e.g. in a worker process."""
+
+    def __init__(self):
+        super().__init__('null', verbose=False)
+
+    @contextmanager
+    def span(self, name: str):
+        yield self
+
+    def add_span(self, name: str, seconds: float) -> None:
+        pass
+
+    def count(self, name: str, n: int = 1) -> None:
+        pass
+
+    def note(self, name: str, value) -> None:
+        pass
+
+    def listen(self, listener: Callable[[Dict], None]) -> None:
+        # Shared by everything untraced, so it never has a listener
+        pass
+
+    def finish(self) -> Dict:
+        return {}
+
+
+NULL_TRACE = _NullTrace()
+
+
+def current_trace() -> Trace:
+    """The trace active in this context, or a no-op one."""
+    return _current.get() or NULL_TRACE